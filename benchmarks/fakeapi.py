@@ -0,0 +1,475 @@
+"""
+A local stand-in for the parts of the DigitalOcean /v2 API that vpsutil
+uses.  The account's state lives in memory and every request is counted
+so benchmarks can report how many calls an operation makes.
+
+    server = FakeAPIServer(latency=0.05, fleet_size=200, page_size=50)
+    server.start()
+    vpsutil.api.Base.URL = server.url
+"""
+import base64
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+try:
+    from urllib.parse import parse_qsl, urlencode, urlsplit
+except ImportError:  # pragma: no cover
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit
+
+REGIONS = ("nyc1", "nyc3", "sfo2", "ams3", "lon1", "fra1")
+SIZES = ("s-1vcpu-1gb", "s-2vcpu-2gb", "s-4vcpu-8gb")
+FEATURES = ("private_networking", "backups", "ipv6", "metadata")
+
+# (method, pattern) -> handler name, patterns double as the templates
+# requests are counted under
+ROUTES = (
+    ("GET", r"/droplets", "list_droplets"),
+    ("POST", r"/droplets", "create_droplets"),
+    ("GET", r"/droplets/(\d+)", "get_droplet"),
+    ("DELETE", r"/droplets/(\d+)", "delete_droplet"),
+    ("POST", r"/droplets/(\d+)/actions", "droplet_action"),
+    ("GET", r"/actions", "list_actions"),
+    ("GET", r"/actions/(\d+)", "get_action"),
+    ("GET", r"/account/keys", "list_keys"),
+    ("POST", r"/account/keys", "create_key"),
+    ("DELETE", r"/account/keys/(\d+)", "delete_key"),
+    ("GET", r"/domains/([^/]+)/records", "list_records"),
+    ("POST", r"/domains/([^/]+)/records", "create_record"),
+    ("PUT", r"/domains/([^/]+)/records/(\d+)", "update_record"),
+    ("DELETE", r"/domains/([^/]+)/records/(\d+)", "delete_record"),
+    ("GET", r"/images", "list_images"),
+    ("GET", r"/regions", "list_regions"),
+    ("GET", r"/sizes", "list_sizes"),
+)
+ROUTES = tuple(
+    (method, re.compile("^/v2%s$" % pattern), pattern, name)
+    for method, pattern, name in ROUTES)
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super(APIError, self).__init__(message)
+        self.status = status
+
+
+class Account(object):
+    """
+    The in-memory state of the fake account.
+
+    :param int fleet_size:
+        The number of droplets the account starts with, named
+        ``host-0000`` and up, each with an A record in ``domain``.
+
+    :param float boot_time:
+        Seconds before a new droplet becomes active.
+
+    :param string domain:
+        The domain whose records are served.
+    """
+    def __init__(self, fleet_size=0, boot_time=0.0, domain="example.com"):
+        self.boot_time = boot_time
+        self.domain = domain
+        self.lock = threading.Lock()
+        self.next_id = 1000
+        self.droplets = {}
+        self.keys = {}
+        self.records = {}
+        self.actions = {}
+        self.images = [
+            {"id": 10, "slug": "ubuntu-24-04-x64", "name": "24.04 x64",
+             "distribution": "Ubuntu", "public": True,
+             "regions": list(REGIONS)},
+            {"id": 11, "slug": "debian-12-x64", "name": "12 x64",
+             "distribution": "Debian", "public": True,
+             "regions": list(REGIONS)},
+            {"id": 20, "slug": None, "name": "base-snapshot",
+             "distribution": "Ubuntu", "public": False,
+             "regions": list(REGIONS[:2])}]
+        self.regions = [
+            {"slug": slug, "name": slug, "available": True,
+             "sizes": list(SIZES), "features": list(FEATURES)}
+            for slug in REGIONS]
+        self.sizes = [
+            {"slug": slug, "available": True, "regions": list(REGIONS)}
+            for slug in SIZES]
+
+        for index in range(fleet_size):
+            droplet = self._droplet(
+                "host-%04d" % index, SIZES[0], REGIONS[index % len(REGIONS)],
+                self.images[0]["id"], active=True)
+            self._record("A", droplet["name"], self._address(droplet["id"]))
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def _address(self, droplet_id):
+        return "10.%d.%d.%d" % (
+            (droplet_id >> 16) & 255, (droplet_id >> 8) & 255,
+            droplet_id & 255)
+
+    def _droplet(self, name, size, region, image, tags=(), active=False):
+        droplet_id = self.new_id()
+        droplet = {
+            "id": droplet_id, "name": name, "memory": 1024, "vcpus": 1,
+            "disk": 25, "locked": False, "status": "new",
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "features": [], "backup_ids": [], "snapshot_ids": [],
+            "image": {"id": image}, "size_slug": size,
+            "region": {"slug": region, "name": region},
+            "networks": {"v4": [], "v6": []}, "tags": list(tags),
+            "_ready": time.time() + (0 if active else self.boot_time)}
+        self.droplets[droplet_id] = droplet
+        self._boot(droplet)
+        return droplet
+
+    def _boot(self, droplet):
+        if droplet["status"] == "new" and droplet["_ready"] <= time.time():
+            droplet["status"] = "active"
+            droplet["networks"]["v4"] = [{
+                "ip_address": self._address(droplet["id"]),
+                "netmask": "255.255.0.0", "gateway": "10.0.0.1",
+                "type": "public"}]
+
+    def _record(self, record_type, name, data):
+        record_id = self.new_id()
+        record = {"id": record_id, "type": record_type, "name": name,
+                  "data": data, "priority": None, "port": None,
+                  "ttl": 1800, "weight": None}
+        self.records[record_id] = record
+        return record
+
+    def droplet(self, droplet_id):
+        droplet = self.droplets.get(droplet_id)
+        if droplet is None:
+            raise APIError(404, "droplet not found")
+        self._boot(droplet)
+        return public(droplet)
+
+    def all_droplets(self, tag_name=None):
+        droplets = []
+        for droplet_id in sorted(self.droplets):
+            droplet = self.droplets[droplet_id]
+            if tag_name is not None and tag_name not in droplet["tags"]:
+                continue
+            self._boot(droplet)
+            droplets.append(public(droplet))
+        return droplets
+
+
+def public(item):
+    """Returns ``item`` without the private bookkeeping fields"""
+    return dict(
+        (key, value) for key, value in item.items()
+        if not key.startswith("_"))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Buffer the headers and body into one write, separate small writes
+    # run into delayed ACKs and add ~40ms to every request
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def account(self):
+        return self.server.account
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.server.count("bytes_received", len(body) + len(
+            str(self.headers)) + len(self.requestline) + 2)
+        if not body:
+            return {}
+        return json.loads(body.decode("utf-8"))
+
+    def _send(self, status, data=None, headers=None):
+        body = b""
+        if data is not None:
+            body = json.dumps(data).encode("utf-8")
+
+        etag = None
+        if status == 200 and self.command == "GET":
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+
+        # Counted before anything is sent, once the client has the
+        # response the benchmark may read and reset the stats.
+        self.server.count("bytes_sent", len(body))
+        self.server.count("status_%d" % status)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("RateLimit-Limit", "5000")
+        self.send_header("RateLimit-Remaining", "4999")
+        self.send_header("RateLimit-Reset", str(int(time.time()) + 60))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _page(self, key, items, query):
+        per_page = min(
+            int(query.get("per_page", 20)), self.server.page_size or 200)
+        page = max(1, int(query.get("page", 1)))
+        start = (page - 1) * per_page
+        data = {key: items[start:start + per_page], "links": {},
+                "meta": {"total": len(items)}}
+
+        if start + per_page < len(items):
+            query = dict(query, page=page + 1, per_page=per_page)
+            data["links"]["pages"] = {"next": "http://%s:%d%s?%s" % (
+                self.server.server_address[:2] + (
+                    urlsplit(self.path).path, urlencode(query)))}
+        return data
+
+    def _dispatch(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        split = urlsplit(self.path)
+        query = dict(parse_qsl(split.query))
+        for method, pattern, template, name in ROUTES:
+            match = pattern.match(split.path)
+            if method == self.command and match:
+                self.server.count("requests")
+                self.server.count("%s %s" % (method, template))
+                body = self._body()
+                # Responses share nested objects with the account so they
+                # are encoded while the lock is held
+                with self.account.lock:
+                    try:
+                        status, data = getattr(self, name)(
+                            query, body, *match.groups())
+                    except APIError as error:
+                        status, data = error.status, {
+                            "id": "error", "message": str(error)}
+                    self._send(status, data)
+                return
+
+        self._body()
+        self.server.count("requests")
+        self.server.count("unrouted")
+        self._send(404, {"id": "not_found", "message": self.path})
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    # droplets
+    def list_droplets(self, query, body):
+        return 200, self._page(
+            "droplets", self.account.all_droplets(query.get("tag_name")),
+            query)
+
+    def create_droplets(self, query, body):
+        names = body.get("names") or [body["name"]]
+        droplets = [
+            public(self.account._droplet(
+                name, body["size"], body["region"], body["image"],
+                tags=body.get("tags") or ()))
+            for name in names]
+        if "names" in body:
+            return 202, {"droplets": droplets}
+        return 202, {"droplet": droplets[0]}
+
+    def get_droplet(self, query, body, droplet_id):
+        return 200, {"droplet": self.account.droplet(int(droplet_id))}
+
+    def delete_droplet(self, query, body, droplet_id):
+        if self.account.droplets.pop(int(droplet_id), None) is None:
+            raise APIError(404, "droplet not found")
+        return 204, None
+
+    def droplet_action(self, query, body, droplet_id):
+        droplet = self.account.droplets.get(int(droplet_id))
+        if droplet is None:
+            raise APIError(404, "droplet not found")
+        status = {"power_on": "active", "power_off": "off"}.get(
+            body.get("type"))
+        if status is not None:
+            droplet["status"] = status
+        action = {"id": self.account.new_id(), "status": "completed",
+                  "type": body.get("type"), "resource_id": droplet["id"],
+                  "resource_type": "droplet"}
+        self.account.actions[action["id"]] = action
+        return 201, {"action": action}
+
+    def list_actions(self, query, body):
+        actions = [self.account.actions[action_id]
+                   for action_id in sorted(self.account.actions, reverse=True)]
+        return 200, self._page("actions", actions, query)
+
+    def get_action(self, query, body, action_id):
+        action = self.account.actions.get(int(action_id))
+        if action is None:
+            raise APIError(404, "action not found")
+        return 200, {"action": action}
+
+    # keys
+    def list_keys(self, query, body):
+        keys = [self.account.keys[key_id]
+                for key_id in sorted(self.account.keys)]
+        return 200, self._page("ssh_keys", keys, query)
+
+    def create_key(self, query, body):
+        key = {"id": self.account.new_id(), "name": body["name"],
+               "public_key": body["public_key"],
+               "fingerprint": fingerprint(body["public_key"])}
+        self.account.keys[key["id"]] = key
+        return 201, {"ssh_key": key}
+
+    def delete_key(self, query, body, key_id):
+        if self.account.keys.pop(int(key_id), None) is None:
+            raise APIError(404, "key not found")
+        return 204, None
+
+    # domains
+    def _check_domain(self, domain):
+        if domain != self.account.domain:
+            raise APIError(404, "domain not found")
+
+    def list_records(self, query, body, domain):
+        self._check_domain(domain)
+        records = [self.account.records[record_id]
+                   for record_id in sorted(self.account.records)]
+        return 200, self._page("domain_records", records, query)
+
+    def create_record(self, query, body, domain):
+        self._check_domain(domain)
+        record = self.account._record(body["type"], body["name"], body["data"])
+        for key in ("priority", "port", "weight", "ttl"):
+            if body.get(key) is not None:
+                record[key] = body[key]
+        return 201, {"domain_record": record}
+
+    def update_record(self, query, body, domain, record_id):
+        self._check_domain(domain)
+        record = self.account.records.get(int(record_id))
+        if record is None:
+            raise APIError(404, "record not found")
+        record.update((key, value) for key, value in body.items()
+                      if key != "id")
+        return 200, {"domain_record": record}
+
+    def delete_record(self, query, body, domain, record_id):
+        self._check_domain(domain)
+        if self.account.records.pop(int(record_id), None) is None:
+            raise APIError(404, "record not found")
+        return 204, None
+
+    # catalog
+    def list_images(self, query, body):
+        images = self.account.images
+        if query.get("private") == "true":
+            images = [image for image in images if not image["public"]]
+        elif query.get("distribution") in ("true", "True"):
+            images = [image for image in images if image["public"]]
+        return 200, self._page("images", images, query)
+
+    def list_regions(self, query, body):
+        return 200, self._page("regions", self.account.regions, query)
+
+    def list_sizes(self, query, body):
+        return 200, self._page("sizes", self.account.sizes, query)
+
+
+def fingerprint(public_key):
+    blob = base64.b64decode(public_key.split()[1].encode("ascii"))
+    digest = hashlib.md5(blob).hexdigest()
+    return ":".join(digest[index:index + 2] for index in range(0, 32, 2))
+
+
+class FakeAPIServer(ThreadingHTTPServer):
+    """
+    Serves an :class:`Account` on a local port.
+
+    :param float latency:
+        Seconds added to every request.
+
+    :param int page_size:
+        The largest page returned by list endpoints, the client's
+        ``per_page`` is honored up to this size.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, page_size=None, account=None,
+                 address=("127.0.0.1", 0), **account_options):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        self.latency = latency
+        self.page_size = page_size
+        self.account = account or Account(**account_options)
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d/v2" % self.server_address[:2]
+
+    def count(self, key, value=1):
+        with self._stats_lock:
+            self.stats[key] += value
+
+    def reset_stats(self):
+        with self._stats_lock:
+            stats = self.stats
+            self.stats = Counter()
+        return stats
+
+    def handle_error(self, request, client_address):
+        # Clients streaming a listing hang up once they've found what
+        # they were looking for
+        if not isinstance(sys.exc_info()[1], (IOError, OSError)):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--page-size", type=int, default=None)
+    parser.add_argument("--fleet-size", type=int, default=0)
+    parser.add_argument("--boot-time", type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeAPIServer(
+        latency=args.latency, page_size=args.page_size,
+        address=("127.0.0.1", args.port), fleet_size=args.fleet_size,
+        boot_time=args.boot_time)
+    print("Serving %s" % server.url)
+    server.serve_forever()
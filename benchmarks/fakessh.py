@@ -0,0 +1,216 @@
+"""
+A local SSH server built on paramiko which stands in for a droplet.  Any
+key is accepted, commands are run with the local shell and SFTP is
+served from the local filesystem, so benchmarks can exercise
+vpsutil.ssh without a remote host.
+
+    server = FakeSSHServer(latency=0.02).start()
+    client = SSHClient("root", "127.0.0.1", key_pair, port=server.port)
+"""
+import os
+import socket
+import subprocess
+import threading
+import time
+from collections import Counter
+
+import paramiko
+from paramiko import (
+    SFTP_OK, SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface)
+
+
+def _sftp_errors(function):
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+    return wrapper
+
+
+class Handle(SFTPHandle):
+    @_sftp_errors
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    @_sftp_errors
+    def chattr(self, attr):
+        SFTPServer.set_file_attr(self.filename, attr)
+        return SFTP_OK
+
+
+class FileSystem(SFTPServerInterface):
+    """Serves the local filesystem over SFTP"""
+    @_sftp_errors
+    def list_folder(self, path):
+        entries = []
+        for filename in os.listdir(path):
+            entry = SFTPAttributes.from_stat(
+                os.stat(os.path.join(path, filename)))
+            entry.filename = filename
+            entries.append(entry)
+        return entries
+
+    @_sftp_errors
+    def stat(self, path):
+        return SFTPAttributes.from_stat(os.stat(path))
+
+    lstat = stat
+
+    @_sftp_errors
+    def open(self, path, flags, attr):
+        descriptor = os.open(path, flags, 0o644)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(descriptor, mode)
+        return handle
+
+    @_sftp_errors
+    def mkdir(self, path, attr):
+        os.mkdir(path)
+        return SFTP_OK
+
+    @_sftp_errors
+    def chattr(self, path, attr):
+        SFTPServer.set_file_attr(path, attr)
+        return SFTP_OK
+
+    @_sftp_errors
+    def remove(self, path):
+        os.remove(path)
+        return SFTP_OK
+
+
+class Server(paramiko.ServerInterface):
+    def __init__(self, ssh_server):
+        self.ssh_server = ssh_server
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_channel_exec_request(self, channel, command):
+        self.ssh_server.count("commands")
+        thread = threading.Thread(
+            target=self.ssh_server.execute, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class FakeSSHServer(object):
+    """
+    Accepts SSH connections on a local port.
+
+    :param float latency:
+        Seconds added before each command starts, roughly one round
+        trip to a remote host.
+    """
+    def __init__(self, latency=0.0, address=("127.0.0.1", 0)):
+        self.latency = latency
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(address)
+        self._socket.listen(128)
+        self._transports = []
+        self._running = False
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def reset_stats(self):
+        with self._lock:
+            stats = self.stats
+            self.stats = Counter()
+        return stats
+
+    def execute(self, channel, command):
+        if self.latency:
+            time.sleep(self.latency)
+
+        process = subprocess.Popen(
+            command.decode("utf-8"), shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def pump(stream, send):
+            for chunk in iter(lambda: stream.read1(32768), b""):
+                self.count("bytes_sent", len(chunk))
+                send(chunk)
+
+        def feed():
+            try:
+                for chunk in iter(lambda: channel.recv(32768), b""):
+                    self.count("bytes_received", len(chunk))
+                    process.stdin.write(chunk)
+                    process.stdin.flush()
+            except (IOError, OSError, EOFError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except (IOError, OSError):
+                    pass
+
+        stderr = threading.Thread(
+            target=pump, args=(process.stderr, channel.sendall_stderr))
+        stdin = threading.Thread(target=feed)
+        stdin.daemon = True
+        stderr.start()
+        stdin.start()
+        pump(process.stdout, channel.sendall)
+        stderr.join()
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+    def _serve(self):
+        while self._running:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                break
+
+            self.count("connections")
+            # Don't let the stand-in's own Nagle delays hide the client's
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, FileSystem)
+            self._transports.append(transport)
+            try:
+                transport.start_server(server=Server(self))
+            except (paramiko.SSHException, EOFError, OSError):
+                # Readiness probes connect and hang up without a handshake
+                pass
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
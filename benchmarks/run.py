@@ -0,0 +1,328 @@
+"""
+Runs vpsutil's main flows against local stand-ins for the DigitalOcean
+API and a droplet's sshd and reports the requests, bytes and wall time
+each one takes.
+
+    python benchmarks/run.py --latency 0.05 --fleet-size 200
+    python benchmarks/run.py --save baseline.json
+    python benchmarks/run.py --compare baseline.json
+
+With ``--compare`` the exit status is non-zero if any scenario makes
+more API requests or SSH commands than it did in the baseline.  It's
+also non-zero when ``ssh_run`` takes longer than ``--latency`` plus
+``--ssh-budget`` per command.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from os.path import abspath, dirname, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+SIZE = "s-1vcpu-1gb"
+DOMAIN = "example.com"
+
+SCENARIOS = OrderedDict()
+
+
+def scenario(function):
+    SCENARIOS[function.__name__] = function
+    return function
+
+
+class Context(object):
+    """What each scenario has to work with"""
+    def __init__(self, args, api, ssh, home):
+        self.args = args
+        self.api = api
+        self.ssh = ssh
+        self.home = home
+        self.failures = []
+        self._key_pair = None
+
+    def digitalocean(self):
+        from vpsutil.api import DigitalOcean
+        do = DigitalOcean()
+        if do.cache is not None:
+            do.cache.clear()
+        return do
+
+    @property
+    def key_pair(self):
+        if self._key_pair is None:
+            from vpsutil.ssh import SSHClient
+            self._key_pair = SSHClient.generate_key_pair(
+                output_dir=tempfile.mkdtemp(dir=self.home),
+                key_type="ed25519")
+        return self._key_pair
+
+    def ssh_client(self):
+        from vpsutil.ssh import SSHClient
+        return SSHClient(
+            "root", "127.0.0.1", self.key_pair, port=self.ssh.port)
+
+    def host(self, index):
+        return "host-%04d" % (index % self.args.fleet_size)
+
+
+@scenario
+def find_droplet(context):
+    """One lookup by name, scans the listing"""
+    do = context.digitalocean()
+    do.droplets.find_droplet(name=context.host(-1))
+
+
+@scenario
+def inventory_refresh(context):
+    """Load the inventory then refresh an unchanged fleet three times"""
+    inventory = context.digitalocean().droplets.inventory()
+    for _ in range(3):
+        inventory.refresh()
+
+
+@scenario
+def update_record(context):
+    """Point one existing A record somewhere else"""
+    do = context.digitalocean()
+    do.dns.update_record(DOMAIN, "A", context.host(1), "192.0.2.1")
+
+
+@scenario
+def sync_zone(context):
+    """Reconcile 50 A records, half of which change"""
+    do = context.digitalocean()
+    records = [
+        {"type": "A", "name": context.host(index),
+         "data": "192.0.2.%d" % (index % 250) if index % 2 else None}
+        for index in range(50)]
+    zone = do.dns.zone(DOMAIN)
+    for record in records:
+        if record["data"] is None:
+            record["data"] = zone.get("A", record["name"])[0]["data"]
+    do.dns.sync_zone(DOMAIN, records, zone=zone)
+
+
+@scenario
+def create_droplet(context):
+    """Create one droplet with a new ssh key and wait for it"""
+    do = context.digitalocean()
+    do.droplets.create_droplet(
+        "bench-single", SIZE, ssh_keys=context.key_pair.public)
+
+
+@scenario
+def create_droplets(context):
+    """Create 20 droplets in one group and wait for all of them"""
+    do = context.digitalocean()
+    do.droplets.create_droplets(
+        ["bench-%02d" % index for index in range(20)], SIZE,
+        ssh_keys=context.key_pair.public)
+
+
+@scenario
+def destroy(context):
+    """Plan and apply the destruction of the bench-* hosts"""
+    from vpsutil.destroy import DestroyPlan
+    do = context.digitalocean()
+    DestroyPlan.build(do, ["bench-*"], domain=DOMAIN).apply()
+
+
+@scenario
+def ssh_run(context):
+    """Connect and run 20 short commands"""
+    with context.ssh_client() as ssh:
+        start = time.time()
+        for index in range(20):
+            ssh.run("echo %d" % index, echo=False)
+        per_command = (time.time() - start) / 20
+
+    # Each command should cost the server's latency plus a little
+    # overhead, anything more means the client is waiting on a timer.
+    budget = context.args.latency + context.args.ssh_budget
+    if per_command > budget:
+        context.failures.append(
+            "ssh_run took %0.1fms per command, budget %0.1fms" % (
+                per_command * 1000, budget * 1000))
+    return {"per_command": round(per_command, 4)}
+
+
+@scenario
+def ssh_put_tree(context):
+    """Sync a 100 file tree twice, the second sync has nothing to send"""
+    source = tempfile.mkdtemp(dir=context.home)
+    destination = tempfile.mkdtemp(dir=context.home)
+    for index in range(100):
+        directory = join(source, "d%d" % (index % 10))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(join(directory, "f%d" % index), "wb") as stream:
+            stream.write(os.urandom(4096 + index * 64))
+
+    with context.ssh_client() as ssh:
+        ssh.put_tree(source, destination)
+        ssh.put_tree(source, destination)
+
+
+def setup_home(home):
+    """
+    Points vpsutil at a throwaway config, this has to happen before
+    vpsutil.config is imported.
+    """
+    os.environ["HOME"] = home
+    os.makedirs(join(home, ".vpsutil"))
+    with open(join(home, ".vpsutil", "config"), "w") as stream:
+        stream.write(
+            "[digital_ocean]\n"
+            "token = benchmark\n"
+            "default_image = ubuntu-24-04-x64\n"
+            "region_slug_prefixes = nyc, sfo\n"
+            "domain = %s\n" % DOMAIN)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "scenarios", nargs="*", metavar="scenario",
+        help="The scenarios to run (default: all of %s)" % ", ".join(
+            SCENARIOS))
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="Seconds added to every API request and SSH command")
+    parser.add_argument(
+        "--page-size", type=int, default=None,
+        help="The largest page the fake API returns")
+    parser.add_argument(
+        "--fleet-size", type=int, default=100,
+        help="The number of droplets the fake account starts with")
+    parser.add_argument(
+        "--boot-time", type=float, default=0.0,
+        help="Seconds before new droplets become active")
+    parser.add_argument(
+        "--ssh-budget", type=float, default=0.02,
+        help="Seconds each ssh_run command may take on top of --latency")
+    parser.add_argument(
+        "--json", action="store_true", help="Print the results as json")
+    parser.add_argument("--save", help="Write the results to this file")
+    parser.add_argument(
+        "--compare",
+        help="Fail if any scenario makes more calls than in this file")
+    parser.add_argument(
+        "--prometheus", action="store_true",
+        help="Also print vpsutil's own request metrics")
+    parser.add_argument(
+        "--models", action="store_true",
+        help="Use the compact models from vpsutil.models")
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="Decode list responses incrementally")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Show vpsutil's logging")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("Unknown scenarios: %s" % ", ".join(sorted(unknown)))
+
+    if len(set(args.scenarios)) != len(args.scenarios):
+        parser.error("Each scenario can only be run once")
+
+    home = tempfile.mkdtemp(prefix="vpsutil-benchmark-")
+    setup_home(home)
+    sys.path.insert(0, ROOT)
+
+    import logging
+    from vpsutil.api import Base
+    from vpsutil.logger import logger
+    from vpsutil.metrics import Metrics
+    from fakeapi import FakeAPIServer
+    from fakessh import FakeSSHServer
+
+    if not args.verbose:
+        logger.setLevel(logging.ERROR)
+        logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+        logging.getLogger("urllib3").setLevel(logging.ERROR)
+
+    api = FakeAPIServer(
+        latency=args.latency, page_size=args.page_size,
+        fleet_size=args.fleet_size, boot_time=args.boot_time,
+        domain=DOMAIN).start()
+    ssh = FakeSSHServer(latency=args.latency).start()
+    Base.URL = api.url
+    metrics = Base.instrumentation = Metrics()
+    Base.models = args.models
+    Base.stream_lists = args.stream
+    context = Context(args, api, ssh, home)
+
+    results = OrderedDict()
+    try:
+        for name in args.scenarios or SCENARIOS:
+            api.reset_stats()
+            ssh.reset_stats()
+            start = time.time()
+            extra = SCENARIOS[name](context)
+            elapsed = time.time() - start
+            api_stats, ssh_stats = api.reset_stats(), ssh.reset_stats()
+            results[name] = OrderedDict((
+                ("requests", api_stats["requests"]),
+                ("sent", api_stats["bytes_received"]),
+                ("received", api_stats["bytes_sent"]),
+                ("ssh_commands", ssh_stats["commands"]),
+                ("ssh_bytes", ssh_stats["bytes_sent"] +
+                 ssh_stats["bytes_received"]),
+                ("seconds", round(elapsed, 4)),
+                ("endpoints", dict(
+                    (key, value) for key, value in api_stats.items()
+                    if " " in key))))
+            results[name].update(extra or {})
+    finally:
+        api.stop()
+        ssh.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%-18s %8s %10s %10s %8s %8s" % (
+            "scenario", "requests", "sent", "received", "ssh cmds",
+            "seconds"))
+        for name, result in results.items():
+            print("%-18s %8d %10d %10d %8d %8.3f" % (
+                name, result["requests"], result["sent"], result["received"],
+                result["ssh_commands"], result["seconds"]))
+
+    if args.prometheus:
+        print(metrics.prometheus())
+
+    if args.save:
+        with open(args.save, "w") as stream:
+            json.dump(results, stream, indent=2)
+
+    failed = False
+    for failure in context.failures:
+        print("SLOW: %s" % failure)
+        failed = True
+
+    if args.compare:
+        with open(args.compare, "r") as stream:
+            baseline = json.load(stream)
+
+        for name, result in results.items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+            for key in ("requests", "ssh_commands"):
+                if result[key] > before[key]:
+                    print("REGRESSION: %s made %d %s, baseline %d" % (
+                        name, result[key], key, before[key]))
+                    failed = True
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
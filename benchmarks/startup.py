@@ -0,0 +1,114 @@
+"""
+Measures how long the ``ocean`` command takes to start and exits with a
+non-zero status if it's over budget, or if importing vpsutil.command
+pulls in any of the modules which should be imported lazily.  The same
+checks run as part of the test suite, see tests/test_startup.py.
+
+    python benchmarks/startup.py --budget 100 --overhead 50 --runs 20
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+# The most time, in milliseconds, vpsutil may add to the interpreter's
+# own startup.  Unlike the total this hardly depends on the machine so
+# it's what the tests enforce.
+OVERHEAD_BUDGET = 50
+
+# Modules ``ocean show --help`` should not need to import
+LAZY_MODULES = (
+    "requests", "paramiko", "cryptography", "aiohttp", "vpsutil.api",
+    "vpsutil.ssh")
+
+STARTUP = """
+from vpsutil.command import ocean
+try:
+    ocean(["show", "--help"])
+except SystemExit:
+    pass
+"""
+
+MODULES = """
+import json, sys
+import vpsutil.command
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def python(code):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [ROOT, env.get("PYTHONPATH")]))
+    start = time.time()
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], env=env, cwd=ROOT,
+        stderr=subprocess.STDOUT)
+    return time.time() - start, output
+
+
+def measure(code, runs):
+    timings = sorted(python(code)[0] for _ in range(runs))
+    return timings[len(timings) // 2]
+
+
+def eager_imports():
+    """Returns the ``LAZY_MODULES`` importing vpsutil.command imports"""
+    _, output = python(MODULES)
+    imported = set(json.loads(output.decode("utf-8").splitlines()[-1]))
+    return [module for module in LAZY_MODULES if module in imported]
+
+
+def startup_times(runs):
+    """
+    Returns the median startup time of the interpreter alone and of
+    ``ocean show --help`` in milliseconds.
+    """
+    return measure("pass", runs) * 1000, measure(STARTUP, runs) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "--budget", type=float, default=100,
+        help="The maximum median startup time in milliseconds, including "
+             "the interpreter's own startup")
+    parser.add_argument(
+        "--overhead", type=float, default=OVERHEAD_BUDGET,
+        help="The maximum median time in milliseconds vpsutil may add to "
+             "the interpreter's startup")
+    parser.add_argument(
+        "--runs", type=int, default=20,
+        help="The number of times to start the command")
+    args = parser.parse_args()
+
+    eager = eager_imports()
+    interpreter, startup = startup_times(args.runs)
+
+    print("interpreter startup:   %7.1fms" % interpreter)
+    print("ocean show --help:     %7.1fms (budget %0.1fms)" % (
+        startup, args.budget))
+    print("vpsutil overhead:      %7.1fms (budget %0.1fms)" % (
+        startup - interpreter, args.overhead))
+
+    failed = False
+    if eager:
+        print("FAIL: imported at startup: %s" % ", ".join(eager))
+        failed = True
+    if startup > args.budget:
+        print("FAIL: over the startup budget")
+        failed = True
+    if startup - interpreter > args.overhead:
+        print("FAIL: over the overhead budget")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
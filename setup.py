@@ -1,6 +1,6 @@
-from distutils.core import setup
+from setuptools import setup
 
-requires = ["requests", "paramiko"]
+requires = ["requests", "paramiko", "cryptography"]
 
 try:
     import configparser
@@ -13,6 +13,9 @@ setup(
     license="MIT",
     packages=["vpsutil"],
     install_requires=requires,
+    extras_require={
+        "async": ["aiohttp"]
+    },
     entry_points={
         "console_scripts": [
             "ocean = vpsutil.command:ocean"
@@ -0,0 +1,27 @@
+"""
+Keeps ``ocean`` quick to start, see benchmarks/startup.py for the
+standalone version of these checks.
+"""
+import sys
+import unittest
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "benchmarks"))
+
+import startup  # noqa: E402
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        self.assertEqual(startup.eager_imports(), [])
+
+    def test_overhead_budget(self):
+        interpreter, ocean = startup.startup_times(runs=5)
+        self.assertLessEqual(
+            ocean - interpreter, startup.OVERHEAD_BUDGET,
+            "ocean show --help took %0.1fms, %0.1fms more than the "
+            "interpreter alone" % (ocean, ocean - interpreter))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,609 @@
+"""
+An asyncio counterpart to :mod:`vpsutil.api`.  The classes here mirror
+:class:`vpsutil.api.Droplets`, :class:`vpsutil.api.Domains`,
+:class:`vpsutil.api.Search` and :class:`vpsutil.api.SSH` and share the same
+search and filtering functions but make their requests with ``aiohttp``
+so many operations can run concurrently from one event loop.
+
+>>> async def main():
+...     async with AsyncDigitalOcean() as do:
+...         await asyncio.gather(*[
+...             do.dns.update_record("example.com", "A", name, address)
+...             for name, address in records])
+
+This module requires Python 3.6+ and the optional ``aiohttp`` dependency.
+"""
+
+import asyncio
+import json
+from os.path import expanduser, isfile
+from pprint import pformat
+
+try:
+    from http.client import (
+        NO_CONTENT, UNPROCESSABLE_ENTITY, TOO_MANY_REQUESTS)
+except ImportError:
+    from httplib import NO_CONTENT, UNPROCESSABLE_ENTITY
+    TOO_MANY_REQUESTS = 429
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = NotImplemented
+
+from vpsutil.api import (
+    Base, PowerState, match_fields, match_droplet, public_ips,
+    select_record, record_data, select_distribution, filter_regions,
+    choose_region, get_fingerprint)
+from vpsutil.config import Providers, config
+from vpsutil.logger import logger
+from vpsutil.waiter import Backoff, droplet_active
+
+
+class AsyncBase(object):
+    PER_PAGE = Base.PER_PAGE
+    RATE_LIMIT_RETRIES = Base.RATE_LIMIT_RETRIES
+
+    def __init__(self, client):
+        self.client = client
+
+    @property
+    def URL(self):
+        return self.client.url
+
+    @property
+    def rate_limiter(self):
+        # Looked up on each use so the async client always shares the
+        # process wide limiter with the blocking sessions.
+        return Base.rate_limiter
+
+    async def _send(self, method, url, params=None, data=None):
+        """
+        The asyncio counterpart to :meth:`vpsutil.api.Base._send`.
+        Performs the request once the rate limiter allows it, retrying
+        when the API responds with 429, and returns the response and its
+        body.
+        """
+        priority = method.upper() != "GET"
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
+            await _acquire(self.rate_limiter, priority)
+            async with self.client.session.request(
+                    method, url, params=params, json=data) as response:
+                self.rate_limiter.record(response.status, response.headers)
+                if (response.status == TOO_MANY_REQUESTS
+                        and attempt < self.RATE_LIMIT_RETRIES):
+                    logger.debug("... rate limited, retry %d", attempt + 1)
+                    continue
+                return response, await response.read()
+
+    async def request(self, method, url, params=None, data=None):
+        """
+        Performs a request and returns the decoded json body, None is
+        returned for responses without a body.
+        """
+        response, body = await self._send(
+            method, url, params=params, data=data)
+        if response.status >= 400:
+            logger.error(
+                "Error in request: %s",
+                pformat(body.decode("utf-8", "replace")))
+        response.raise_for_status()
+        if response.status == NO_CONTENT or not body:
+            return None
+        return json.loads(body.decode("utf-8"))
+
+    async def paginate(self, url, key, params=None):
+        """
+        Asynchronous generator which behaves like
+        :meth:`vpsutil.api.Base.paginate`.
+        """
+        params = dict(params or {})
+        params.setdefault("per_page", self.PER_PAGE)
+
+        while url is not None:
+            data = await self.request("GET", url, params=params)
+            for item in data.get(key, []):
+                yield item
+
+            url = data.get("links", {}).get("pages", {}).get("next")
+            params = None
+
+
+async def _acquire(rate_limiter, priority=False):
+    """
+    The asyncio counterpart to :meth:`vpsutil.ratelimit.RateLimiter.acquire`,
+    waits on the event loop instead of blocking it.
+    """
+    while True:
+        delay = rate_limiter.try_acquire(priority=priority)
+        if delay is None:
+            return
+        await asyncio.sleep(delay)
+
+
+async def _sleep(backoff):
+    """
+    The asyncio counterpart to :meth:`vpsutil.waiter.Backoff.sleep`,
+    raises :class:`TimeoutError` once the deadline has passed.
+    """
+    if backoff.expired:
+        raise TimeoutError("Deadline exceeded")
+    await asyncio.sleep(backoff.delay())
+
+
+async def _collect(generator, limit=None):
+    """Collects up to ``limit`` items from an asynchronous generator"""
+    items = []
+    async for item in generator:
+        items.append(item)
+        if limit is not None and len(items) >= limit:
+            break
+    return items
+
+
+class AsyncDomains(AsyncBase):
+    async def get_record(self, domain, record_type, name):
+        assert isinstance(domain, str)
+        assert isinstance(record_type, str) and record_type.isupper()
+        assert isinstance(name, str)
+        query = {"domain": domain, "type": record_type, "name": name}
+        logger.info("Searching for domain record %r", query)
+
+        records = await _collect(self.paginate(
+            self.URL + "/domains/%s/records" % domain, "domain_records"))
+        return select_record(records, record_type, name, query)
+
+    async def update_record(
+            self, domain, record_type, name, target,
+            priority=None, port=None, weight=None, must_exist=False):
+        """See :meth:`vpsutil.api.Domains.update_record`"""
+        assert isinstance(domain, str)
+        assert isinstance(record_type, str) and record_type.isupper()
+        assert isinstance(name, str)
+        assert isinstance(target, str)
+        query = {
+            "domain": domain, "type": record_type,
+            "name": name, "target": target}
+        current_record = await self.get_record(domain, record_type, name)
+        data = record_data(
+            record_type, name, target,
+            priority=priority, port=port, weight=weight)
+
+        if current_record is None and must_exist:
+            raise ValueError(
+                "Domain record for %r does not exist." % query)
+
+        elif current_record is None and not must_exist:
+            logger.info("Creating domain record %r", query)
+            response = await self.request(
+                "POST", self.URL + "/domains/%s/records" % domain, data=data)
+
+        else:
+            logger.info("Updating domain record %r", query)
+            response = await self.request(
+                "PUT", self.URL + "/domains/%s/records/%d" % (
+                    domain, current_record["id"]),
+                data=data)
+
+        return response["domain_record"]
+
+    async def delete_record(self, domain, record_type, name):
+        assert record_type.isupper()
+        query = {"domain": domain, "type": record_type, "name": name}
+
+        record = await self.get_record(domain, record_type, name)
+        if record is None:
+            return
+
+        logger.warning("Delete domain record %r", query)
+        await self.request(
+            "DELETE",
+            self.URL + "/domains/%s/records/%d" % (domain, record["id"]))
+
+
+class AsyncSearch(AsyncBase):
+    async def distributions(self, slug=None, regions=None):
+        if slug is None:
+            slug = config.get(Providers.DIGITAL_OCEAN, "default_image")
+
+        if regions is None:
+            regions = []
+
+        logger.info(
+            "Searching for distribution %s (regions: %s)", slug, regions)
+        dists = await _collect(self.paginate(
+            self.URL + "/images", "images", params={"distribution": "true"}))
+        return select_distribution(dists, slug, regions)
+
+    async def regions(self, size, slug_prefixes=None, features=None):
+        """See :meth:`vpsutil.api.Search.regions`"""
+        if slug_prefixes is None:
+            slug_prefixes = list(
+                map(str.strip,
+                    config.get(Providers.DIGITAL_OCEAN,
+                               "region_slug_prefixes").split(",")))
+
+        assert isinstance(size, str)
+        assert features is None or isinstance(features, (list, tuple))
+        logger.info(
+            "Searching for region(s) matching %r",
+            {"size": size,
+             "slug_prefixes": slug_prefixes or "any",
+             "features": features or "any"})
+
+        if features is None:
+            features = []
+
+        regions = await _collect(self.paginate(self.URL + "/regions", "regions"))
+        regions = list(filter_regions(regions, size, slug_prefixes, features))
+        logger.debug("... regions: %r", [region["slug"] for region in regions])
+        return regions
+
+    async def find_images(self, **fields):
+        """Finds private images matching all ``fields``"""
+        logger.info("Searching for images matching %r", fields)
+        async for image in self.paginate(
+                self.URL + "/images", "images", params={"private": "true"}):
+            if match_fields(image, fields):
+                yield image
+
+    async def find_image(self, **fields):
+        """Finds a single private image matching ``fields``"""
+        images = await _collect(self.find_images(**fields), limit=2)
+        if not images:
+            return
+        if len(images) > 1:
+            raise ValueError("Found multiple images matching %r" % fields)
+        return images[0]
+
+
+class AsyncSSH(AsyncBase):
+    def __init__(self, client):
+        super(AsyncSSH, self).__init__(client)
+        self._keys = None
+        self._keys_lock = None
+        self._uploads = {}
+
+    async def public_keys(self):
+        logger.info("Retrieving public SSH keys")
+        async for key in self.paginate(self.URL + "/account/keys", "ssh_keys"):
+            yield key
+
+    async def key_index(self, refresh=False):
+        """See :meth:`vpsutil.api.SSH.key_index`"""
+        # Created here rather than in __init__ so it belongs to the
+        # running loop, concurrent callers then share one listing.
+        if self._keys_lock is None:
+            self._keys_lock = asyncio.Lock()
+
+        async with self._keys_lock:
+            if self._keys is None or refresh:
+                keys = {"name": {}, "fingerprint": {}, "id": {}}
+                async for key in self.public_keys():
+                    for field in keys:
+                        keys[field][key[field]] = key
+                self._keys = keys
+        return self._keys
+
+    def _index_key(self, key, remove=False):
+        if self._keys is None:
+            return
+        for field, keys in self._keys.items():
+            if remove:
+                keys.pop(key[field], None)
+            else:
+                keys[key[field]] = key
+
+    async def upload_key(self, name=None, path=None):
+        """See :meth:`vpsutil.api.SSH.upload_key`"""
+        if path is None:
+            path = expanduser(config.get(Providers.DIGITAL_OCEAN, "public_key"))
+
+        with open(path, "r") as ssh_key:
+            public_key_data = ssh_key.read()
+
+        if "PRIVATE" in public_key_data:
+            raise ValueError(
+                "%s appears to be a private key, we "
+                "expected a public key" % path)
+
+        fingerprint, comment = get_fingerprint(path)
+        if name is None:
+            name = comment
+
+        if name is None or not name.strip():
+            raise ValueError(
+                "No name was supplied or one could not be determined.")
+
+        public_key = await self.get_key(fingerprint=fingerprint)
+        if public_key:
+            logger.debug("Key %s already exists, skipping.", fingerprint)
+            return public_key
+
+        # Concurrent callers uploading the same key share one request,
+        # the API rejects a second upload of the same fingerprint.
+        upload = self._uploads.get(fingerprint)
+        if upload is None:
+            upload = asyncio.ensure_future(
+                self._upload_key(fingerprint, name, path, public_key_data))
+            self._uploads[fingerprint] = upload
+        return await asyncio.shield(upload)
+
+    async def _upload_key(self, fingerprint, name, path, public_key_data):
+        logger.info("Uploading public key %s", path)
+        try:
+            data = await self.request(
+                "POST", self.URL + "/account/keys",
+                data={"name": name, "public_key": public_key_data})
+            self._index_key(data["ssh_key"])
+            return data["ssh_key"]
+        finally:
+            self._uploads.pop(fingerprint, None)
+
+    async def get_key(self, name=None, fingerprint=None):
+        """
+        Retrieves the public key matching the given name or fingerprint.
+        """
+        assert not all([name, fingerprint]), "Name or fingerprint only please"
+        assert any([name, fingerprint]), "You must provide name or fingerprint"
+        key_id = name or fingerprint
+        logger.info("Trying to retrieve public key %s", key_id)
+        keys = await self.key_index()
+        key = keys["name"].get(key_id) or keys["fingerprint"].get(key_id)
+        if key is not None:
+            return key
+        logger.info(
+            "No public key for search {'name': %r, 'fingerprint': %r}",
+            name, fingerprint)
+
+    async def delete_key(self, name=None, fingerprint=None):
+        key = await self.get_key(name=name, fingerprint=fingerprint)
+        if not key:
+            return
+
+        logger.warning("Deleting key %s", key["name"])
+        await self.request(
+            "DELETE", self.URL + "/account/keys/%d" % key["id"])
+        self._index_key(key, remove=True)
+
+
+class AsyncDroplets(AsyncBase):
+    def __init__(self, client, search, ssh):
+        super(AsyncDroplets, self).__init__(client)
+        assert isinstance(search, AsyncSearch)
+        assert isinstance(ssh, AsyncSSH)
+        self.search = search
+        self.ssh = ssh
+
+    async def _resolve_key(self, hostname, key):
+        if isinstance(key, int):
+            return key
+
+        elif isinstance(key, str) and isfile(key):
+            fingerprint, comment = get_fingerprint(key)
+            remote_key = await self.ssh.get_key(fingerprint=fingerprint)
+            if remote_key is not None:
+                return fingerprint
+            upload_key = await self.ssh.upload_key(name=hostname, path=key)
+            return upload_key["id"]
+
+        elif isinstance(key, str):
+            get_key = await self.ssh.get_key(name=key)
+            if get_key is None:
+                get_key = await self.ssh.get_key(fingerprint=key)
+
+            if get_key is None:
+                raise RuntimeError("Failed to find uploaded key %r" % key)
+
+            return get_key["id"]
+
+        elif isinstance(key, dict):
+            return key["id"]
+
+        raise TypeError("Don't know how to handle %r here" % key)
+
+    async def create_droplet(
+            self, hostname, size, distribution=None, bootstrap=None,
+            ssh_keys=None, poll_interval=10, timeout=None):
+        """
+        See :meth:`vpsutil.api.Droplets.create_droplet`.  The droplet is
+        polled with a backoff of up to ``poll_interval`` seconds until
+        it's active or ``timeout`` seconds have passed.
+        """
+        features = []
+        if bootstrap:
+            features.append("metadata")
+
+        regions = await self.search.regions(size, features=features)
+        region_slugs = [region["slug"] for region in regions]
+
+        if not isinstance(distribution, dict):
+            distribution = await self.search.distributions(
+                slug=distribution, regions=region_slugs)
+
+        region_slug = choose_region(distribution, regions)
+
+        data = {
+            "name": hostname,
+            "region": region_slug,
+            "size": size,
+            "image": distribution["id"],
+        }
+
+        if isinstance(ssh_keys, (str, int, dict)):
+            ssh_keys = [ssh_keys]
+        elif ssh_keys is None:
+            ssh_keys = []
+
+        # Every key is resolved from the same listing of the account's keys
+        if ssh_keys:
+            await self.ssh.key_index()
+        droplet_keys = await asyncio.gather(*[
+            self._resolve_key(hostname, key) for key in ssh_keys])
+
+        if droplet_keys:
+            data.update(ssh_keys=list(droplet_keys))
+
+        if bootstrap and isfile(bootstrap):
+            with open(bootstrap, "r") as stream:
+                bootstrap = stream.read()
+
+        if bootstrap:
+            data.update(user_data=bootstrap)
+
+        logger.info(
+            "Creating %s @ %s in %s (data: %s)",
+            hostname, size, region_slug, pformat(data))
+
+        response = await self.request(
+            "POST", self.URL + "/droplets", data=data)
+        droplet_id = response["droplet"]["id"]
+
+        logger.info("Waiting for droplet to become active")
+        return await self.wait_for_droplet(
+            droplet_id, timeout=timeout, maximum=poll_interval)
+
+    async def wait_for_droplet(self, droplet_id, condition=droplet_active,
+                               timeout=None, maximum=10):
+        """
+        Polls the droplet with an increasing delay of up to ``maximum``
+        seconds and returns it once ``condition(droplet)`` is true.
+        Raises :class:`TimeoutError` after ``timeout`` seconds, errors
+        from individual polls are logged and retried.
+        """
+        backoff = Backoff(initial=min(2, maximum), maximum=maximum,
+                          timeout=timeout)
+        while True:
+            try:
+                droplet = await self.get_droplet(droplet_id)
+            except aiohttp.ClientError as error:
+                logger.debug("... failed to poll droplet %d: %s",
+                             droplet_id, error)
+            else:
+                if condition(droplet):
+                    return droplet
+
+            await _sleep(backoff)
+
+    async def set_power_state(self, droplet_id, state):
+        logger.info("Set power state of droplet %d to %s", droplet_id, state)
+        if state is PowerState.ON:
+            response = await self.request(
+                "POST", self.URL + "/droplets/%d/actions" % droplet_id,
+                data={"type": "power_on"})
+            return response["action"]
+
+        raise NotImplementedError(state)
+
+    async def delete_droplet(self, timeout=300, **fields):
+        droplet = await self.find_droplet(**fields)
+        if not droplet:
+            return
+
+        logger.warning("Destroy droplet %d", droplet["id"])
+        url = self.URL + "/droplets/%d" % droplet["id"]
+
+        # The API responds with 422 while the droplet is still busy
+        # with another event (such as being created).
+        backoff = Backoff(initial=2, maximum=10, timeout=timeout)
+        while True:
+            response, _ = await self._send("DELETE", url)
+            if response.status == UNPROCESSABLE_ENTITY:
+                logger.debug("... retry")
+                await _sleep(backoff)
+                continue
+
+            response.raise_for_status()
+            break
+
+    async def get_droplet(self, droplet_id):
+        assert isinstance(droplet_id, int)
+        logger.info("Get droplet %d", droplet_id)
+        response = await self.request(
+            "GET", self.URL + "/droplets/%d" % droplet_id)
+        return response["droplet"]
+
+    async def get_droplet_ip(self, droplet, ip_version="v4", timeout=None):
+        if isinstance(droplet, int):
+            # We might not have a network yet
+            droplet = await self.wait_for_droplet(
+                droplet, timeout=timeout, maximum=3,
+                condition=lambda result: result["networks"][ip_version])
+
+        logger.info("Get IP of droplet %s", droplet["id"])
+        addresses = public_ips(droplet, ip_version)
+        assert len(addresses) == 1
+        return addresses[0]
+
+    async def find_droplets(self, **fields):
+        logger.info("Searching for droplets matching %r", fields)
+        async for droplet in self.paginate(
+                self.URL + "/droplets", "droplets"):
+            if match_droplet(droplet, fields):
+                yield droplet
+
+    async def find_droplet(self, **fields):
+        droplets = await _collect(self.find_droplets(**fields), limit=2)
+        if not droplets:
+            return
+        if len(droplets) > 1:
+            raise ValueError("Found multiple droplets matching %s" % fields)
+        return droplets[0]
+
+
+class AsyncDigitalOcean(object):
+    """
+    High level wrapper around the asyncio sub APIs.  The underlying
+    ``aiohttp`` session is created on first use and should be closed
+    with :meth:`close` or by using this object as an async context
+    manager.
+
+    :param string token:
+        The API token, defaults to ``token`` in the config.
+
+    :param string url:
+        The root of the API.  Mostly useful for pointing the client at
+        a local stand-in server.
+
+    :param int limit:
+        The maximum number of simultaneous connections.
+    """
+    def __init__(self, token=None, url=None, limit=100):
+        if aiohttp is NotImplemented:
+            raise ImportError("AsyncDigitalOcean requires aiohttp")
+
+        if token is None:
+            token = config.get(Providers.DIGITAL_OCEAN, "token")
+
+        self.url = url or Base.URL
+        self.token = token
+        self.limit = limit
+        self._session = None
+        self.ssh = AsyncSSH(self)
+        self.search = AsyncSearch(self)
+        self.droplets = AsyncDroplets(self, self.search, self.ssh)
+        self.dns = AsyncDomains(self)
+
+    @property
+    def session(self):
+        if self._session is not None:
+            return self._session
+
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit),
+            headers={
+                "Accept": "application/json",
+                "Authorization": "Bearer %s" % self.token
+            })
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
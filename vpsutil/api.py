@@ -1,34 +1,366 @@
+import base64
+import hashlib
+import os
 import random
-import subprocess
+import threading
 import time
 import json
-from collections import namedtuple
-from configparser import NoOptionError
-from os.path import expanduser, isfile
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from configparser import NoOptionError, NoSectionError
+from os.path import abspath, expanduser, isfile
 from pprint import pformat
 
 try:
-    from http.client import NOT_FOUND, UNPROCESSABLE_ENTITY
+    from http.client import (
+        OK, NOT_FOUND, NOT_MODIFIED, UNPROCESSABLE_ENTITY, TOO_MANY_REQUESTS)
 except ImportError:
-    from httplib import NOT_FOUND, UNPROCESSABLE_ENTITY
+    from httplib import OK, NOT_FOUND, NOT_MODIFIED, UNPROCESSABLE_ENTITY
+    TOO_MANY_REQUESTS = 429
 
-from requests import Session as _Session
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from requests import Request, Session as _Session
 from requests.adapters import HTTPAdapter
 
+from vpsutil.cache import HTTPCache
 from vpsutil.config import Providers, config
+from vpsutil.inventory import Inventory
+from vpsutil.jsonstream import iter_items
 from vpsutil.logger import logger
+from vpsutil.models import MODELS
+from vpsutil.placement import (
+    ANTI_AFFINITY, SPREAD, USAGE_POLICIES, Placement, RegionTable)
+from vpsutil.ratelimit import RateLimiter
+from vpsutil.waiter import Backoff, Waiter
+from vpsutil.zone import Zone
 
 
 _PowerState = namedtuple("PowerStates", ("ON", "OFF", "RESET"))
 PowerState = _PowerState(ON="on", OFF="off", RESET="reset")
 
 
+# The functions below contain the search and filtering logic which is
+# independent of how a request is made.  They're shared by the blocking
+# API classes in this module and the asyncio API in vpsutil.aio.
+
+def match_fields(item, fields):
+    """Returns True if ``item`` contains all key/value pairs in ``fields``"""
+    for key, value in fields.items():
+        if key not in item:
+            raise KeyError("No such key %s" % key)
+
+        if item[key] != value:
+            return False
+    return True
+
+
+def match_droplet(droplet, fields, ip_version="v4"):
+    """
+    Like :func:`match_fields` but also supports searching by ``ip``
+    which is matched against the droplet's public address and ``tag``
+    which must be one of the droplet's tags.
+    """
+    fields = dict(fields)
+    ip_address = fields.pop("ip", None)
+    tag = fields.pop("tag", None)
+    if not match_fields(droplet, fields):
+        return False
+    if tag is not None and tag not in droplet.get("tags", []):
+        return False
+    return ip_address is None or ip_address in public_ips(droplet, ip_version)
+
+
+def public_ips(droplet, ip_version="v4"):
+    """Returns a list of public addresses for ``droplet``"""
+    return [
+        address["ip_address"] for address in droplet["networks"][ip_version]
+        if address["type"] == "public"]
+
+
+def select_record(records, record_type, name, query):
+    """
+    Returns the single record from ``records`` matching ``record_type``
+    and ``name``, None if no record matched.
+    """
+    matches = []
+    for record in records:
+        if record["type"] != record_type or record["name"] != name:
+            continue
+        matches.append(record)
+
+    if len(matches) > 1:
+        raise ValueError(
+            "Found more than one domain record matching %r" % query)
+    elif not matches:
+        return None
+    else:
+        return matches[0]
+
+
+def record_data(record_type, name, target, priority=None, port=None,
+                weight=None):
+    """Constructs the request body used to create or update a record"""
+    data = {
+        "type": record_type,
+        "name": name,
+        "data": target,
+    }
+
+    if record_type in ("MX", "SRV"):
+        data.update(priority=priority)
+
+    if record_type == "SRV":
+        data.update(
+            port=port, weight=weight
+        )
+
+    return data
+
+
+def select_distribution(dists, slug, regions):
+    """
+    Returns the public distribution from ``dists`` matching ``slug``
+    which is available in at least one of ``regions``.
+    """
+    for dist in dists:
+        if not dist["public"]:
+            logger.debug("... %s not public", dist["slug"])
+            continue
+
+        # At least one of the region slugs which came from
+        # regions() must be present in the distribution
+        for region_slug in regions:
+            if region_slug in dist["regions"]:
+                break
+            else:
+                logger.debug(
+                    "... %s region not in %s", region_slug, dist["slug"])
+        else:
+            continue
+
+        if dist["slug"] == slug:
+            return dist
+    else:
+        raise ValueError("Failed to locate distribution")
+
+
+def filter_regions(regions, size, slug_prefixes, features):
+    """
+    Generator which yields the available regions supporting ``size``
+    and all ``features`` whose slug starts with one of ``slug_prefixes``.
+    """
+    for region in regions:
+        if not region["available"]:
+            logger.debug("... %s - not available", region["slug"])
+            continue
+
+        region_match = True
+        if slug_prefixes:
+            for prefix in slug_prefixes:
+                if region["slug"].startswith(prefix):
+                    region_match = True
+                    break
+            else:
+                region_match = False
+
+        if not region_match:
+            logger.debug("... %s - wrong slug prefix", region["slug"])
+            continue
+
+        if size not in region["sizes"]:
+            logger.debug(
+                "... %s - does not support this size", region["slug"])
+            continue
+
+        missing_feature = False
+        for feature in features:
+            if feature not in region["features"]:
+                missing_feature = True
+                logger.debug(
+                    "... %s - missing feature %s", region["slug"], feature)
+                break
+
+        if missing_feature:
+            logger.debug(
+                "... %s - missing one or more features", region["slug"])
+            continue
+
+        yield region
+
+
+_fingerprints = {}
+
+
+def get_fingerprint(path):
+    """
+    Returns the MD5 fingerprint, in the colon separated form the API
+    uses, and the comment of the public key at ``path``.  The comment
+    is None if the key does not have one.  Results are memoized by
+    path and modification time.
+    """
+    path = abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size)
+    cached = _fingerprints.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with open(path, "r") as stream:
+        fields = stream.read().strip().split(None, 2)
+
+    try:
+        blob = base64.b64decode(fields[1].encode("ascii"))
+    except (IndexError, TypeError, ValueError):
+        raise ValueError("%s does not appear to be a public key" % path)
+
+    digest = hashlib.md5(blob).hexdigest()
+    fingerprint = ":".join(
+        digest[index:index + 2] for index in range(0, len(digest), 2))
+    comment = fields[2].strip() if len(fields) > 2 else None
+
+    _fingerprints[path] = (version, (fingerprint, comment))
+    return fingerprint, comment
+
+
+def choose_region(distribution, regions):
+    """
+    Returns a random region slug which both ``regions`` and
+    ``distribution`` agree on.
+    """
+    region_slugs = [region["slug"] for region in regions]
+    return random.choice(
+        list(set(distribution["regions"]) & set(region_slugs)))
+
+
+class Transport(HTTPAdapter):
+    """
+    An :class:`HTTPAdapter` which is meant to be shared by every sub API
+    so they all draw from the same pool of keep-alive connections
+    instead of each performing their own TLS handshakes.
+
+    :param int pool_connections:
+        The number of host pools to cache.
+
+    :param int pool_maxsize:
+        The maximum number of connections kept open per host.  This
+        should be at least the number of threads making requests.
+
+    :param bool pool_block:
+        If True threads wait for a free connection rather than opening
+        throwaway connections once ``pool_maxsize`` is reached.
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=10, pool_block=False,
+                 max_retries=5):
+        self._lock = threading.Lock()
+        self._requests = 0
+        super(Transport, self).__init__(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+            pool_block=pool_block, max_retries=max_retries)
+
+    @classmethod
+    def from_config(cls):
+        """
+        Constructs a transport using the ``pool_connections``,
+        ``pool_maxsize`` and ``pool_block`` config options if present.
+        """
+        kwargs = {}
+        for option, getter in (("pool_connections", config.getint),
+                               ("pool_maxsize", config.getint),
+                               ("pool_block", config.getboolean)):
+            try:
+                kwargs[option] = getter(Providers.DIGITAL_OCEAN, option)
+            except (NoOptionError, NoSectionError):
+                pass
+        return cls(**kwargs)
+
+    def send(self, *args, **kwargs):
+        with self._lock:
+            self._requests += 1
+        return super(Transport, self).send(*args, **kwargs)
+
+    def stats(self):
+        """
+        Returns a dictionary describing how well connections are being
+        reused.  ``connections`` is the number of connections opened by
+        the pools which are still alive, a ``requests`` count much higher
+        than ``connections`` means keep-alive is doing its job.
+        """
+        pools = self.poolmanager.pools
+        connections = 0
+        pool_requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            pool_requests += pool.num_requests
+
+        return {
+            "requests": self._requests,
+            "pools": len(pools),
+            "connections": connections,
+            "reused": max(0, pool_requests - connections)
+        }
+
+
 class Base(_Session):
     URL = "https://api.digitalocean.com/v2"
 
-    def __init__(self):
+    # The largest page size the API will honor for list endpoints
+    PER_PAGE = 200
+
+    # Number of seconds a cached GET response for a given path is
+    # considered fresh.  Anything not listed here is only cached when
+    # ``cache=True`` is passed to request().
+    CACHE_TTL = {
+        "/regions": 3600,
+        "/sizes": 3600,
+        "/images": 3600,
+        "/account/keys": 300
+    }
+
+    # Shared by every session in the process so concurrent users of
+    # the API stay under the account's rate limit together.
+    rate_limiter = RateLimiter()
+
+    # Number of times a request is retried after a 429 response
+    RATE_LIMIT_RETRIES = 3
+
+    # A vpsutil.metrics.Metrics instance (or anything with the same
+    # start/retry/finish methods) which records every request, None
+    # disables instrumentation.
+    instrumentation = None
+
+    # When True list responses and droplets are returned as the compact
+    # read only models from vpsutil.models instead of plain dictionaries.
+    models = False
+
+    # When True paginate() decodes each page incrementally as it's
+    # downloaded instead of building the whole document first.
+    stream_lists = False
+
+    # Bytes read from the socket at a time when streaming a page
+    STREAM_CHUNK_SIZE = 65536
+
+    def __init__(self, cache=None, transport=None):
         super(Base, self).__init__()
-        self.mount("https://", HTTPAdapter(max_retries=5))
+        if transport is None:
+            transport = Transport()
+
+        self.cache = cache
+        self.transport = transport
+        self.mount("https://", transport)
+        self.mount("http://", transport)
         self.headers.update({
             "Content-Type": "application/json",
             "Accept": "application/json",
@@ -36,14 +368,181 @@ class Base(_Session):
                 Providers.DIGITAL_OCEAN, "token")
         })
 
-    def request(self, *args, **kwargs):
+    def _cache_path(self, url):
+        """Returns the path of ``url`` relative to the API's root"""
+        path = urlsplit(url).path
+        root = urlsplit(self.URL).path
+        if path.startswith(root):
+            path = path[len(root):]
+        return path
+
+    def _send(self, method, url, *args, **kwargs):
+        """
+        Performs the request once the rate limiter allows it, retrying
+        when the API responds with 429.  Mutating requests are given
+        priority over reads.
+        """
+        priority = method.upper() != "GET"
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
+            self.rate_limiter.acquire(priority=priority)
+            response = super(Base, self).request(method, url, *args, **kwargs)
+            self.rate_limiter.update(response)
+            if response.status_code != TOO_MANY_REQUESTS:
+                break
+
+            logger.debug("... rate limited, retry %d", attempt + 1)
+            response.close()
+            if self.instrumentation is not None:
+                self.instrumentation.retry()
+
+        return response
+
+    def request(self, method, url, *args, **kwargs):
+        """
+        Wrapper around :meth:`requests.Session.request` which json encodes
+        ``data`` and handles caching.  In addition to the standard keyword
+        arguments this accepts ``cache`` which may be None (use the cache
+        for paths in ``CACHE_TTL``), True (cache the response but always
+        revalidate it with a conditional request) or False (bypass the
+        cache entirely).
+        """
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return self._request(method, url, *args, **kwargs)
+
+        span = instrumentation.start(
+            method, url, stream=kwargs.get("stream", False))
+        try:
+            response = self._request(method, url, *args, **kwargs)
+        except Exception as error:
+            instrumentation.finish(span, error=error)
+            raise
+        instrumentation.finish(span, response=response)
+        return response
+
+    def _request(self, method, url, *args, **kwargs):
+        use_cache = kwargs.pop("cache", None)
+
         # It's magic...but it saves time.  Wouldn't really expect
         # the requests package to do this for us anyway.
         if (self.headers.get("Content-Type") == "application/json"
                 and "data" in kwargs):
             kwargs["data"] = json.dumps(kwargs["data"])
 
-        return super(Base, self).request(*args, **kwargs)
+        if self.cache is None or use_cache is False:
+            return self._send(method, url, *args, **kwargs)
+
+        path = self._cache_path(url)
+        resource = path.strip("/").split("/")[0]
+
+        if method.upper() != "GET":
+            response = self._send(method, url, *args, **kwargs)
+            if response.ok:
+                self.cache.invalidate(resource)
+            return response
+
+        ttl = self.CACHE_TTL.get(path)
+        if ttl is None and not use_cache:
+            return self._send(method, url, *args, **kwargs)
+        ttl = ttl or 0
+
+        prepared = self.prepare_request(
+            Request(method, url, params=kwargs.get("params")))
+
+        # Responses are account specific so the token is part of the key
+        key = "%s %s" % (prepared.headers.get("Authorization"), prepared.url)
+        entry = self.cache.get(resource, key)
+
+        if (entry is not None and not use_cache
+                and entry["expires"] > time.time()):
+            logger.debug("Cache hit for %s", prepared.url)
+            return self.cache.response(entry, prepared)
+
+        if entry is not None:
+            headers = dict(kwargs.pop("headers", None) or {})
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+            kwargs["headers"] = headers
+
+        response = self._send(method, url, *args, **kwargs)
+
+        if entry is not None and response.status_code == NOT_MODIFIED:
+            logger.debug("Cache revalidated for %s", prepared.url)
+            self.cache.touch(resource, key, entry, response, ttl)
+            response.close()
+            return self.cache.response(entry, prepared)
+
+        if response.status_code == OK:
+            self.cache.set(resource, key, response, ttl)
+
+        return response
+
+    def model(self, key, item):
+        """
+        Returns ``item``, an object found under ``key`` in a response, as
+        a :mod:`vpsutil.models` model when :attr:`models` is enabled.
+        """
+        if not self.models:
+            return item
+        model = MODELS.get(key)
+        return item if model is None else model.from_json(item)
+
+    def paginate(self, url, key, params=None, cache=None, stream=None):
+        """
+        Generator which yields each object under ``key`` for a collection
+        endpoint.  Pages are requested lazily by following
+        ``links.pages.next`` so callers which stop iterating early
+        never fetch the remaining pages.
+
+        :param string url:
+            The url of the first page.
+
+        :param string key:
+            The key in each page containing the list of objects
+            (ex. ``droplets``)
+
+        :param dict params:
+            Optional query parameters for the first request.  Subsequent
+            pages already carry the query in their ``next`` link.
+
+        :param cache:
+            Passed along to :meth:`request` for each page.
+
+        :param bool stream:
+            Decode each page incrementally and yield objects as soon as
+            they're parsed rather than after the whole page has been
+            downloaded and decoded (default: :attr:`stream_lists`).
+            Pages which are stored in the HTTP cache are still read in
+            full before decoding starts.
+        """
+        if stream is None:
+            stream = self.stream_lists
+
+        params = dict(params or {})
+        params.setdefault("per_page", self.PER_PAGE)
+
+        while url is not None:
+            response = self.get(url, params=params, cache=cache, stream=stream)
+            if not stream:
+                response.raise_for_status()
+                data = response.json()
+                for item in data.get(key, []):
+                    yield self.model(key, item)
+            else:
+                data = {}
+                try:
+                    response.raise_for_status()
+                    for item in iter_items(
+                            response.iter_content(self.STREAM_CHUNK_SIZE),
+                            key, data):
+                        yield self.model(key, item)
+                finally:
+                    response.close()
+
+            url = data.get("links", {}).get("pages", {}).get("next")
+            params = None
 
 
 class Domains(Base):
@@ -57,24 +556,9 @@ class Domains(Base):
         query = {"domain": domain, "type": record_type, "name": name}
         logger.info("Searching for domain record %r", query)
 
-        response = self.get(
-            self.URL + "/domains/%s/records" % domain
-        )
-        response.raise_for_status()
-        data = response.json()
-        records = []
-        for record in data["domain_records"]:
-            if record["type"] != record_type or record["name"] != name:
-                continue
-            records.append(record)
-
-        if len(records) > 1:
-            raise ValueError(
-                "Found more than one domain record matching %r" % query)
-        elif not records:
-            return None
-        else:
-            return records[0]
+        records = self.paginate(
+            self.URL + "/domains/%s/records" % domain, "domain_records")
+        return select_record(records, record_type, name, query)
 
     def update_record(
             self, domain, record_type, name, target,
@@ -91,19 +575,9 @@ class Domains(Base):
             "domain": domain, "type": record_type,
             "name": name, "target": target}
         current_record = self.get_record(domain, record_type, name)
-        record_data = {
-            "type": record_type,
-            "name": name,
-            "data": target,
-        }
-
-        if record_type in ("MX", "SRV"):
-            record_data.update(priority=priority)
-
-        if record_type == "SRV":
-            record_data.update(
-                port=port, weight=weight
-            )
+        data = record_data(
+            record_type, name, target,
+            priority=priority, port=port, weight=weight)
 
         if current_record is None and must_exist:
             raise ValueError(
@@ -112,22 +586,12 @@ class Domains(Base):
         # Create new record
         elif current_record is None and not must_exist:
             logger.info("Creating domain record %r", query)
-            response = self.post(
-                self.URL + "/domains/%s/records" % domain,
-                data=record_data
-            )
+            return self._create_record(domain, data)
 
         # Update existing record
         else:
             logger.info("Updating domain record %r", query)
-            response = self.put(
-                self.URL + "/domains/%s/records/%d" % (
-                    domain, current_record["id"]),
-                data=record_data
-            )
-
-        response.raise_for_status()
-        return response.json()["domain_record"]
+            return self._update_record(domain, current_record["id"], data)
 
     def delete_record(self, domain, record_type, name):
         assert record_type.isupper()
@@ -138,11 +602,104 @@ class Domains(Base):
             return
 
         logger.warning("Delete domain record %r", query)
+        self._delete_record(domain, record["id"])
+
+    def delete_record_by_id(self, domain, record_id):
+        """
+        Deletes a record which was already looked up, such as one from
+        :meth:`zone`, without searching the zone for it again.
+        """
+        logger.warning("Delete domain record %d from %s", record_id, domain)
+        self._delete_record(domain, record_id)
+
+    def _create_record(self, domain, data):
+        response = self.post(
+            self.URL + "/domains/%s/records" % domain,
+            data=data
+        )
+        response.raise_for_status()
+        return response.json()["domain_record"]
+
+    def _update_record(self, domain, record_id, data):
+        response = self.put(
+            self.URL + "/domains/%s/records/%d" % (domain, record_id),
+            data=data
+        )
+        response.raise_for_status()
+        return response.json()["domain_record"]
+
+    def _delete_record(self, domain, record_id):
         response = self.delete(
-            self.URL + "/domains/%s/records/%d" % (domain, record["id"])
+            self.URL + "/domains/%s/records/%d" % (domain, record_id)
         )
         response.raise_for_status()
 
+    def zone(self, domain):
+        """
+        Downloads all records for ``domain`` once and returns them as
+        an indexed :class:`vpsutil.zone.Zone`.
+        """
+        assert isinstance(domain, str)
+        logger.info("Retrieving domain records for %s", domain)
+        return Zone(domain, self.paginate(
+            self.URL + "/domains/%s/records" % domain, "domain_records"))
+
+    def sync_zone(self, domain, records, prune=False, dry_run=False,
+                  workers=8, zone=None):
+        """
+        Reconciles ``domain`` with the desired ``records`` and returns the
+        list of :class:`vpsutil.zone.ZoneChange` which were (or with
+        ``dry_run`` would be) applied.  The zone is downloaded once and
+        only the creates, updates and deletes needed are performed,
+        concurrently using up to ``workers`` threads.
+
+        :param list records:
+            Desired records as dictionaries using the API's field names
+            (ex. ``{"type": "A", "name": "www", "data": "127.0.0.1"}``)
+
+        :param bool prune:
+            Delete records whose (type, name) is not in ``records``.
+
+        :param zone:
+            An already loaded :class:`vpsutil.zone.Zone` to diff against,
+            it's updated in place as changes are applied.
+        """
+        if zone is None:
+            zone = self.zone(domain)
+        changes = zone.plan(records, prune=prune)
+
+        for change in changes:
+            logger.info(
+                "%s%s domain record %r", "(dry run) " if dry_run else "",
+                change.action.capitalize(),
+                dict(domain=domain, **{
+                    key: change.record.get(key)
+                    for key in ("type", "name", "data")}))
+
+        if dry_run or not changes:
+            return changes
+
+        def apply_change(change):
+            if change.action == "delete":
+                self._delete_record(domain, change.current["id"])
+                return None
+
+            data = dict(
+                (key, value) for key, value in change.record.items()
+                if key != "id" and value is not None)
+            if change.action == "create":
+                return self._create_record(domain, data)
+            return self._update_record(domain, change.current["id"], data)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (executor.submit(apply_change, change), change)
+                for change in changes)
+            for future in as_completed(futures):
+                zone.apply(futures[future], future.result())
+
+        return changes
+
 
 class Search(Base):
     def distributions(self, slug=None, regions=None):
@@ -154,30 +711,10 @@ class Search(Base):
 
         logger.info(
             "Searching for distribution %s (regions: %s)", slug, regions)
-        response = self.get(self.URL + "/images", params={"distribution": True})
-        response.raise_for_status()
-        data = response.json()
-
-        for dist in data["images"]:
-            if not dist["public"]:
-                logger.debug("... %s not public", dist["slug"])
-                continue
-
-            # At least one of the region slugs which came from
-            # regions() must be present in the distribution
-            for region_slug in regions:
-                if region_slug in dist["regions"]:
-                    break
-                else:
-                    logger.debug(
-                        "... %s region not in %s", region_slug, dist["slug"])
-            else:
-                continue
+        dists = self.paginate(
+            self.URL + "/images", "images", params={"distribution": True})
 
-            if dist["slug"] == slug:
-                return dist
-        else:
-            raise ValueError("Failed to locate distribution")
+        return select_distribution(dists, slug, regions)
 
     def regions(self, size, slug_prefixes=None, features=None):
         """
@@ -194,13 +731,7 @@ class Search(Base):
             (ex. ['metadata', 'ipv6'])
         """
         if slug_prefixes is None:
-            try:
-                slug_prefixes = list(
-                    map(str.strip,
-                         config.get(Providers.DIGITAL_OCEAN,
-                                    "region_slug_prefixes").split(",")))
-            except NoOptionError:
-                raise
+            slug_prefixes = self.slug_prefixes()
 
         assert isinstance(size, str)
         assert features is None or isinstance(features, (list, tuple))
@@ -213,72 +744,50 @@ class Search(Base):
         if features is None:
             features = []
 
-        response = self.get(self.URL + "/regions")
-        response.raise_for_status()
-        data = response.json()
-        regions = []
-
-        for region in data["regions"]:
-            if not region["available"]:
-                logger.debug("... %s - not available", region["slug"])
-                continue
-
-            region_match = True
-            if slug_prefixes:
-                for prefix in slug_prefixes:
-                    if region["slug"].startswith(prefix):
-                        region_match = True
-                        break
-                else:
-                    region_match = False
-
-            if not region_match:
-                logger.debug("... %s - wrong slug prefix", region["slug"])
-                continue
-
-            if size not in region["sizes"]:
-                logger.debug(
-                    "... %s - does not support this size", region["slug"])
-                continue
-
-            missing_feature = False
-            for feature in features:
-                if feature not in region["features"]:
-                    missing_feature = True
-                    logger.debug(
-                        "... %s - missing feature %s", region["slug"], feature)
-                    break
-
-            if missing_feature:
-                logger.debug(
-                    "... %s - missing one or more features", region["slug"])
-                continue
-
-            regions.append(region)
+        regions = list(filter_regions(
+            self.paginate(self.URL + "/regions", "regions"),
+            size, slug_prefixes, features))
 
         logger.debug("... regions: %r", [region["slug"] for region in regions])
         return regions
 
+    def slug_prefixes(self):
+        """Returns the ``region_slug_prefixes`` config option as a list"""
+        return list(
+            map(str.strip,
+                config.get(Providers.DIGITAL_OCEAN,
+                           "region_slug_prefixes").split(",")))
+
+    def region_table(self):
+        """
+        Returns a :class:`vpsutil.placement.RegionTable` built from one
+        listing of the regions and of the public distributions.
+        """
+        logger.info("Loading the region and distribution catalog")
+        return RegionTable(
+            self.paginate(self.URL + "/regions", "regions"),
+            self.paginate(
+                self.URL + "/images", "images",
+                params={"distribution": True}))
+
     def find_images(self, **fields):
         """Finds private images matching all ``fields``"""
         logger.info("Searching for images matching %r", fields)
-        response = self.get(self.URL + "/images", params={"private": "true"})
-        response.raise_for_status()
-        data = response.json()
-
-        for image in data["images"]:
-            for key, value in fields.items():
-                if key not in image:
-                    raise KeyError("No such key %s" % key)
-
-                if image[key] != value:
-                    break
-            else:
+        # Private images change whenever a snapshot is taken so always
+        # revalidate rather than trusting the catalog TTL.
+        images = self.paginate(
+            self.URL + "/images", "images", params={"private": "true"},
+            cache=True)
+
+        for image in images:
+            if match_fields(image, fields):
                 yield image
 
     def find_image(self, **fields):
         """Finds a single private image matching ``fields``"""
-        images = list(self.find_images(**fields))
+        # Two matches are enough to know the result is ambiguous so
+        # there's no need to fetch the remaining pages.
+        images = list(islice(self.find_images(**fields), 2))
         if not images:
             return
         if len(images) > 1:
@@ -287,16 +796,39 @@ class Search(Base):
 
 
 class SSH(Base):
+    def __init__(self, cache=None, transport=None):
+        super(SSH, self).__init__(cache=cache, transport=transport)
+        self._keys = None
+
     def public_keys(self):
         logger.info("Retrieving public SSH keys")
-        response = self.get(self.URL + "/account/keys")
-        response.raise_for_status()
-        return response.json()["ssh_keys"]
+        return self.paginate(self.URL + "/account/keys", "ssh_keys")
+
+    def key_index(self, refresh=False):
+        """
+        Returns the account's keys indexed by ``name``, ``fingerprint``
+        and ``id``.  The keys are downloaded once per session and kept
+        up to date by :meth:`upload_key` and :meth:`delete_key`.
+        """
+        if self._keys is None or refresh:
+            keys = {"name": {}, "fingerprint": {}, "id": {}}
+            for key in self.public_keys():
+                for field in keys:
+                    keys[field][key[field]] = key
+            self._keys = keys
+        return self._keys
+
+    def _index_key(self, key, remove=False):
+        if self._keys is None:
+            return
+        for field, keys in self._keys.items():
+            if remove:
+                keys.pop(key[field], None)
+            else:
+                keys[key[field]] = key
 
     def _get_fingerprint(self, path):
-        bits, fingerprint, comment, typename = subprocess.check_output(
-            ["ssh-keygen", "-lf", path]).strip().split()
-        return fingerprint.decode("utf-8"), comment.decode("utf-8")
+        return get_fingerprint(path)
 
     def upload_key(self, name=None, path=None):
         """
@@ -335,15 +867,19 @@ class SSH(Base):
             return public_key
 
         logger.info("Uploading public key %s", path)
+        with open(path, "r") as ssh_key:
+            public_key_data = ssh_key.read()
+
         response = self.post(
             self.URL + "/account/keys",
             data={
                 "name": name,
-                "public_key": open(path, "r").read()
+                "public_key": public_key_data
             }
         )
         response.raise_for_status()
         data = response.json()
+        self._index_key(data["ssh_key"])
         return data["ssh_key"]
 
     def get_key(self, name=None, fingerprint=None):
@@ -354,12 +890,10 @@ class SSH(Base):
         assert any([name, fingerprint]), "You must provide name or fingerprint"
         key_id = name or fingerprint
         logger.info("Trying to retrieve public key %s", key_id)
-        response = self.get(self.URL + "/account/keys")
-        response.raise_for_status()
-        data = response.json()
-        for key in data["ssh_keys"]:
-            if key_id in (key["name"], key["fingerprint"]):
-                return key
+        keys = self.key_index()
+        key = keys["name"].get(key_id) or keys["fingerprint"].get(key_id)
+        if key is not None:
+            return key
         logger.info(
             "No public key for search {'name': %r, 'fingerprint': %r}",
             name, fingerprint)
@@ -372,43 +906,116 @@ class SSH(Base):
         logger.warning("Deleting key %s", key["name"])
         response = self.delete(self.URL + "/account/keys/%d" % key["id"])
         response.raise_for_status()
+        self._index_key(key, remove=True)
 
 
 class Droplets(Base):
-    def __init__(self, search, ssh):
-        super(Droplets, self).__init__()
+    def __init__(self, search, ssh, cache=None, transport=None):
+        super(Droplets, self).__init__(cache=cache, transport=transport)
         assert isinstance(search, Search)
         assert isinstance(ssh, SSH)
         self.search = search
         self.ssh = ssh
+        self.waiter = Waiter(self)
 
-    def create_droplet(
-            self, hostname, size, distribution=None, bootstrap=None,
-            ssh_keys=None):
+    # The maximum number of names the API accepts in a single create request
+    MAX_CREATE_NAMES = 10
+
+    def placement(self, policy=None, tag=None, preferred=None,
+                  inventory=None, strict=False):
+        """
+        Returns a :class:`vpsutil.placement.Placement` which chooses
+        regions according to ``policy`` (default: the
+        ``placement_policy`` config option or ``spread``).  The region
+        catalog is loaded once and, for the policies which need it, the
+        number of droplets in each region is counted from ``inventory``
+        or a single listing of the droplets tagged ``tag``.  Without
+        either the existing droplets are not counted, so creating an
+        untagged droplet never lists the whole account, and only the
+        droplets scheduled by the placement itself are spread or packed.
+
+        :param list preferred:
+            Region slugs in order of preference, defaults to the
+            ``preferred_regions`` config option.
+        """
+        if policy is None:
+            try:
+                policy = config.get(
+                    Providers.DIGITAL_OCEAN, "placement_policy").strip()
+            except (NoOptionError, NoSectionError):
+                policy = SPREAD
+
+        if preferred is None:
+            try:
+                preferred = [
+                    slug.strip() for slug in config.get(
+                        Providers.DIGITAL_OCEAN,
+                        "preferred_regions").split(",") if slug.strip()]
+            except (NoOptionError, NoSectionError):
+                preferred = []
+
+        if policy == ANTI_AFFINITY and tag is None:
+            raise ValueError("The anti-affinity policy requires a tag")
+
+        usage = {}
+        if policy in USAGE_POLICIES and (
+                tag is not None or inventory is not None):
+            if inventory is not None:
+                droplets = inventory.find_droplets(tag=tag) \
+                    if tag is not None else inventory
+            else:
+                params = {}
+                if tag is not None:
+                    params.update(tag_name=tag)
+                droplets = self.paginate(
+                    self.URL + "/droplets", "droplets", params=params)
+
+            for droplet in droplets:
+                slug = droplet["region"]["slug"]
+                usage[slug] = usage.get(slug, 0) + 1
+            logger.debug("... droplets per region (tag: %s): %r", tag, usage)
+
+        return Placement(
+            self.search.region_table(), policy=policy, usage=usage,
+            preferred=preferred, slug_prefixes=self.search.slug_prefixes(),
+            strict=strict)
+
+    def _placement(self, size, distribution=None, bootstrap=None,
+                   placement=None, tags=None):
+        """
+        Returns the :class:`vpsutil.placement.Placement`, distribution
+        and required features for droplets of ``size``.  ``placement``
+        may be a placement, a policy name or None for the default
+        policy, the first of ``tags`` is used for anti-affinity.
+        """
         features = []
         if bootstrap:
             features.append("metadata")
 
-        regions = self.search.regions(size, features=features)
-        region_slugs = [region["slug"] for region in regions]
-
-        if not isinstance(distribution, dict):
-            distribution = self.search.distributions(
-                slug=distribution, regions=region_slugs)
+        if not isinstance(placement, Placement):
+            placement = self.placement(
+                policy=placement, tag=tags[0] if tags else None)
 
-        # Get all regions which both regions() and distributions()
-        # agree on.
-        region_slug = random.choice(
-            list(set(distribution["regions"]) & set(region_slugs)))
+        if not isinstance(distribution, Mapping):
+            if distribution is None:
+                distribution = config.get(
+                    Providers.DIGITAL_OCEAN, "default_image")
+            region_slugs = placement.candidates(size, features=features)
+            logger.info(
+                "Searching for distribution %s (regions: %s)",
+                distribution, region_slugs)
+            distribution = select_distribution(
+                placement.table.images, distribution, region_slugs)
 
-        data = {
-            "name": hostname,
-            "region": region_slug,
-            "size": size,
-            "image": distribution["id"],
-        }
+        return placement, distribution, features
 
-        if isinstance(ssh_keys, (str, int, dict)):
+    def _resolve_ssh_keys(self, ssh_keys, name):
+        """
+        Converts ``ssh_keys`` into a list of key ids or fingerprints
+        the API understands.  Local public key files which have not been
+        uploaded yet are uploaded using ``name``.
+        """
+        if isinstance(ssh_keys, (str, int, Mapping)):
             ssh_keys = [ssh_keys]
         elif ssh_keys is None:
             ssh_keys = []
@@ -425,8 +1032,7 @@ class Droplets(Base):
                 if remote_key is not None:
                     droplet_keys.append(fingerprint)
                 else:
-                    upload_key = self.ssh.upload_key(
-                        name=hostname, path=key)
+                    upload_key = self.ssh.upload_key(name=name, path=key)
                     droplet_keys.append(upload_key["id"])
 
             elif isinstance(key, str):
@@ -440,21 +1046,56 @@ class Droplets(Base):
 
                 droplet_keys.append(get_key["id"])
 
-            elif isinstance(key, dict):
+            elif isinstance(key, Mapping):
                 droplet_keys.append(key["id"])
 
             else:
                 raise TypeError("Don't know how to handle %r here" % key)
 
+        return droplet_keys
+
+    def _droplet_data(self, size, distribution, region_slug, droplet_keys,
+                      bootstrap, tags=None):
+        """Returns the request body shared by single and bulk creation"""
+        data = {
+            "region": region_slug,
+            "size": size,
+            "image": distribution["id"],
+        }
+
         if droplet_keys:
             data.update(ssh_keys=droplet_keys)
 
+        if tags:
+            data.update(tags=list(tags))
+
         if bootstrap and isfile(bootstrap):
-            bootstrap = open(bootstrap, "r").read()
+            with open(bootstrap, "r") as stream:
+                bootstrap = stream.read()
 
         if bootstrap:
             data.update(user_data=bootstrap)
 
+        return data
+
+    def create_droplet(
+            self, hostname, size, distribution=None, bootstrap=None,
+            ssh_keys=None, timeout=None, tags=None, placement=None):
+        """
+        Creates a droplet and returns it once it's active.  The region
+        is chosen by ``placement``, see :meth:`create_droplets`.
+        """
+        placement, distribution, features = self._placement(
+            size, distribution=distribution, bootstrap=bootstrap,
+            placement=placement, tags=tags)
+        region_slug = placement.choose(
+            size, image=distribution, features=features)
+        droplet_keys = self._resolve_ssh_keys(ssh_keys, hostname)
+        data = self._droplet_data(
+            size, distribution, region_slug, droplet_keys, bootstrap,
+            tags=tags)
+        data.update(name=hostname)
+
         logger.info(
             "Creating %s @ %s in %s (data: %s)",
             hostname, size, region_slug, pformat(data))
@@ -471,18 +1112,75 @@ class Droplets(Base):
         droplet_id = response.json()["droplet"]["id"]
 
         logger.info("Waiting for droplet to become active")
-        while True:
-            response = self.get(self.URL + "/droplets/%d" % droplet_id)
-
-            try:
-                droplet_data = response.json()["droplet"]
-            except KeyError:
-                pass
-            else:
-                if droplet_data["status"] == "active":
-                    return droplet_data
+        future = self.waiter.droplet(droplet_id, timeout=timeout)
+        return self.waiter.wait([future], timeout=timeout)[0]
 
-            time.sleep(10)
+    def create_droplets(
+            self, hostnames, size, distribution=None, bootstrap=None,
+            ssh_keys=None, batch_size=MAX_CREATE_NAMES, timeout=None,
+            tags=None, placement=None):
+        """
+        Creates a droplet for each name in ``hostnames`` and returns
+        the droplets, in the same order, once they are all active.
+        Placement and ssh keys are resolved once for the whole group and
+        the droplets are created using the API's ``names`` list so
+        creating many droplets only costs a handful of requests.
+
+        :param placement:
+            A :class:`vpsutil.placement.Placement`, the name of a
+            placement policy or None for the default policy.  Every
+            droplet is scheduled against the placement's region table up
+            front and the droplets are created in one batch per region.
+
+        :param list tags:
+            Tags applied to every droplet.  The default placement spreads
+            the droplets sharing the first tag across regions.
+        """
+        hostnames = list(hostnames)
+        assert hostnames, "At least one hostname is required"
+        assert 0 < batch_size <= self.MAX_CREATE_NAMES
+        assert len(set(hostnames)) == len(hostnames), "Duplicate hostnames"
+
+        placement, distribution, features = self._placement(
+            size, distribution=distribution, bootstrap=bootstrap,
+            placement=placement, tags=tags)
+        droplet_keys = self._resolve_ssh_keys(ssh_keys, hostnames[0])
+
+        schedule = OrderedDict()
+        for hostname, region_slug in zip(hostnames, placement.schedule(
+                len(hostnames), size, image=distribution,
+                features=features)):
+            schedule.setdefault(region_slug, []).append(hostname)
+
+        droplet_ids = {}
+        for region_slug, region_hostnames in schedule.items():
+            for index in range(0, len(region_hostnames), batch_size):
+                names = region_hostnames[index:index + batch_size]
+                data = self._droplet_data(
+                    size, distribution, region_slug, droplet_keys,
+                    bootstrap, tags=tags)
+                data.update(names=names)
+
+                logger.info(
+                    "Creating %s @ %s in %s (data: %s)",
+                    ", ".join(names), size, region_slug, pformat(data))
+
+                response = self.post(self.URL + "/droplets", data=data)
+                try:
+                    response.raise_for_status()
+                except Exception:
+                    logger.error(
+                        "Error in request: %s", pformat(response.json()))
+                    raise
+
+                for droplet in response.json()["droplets"]:
+                    droplet_ids[droplet["name"]] = droplet["id"]
+
+        logger.info("Waiting for %d droplet(s) to become active",
+                    len(droplet_ids))
+        futures = [self.waiter.droplet(droplet_ids[hostname], timeout=timeout)
+                   for hostname in hostnames]
+        return self.waiter.wait(futures, timeout=timeout)
 
     def set_power_state(self, droplet_id, state):
         logger.info("Set power state of droplet %d to %s", droplet_id, state)
@@ -496,18 +1194,28 @@ class Droplets(Base):
 
         raise NotImplementedError(state)
 
-    def delete_droplet(self, **fields):
+    def delete_droplet(self, timeout=300, **fields):
         droplet = self.find_droplet(**fields)
         if not droplet:
             return
 
-        logger.warning("Destroy droplet %d", droplet["id"])
+        self.delete_droplet_by_id(droplet["id"], timeout=timeout)
 
+    def delete_droplet_by_id(self, droplet_id, timeout=300):
+        """
+        Deletes a droplet which was already looked up, such as one from
+        :meth:`inventory`, without searching for it again.
+        """
+        logger.warning("Destroy droplet %d", droplet_id)
+
+        # The API responds with 422 while the droplet is still busy
+        # with another event (such as being created).
+        backoff = Backoff(initial=2, maximum=10, timeout=timeout)
         while True:
-            response = self.delete(self.URL + "/droplets/%d" % droplet["id"])
+            response = self.delete(self.URL + "/droplets/%d" % droplet_id)
             if response.status_code == UNPROCESSABLE_ENTITY:
-                time.sleep(5)
                 logger.debug("... retry")
+                backoff.sleep()
                 continue
 
             response.raise_for_status()
@@ -518,50 +1226,44 @@ class Droplets(Base):
         logger.info("Get droplet %d", droplet_id)
         response = self.get(self.URL + "/droplets/%d" % droplet_id)
         response.raise_for_status()
-        return response.json()["droplet"]
+        return self.model("droplets", response.json()["droplet"])
 
-    def get_droplet_ip(self, droplet, ip_version="v4"):
+    def get_droplet_ip(self, droplet, ip_version="v4", timeout=None):
         if isinstance(droplet, int):
             # We might not have a network yet
-            while True:
-                result = self.get_droplet(droplet)
-                if result["networks"][ip_version]:
-                    droplet = result
-                    break
-                time.sleep(3)
+            future = self.waiter.droplet(
+                droplet, timeout=timeout,
+                condition=lambda result: result["networks"][ip_version])
+            droplet = self.waiter.wait([future], timeout=timeout)[0]
 
         logger.info("Get IP of droplet %s", droplet["id"])
-        addresses = []
-        for address in droplet["networks"][ip_version]:
-            if address["type"] == "public":
-                addresses.append(address["ip_address"])
-
+        addresses = public_ips(droplet, ip_version)
         assert len(addresses) == 1
         return addresses[0]
 
     def find_droplets(self, **fields):
         logger.info("Searching for droplets matching %r", fields)
-        response = self.get(self.URL + "/droplets")
-        response.raise_for_status()
-        data = response.json()
-
-        for droplet in data["droplets"]:
-            for key, value in fields.items():
-                if key not in ("ip", ):
-                    if key not in droplet:
-                        raise KeyError("No such key %s" % key)
 
-                    if droplet[key] != value:
-                        break
+        # Let the API do the filtering when we're searching by tag
+        params = {}
+        if "tag" in fields:
+            params.update(tag_name=fields["tag"])
 
-                if key == "ip" and value != self.get_droplet_ip(droplet):
-                    break
-
-            else:
+        for droplet in self.paginate(
+                self.URL + "/droplets", "droplets", params=params):
+            if match_droplet(droplet, fields):
                 yield droplet
 
+    def inventory(self, tag_name=None):
+        """
+        Returns a loaded :class:`vpsutil.inventory.Inventory` which can
+        answer repeated lookups by id, name, ip, tag or region without
+        further requests.
+        """
+        return Inventory(self, tag_name=tag_name).load()
+
     def find_droplet(self, **fields):
-        droplets = list(self.find_droplets(**fields))
+        droplets = list(islice(self.find_droplets(**fields), 2))
         if not droplets:
             return
         if len(droplets) > 1:
@@ -572,11 +1274,70 @@ class Droplets(Base):
 class DigitalOcean(object):
     """
     High level wrapper around the various sub APIs.
+
+    :param cache:
+        An :class:`HTTPCache` instance shared by the sub APIs.  When not
+        provided one is created in ``~/.vpsutil/cache`` unless the
+        ``http_cache`` config option is false.  Pass False to disable
+        caching.
+
+    :param transport:
+        A :class:`Transport` shared by the sub APIs.  When not provided
+        one is constructed from the ``pool_*`` config options.
+
+    :param bool models:
+        Return droplets, images, records and keys as the compact models
+        from :mod:`vpsutil.models` rather than dictionaries.  Defaults to
+        the ``compact_models`` config option, or :attr:`Base.models` when
+        that's not set.
+
+    :param bool stream_lists:
+        Decode list responses incrementally, see :meth:`Base.paginate`.
+        Defaults to the ``stream_lists`` config option, or
+        :attr:`Base.stream_lists` when that's not set.
     """
-    def __init__(self):
-        self.ssh = SSH()
-        self.search = Search()
-        self.droplets = Droplets(self.search, self.ssh)
-        self.dns = Domains()
+    def __init__(self, cache=None, transport=None, models=None,
+                 stream_lists=None):
+        if cache is None:
+            try:
+                enabled = config.getboolean(
+                    Providers.DIGITAL_OCEAN, "http_cache")
+            except (NoOptionError, NoSectionError):
+                enabled = True
+            cache = HTTPCache() if enabled else False
+
+        if cache is False:
+            cache = None
+
+        if transport is None:
+            transport = Transport.from_config()
+
+        self.cache = cache
+        self.transport = transport
+        self.ssh = SSH(cache=cache, transport=transport)
+        self.search = Search(cache=cache, transport=transport)
+        self.droplets = Droplets(
+            self.search, self.ssh, cache=cache, transport=transport)
+        self.dns = Domains(cache=cache, transport=transport)
+
+        if models is None:
+            try:
+                models = config.getboolean(
+                    Providers.DIGITAL_OCEAN, "compact_models")
+            except (NoOptionError, NoSectionError):
+                models = None
+
+        if stream_lists is None:
+            try:
+                stream_lists = config.getboolean(
+                    Providers.DIGITAL_OCEAN, "stream_lists")
+            except (NoOptionError, NoSectionError):
+                stream_lists = None
+
+        for api in (self.ssh, self.search, self.droplets, self.dns):
+            if models is not None:
+                api.models = models
+            if stream_lists is not None:
+                api.stream_lists = stream_lists
 
 
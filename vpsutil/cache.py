@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from errno import EEXIST, ENOENT
+from os.path import join
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from vpsutil.config import CONFIG_DIR_CACHE
+from vpsutil.logger import logger
+
+
+class HTTPCache(object):
+    """
+    A small persistent cache for GET responses.  Each entry is stored
+    as its own json file containing the body, the validators needed to
+    revalidate it (``ETag``/``Last-Modified``) and the time at which
+    it expires.  The total size of the cache is bounded by evicting the
+    least recently used entries, access time is tracked using the
+    mtime of each file.
+
+    Entry file names are prefixed with the top level resource of the
+    url (``droplets``, ``account``, etc) so a write to a resource can
+    cheaply invalidate everything cached beneath it.
+    """
+    MAX_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, path=CONFIG_DIR_CACHE, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+        try:
+            os.makedirs(self.path)
+        except (OSError, IOError) as e:
+            if e.errno != EEXIST:
+                raise
+
+    def _filename(self, resource, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return join(self.path, "%s-%s.json" % (resource, digest))
+
+    def get(self, resource, key):
+        """
+        Returns the cache entry for ``key`` or None if we have not
+        cached anything for it.
+        """
+        filename = self._filename(resource, key)
+        try:
+            with open(filename, "r") as stream:
+                entry = json.load(stream)
+        except (OSError, IOError) as e:
+            if e.errno != ENOENT:
+                raise
+            return None
+        except ValueError:
+            logger.debug("Discarding corrupt cache entry %s", filename)
+            self._remove(filename)
+            return None
+
+        # Update the mtime, this is what the LRU eviction is based on
+        try:
+            os.utime(filename, None)
+        except (OSError, IOError):
+            pass
+
+        return entry
+
+    def set(self, resource, key, response, ttl):
+        """Stores ``response`` for ``key`` for ``ttl`` seconds"""
+        cache_control = response.headers.get("Cache-Control", "")
+        if "no-store" in cache_control:
+            return
+
+        entry = {
+            "url": response.url,
+            "headers": dict(response.headers),
+            "content": response.content.decode("utf-8"),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "expires": time.time() + ttl
+        }
+        self._write(self._filename(resource, key), entry)
+        self.evict()
+
+    def touch(self, resource, key, entry, response, ttl):
+        """
+        Called when a conditional request returns 304, refreshes the
+        expiration and validators of an existing entry.
+        """
+        entry.update(expires=time.time() + ttl)
+        for header, field in (("ETag", "etag"),
+                              ("Last-Modified", "last_modified")):
+            if header in response.headers:
+                entry[field] = response.headers[header]
+
+        self._write(self._filename(resource, key), entry)
+
+    def invalidate(self, resource):
+        """Removes all entries for the given top level ``resource``"""
+        prefix = resource + "-"
+        for filename in os.listdir(self.path):
+            if filename.startswith(prefix):
+                self._remove(join(self.path, filename))
+
+    def clear(self):
+        for filename in os.listdir(self.path):
+            self._remove(join(self.path, filename))
+
+    def evict(self):
+        """Removes the least recently used entries until under max_size"""
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.path):
+            path = join(self.path, filename)
+            try:
+                stat = os.stat(path)
+            except (OSError, IOError):
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            logger.debug("Evicting cache entry %s", path)
+            self._remove(path)
+            total_size -= size
+
+    def response(self, entry, request):
+        """Constructs a response object from a cache ``entry``"""
+        response = Response()
+        response.status_code = 200
+        response.url = entry["url"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = "utf-8"
+        response.request = request
+        response._content = entry["content"].encode("utf-8")
+        # There's no connection behind the response so iter_content()
+        # and close() must only use the content above.
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+    def _write(self, filename, entry):
+        # Write to a temporary file first and rename it so other
+        # processes never see a partially written entry.
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as stream:
+                json.dump(entry, stream)
+            os.replace(temp_path, filename)
+        except Exception:
+            self._remove(temp_path)
+            raise
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except (OSError, IOError) as e:
+            if e.errno != ENOENT:
+                raise
@@ -1,68 +1,230 @@
 import argparse
-from fnmatch import fnmatchcase
+import csv
+import json
+import logging
+import sys
+import time
+from glob import has_magic
 from configparser import NoOptionError, NoSectionError
-from vpsutil.api import DigitalOcean
 from vpsutil.logger import logger
 from vpsutil.config import config, Providers
-from vpsutil.ssh import SSHClient
 
-try:
-    from vpsutil_private import parser_hook
-except ImportError:
-    parser_hook = NotImplemented
-    logger.warning(
-        "parser_hook() will not be run, could not import vpsutil_private")
+# vpsutil.api and vpsutil.ssh (and with them requests and paramiko) are
+# imported by the subcommand functions which need them so the CLI
+# starts quickly.
 
 
-def destroy_resources(parser, args):
-    never_destroy = []
+def load_parser_hook():
+    """
+    Returns vpsutil_private.parser_hook or NotImplemented if it can't be
+    imported.
+    """
     try:
-        never_destroy = \
-            map(str.strip,
-                config.get(Providers.DEFAULT, "never_destroy").split(","))
-    except Exception:
-        pass
+        from vpsutil_private import parser_hook
+    except ImportError:
+        logger.debug(
+            "parser_hook() will not be run, could not import vpsutil_private")
+        return NotImplemented
+    return parser_hook
 
-    for match in never_destroy:
-        if fnmatchcase(args.name, match):
-            logger.error(
-                "Cannot destroy %s, it matches %s in the `never_destroy` "
-                "configuration variable", args.name, match)
-            return
 
-    logger.info("Destroying resources with the name %r", args.name)
-    SSHClient.delete_rsa_key_pair(args.name)
+def destroy_resources(parser, args):
+    from vpsutil.api import DigitalOcean
+    from vpsutil.destroy import DestroyPlan
+
     do = DigitalOcean()
-    do.ssh.delete_key(name=args.name)
-    do.droplets.delete_droplet(name=args.name)
+    plan = DestroyPlan.build(do, args.names, domain=args.domain)
+
+    for name, pattern in plan.protected:
+        logger.error(
+            "Cannot destroy %s, it matches %s in the `never_destroy` "
+            "configuration variable", name, pattern)
+
+    if not plan.actions:
+        logger.info("Nothing to destroy matching %s", ", ".join(args.names))
+        return
+
+    for action in plan:
+        print("%s%s" % ("(dry run) " if args.dry_run else "",
+                        action.description))
+
+    if args.dry_run:
+        return
+
+    # Patterns can match far more than intended so confirm those first
+    if not args.yes and any(has_magic(name) for name in args.names):
+        if not sys.stdin.isatty():
+            parser.error("Use --yes to destroy by pattern non-interactively")
+
+        answer = input("Destroy %d host(s)? [y/N] " % len(plan.names))
+        if answer.strip().lower() not in ("y", "yes"):
+            return
+
+    logger.info("Destroying resources for %s", ", ".join(plan.names))
+    failed = plan.apply(workers=args.workers)
+    if failed:
+        sys.exit(1)
+
+
+SHOW_FIELDS = ("name", "address", "status", "region", "size")
+TABLE_HEADER = (
+    "Name             Address          Status Region Size",
+    "---------------- ---------------- ------ ------ --------")
+TABLE_ROW = "{0:<16} {1:<16} {2:<6} {3:<6} {4:<8}"
+
+
+def droplet_row(droplet):
+    """Returns the values ``ocean show`` displays for ``droplet``"""
+    ip_address = None
+    for network in droplet["networks"]["v4"]:
+        ip_address = network["ip_address"]
+        break
+
+    return (
+        droplet["name"], ip_address,
+        droplet["status"], droplet["region"]["slug"],
+        droplet["size_slug"]
+    )
+
+
+class TableOutput(object):
+    """
+    Prints droplets as a table.  When writing to a terminal updates
+    rewrite only the rows which changed, otherwise the changed rows are
+    printed as they come in.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.interactive = stream.isatty()
+        self.rows = []
 
-    if args.domain:
-        # For now we don't destroy any other record type
-        for record_type in ("A", "AAAA"):
-            do.dns.delete_record(args.domain, record_type, args.name)
+    def _write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+    def snapshot(self, droplets):
+        self.rows = [(droplet["id"], droplet_row(droplet))
+                     for droplet in droplets]
+        self._write("\n".join(
+            list(TABLE_HEADER) +
+            [TABLE_ROW.format(*row) for _, row in self.rows]) + "\n")
+
+    def update(self, droplets, added, changed, removed):
+        if not self.interactive:
+            for droplet in droplets:
+                if droplet["id"] in added or droplet["id"] in changed:
+                    self._write(TABLE_ROW.format(*droplet_row(droplet)) + "\n")
+            return
+
+        # Rows moving around means redrawing everything below the header
+        if added or removed:
+            self._write("\x1b[%dA\r\x1b[J" % (len(self.rows) + 2))
+            self.snapshot(droplets)
+            return
+
+        by_id = dict((droplet["id"], droplet) for droplet in droplets)
+        for index, (droplet_id, row) in enumerate(self.rows):
+            if droplet_id not in changed:
+                continue
+            row = droplet_row(by_id[droplet_id])
+            self.rows[index] = (droplet_id, row)
+            offset = len(self.rows) - index
+            self._write("\x1b[%dA\r\x1b[2K%s\x1b[%dB\r" % (
+                offset, TABLE_ROW.format(*row), offset))
+
+
+class JSONOutput(object):
+    """
+    Prints one JSON object per droplet per line.  Updates include an
+    ``event`` of added, changed or removed.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.rows = {}
+
+    def _emit(self, row, event=None):
+        record = dict(zip(SHOW_FIELDS, row))
+        if event is not None:
+            record["event"] = event
+        self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def snapshot(self, droplets):
+        for droplet in droplets:
+            self.rows[droplet["id"]] = droplet_row(droplet)
+            self._emit(self.rows[droplet["id"]])
+        self.stream.flush()
+
+    def update(self, droplets, added, changed, removed):
+        for droplet_id in sorted(removed):
+            self._emit(self.rows.pop(droplet_id), "removed")
+        for droplet in droplets:
+            if droplet["id"] in added or droplet["id"] in changed:
+                self.rows[droplet["id"]] = droplet_row(droplet)
+                self._emit(
+                    self.rows[droplet["id"]],
+                    "added" if droplet["id"] in added else "changed")
+        self.stream.flush()
+
+
+class CSVOutput(JSONOutput):
+    """
+    Prints droplets as CSV, in watch mode the first column is the event
+    which is empty for the initial snapshot.
+    """
+    def __init__(self, stream, watch=False):
+        super(CSVOutput, self).__init__(stream)
+        self.watch = watch
+        self.writer = csv.writer(stream)
+        if watch:
+            self.writer.writerow(("event", ) + SHOW_FIELDS)
+        else:
+            self.writer.writerow(SHOW_FIELDS)
+
+    def _emit(self, row, event=None):
+        if self.watch:
+            row = (event or "", ) + tuple(row)
+        self.writer.writerow(row)
 
 
 def show_droplets(parser, args):
+    from vpsutil.api import DigitalOcean
     do = DigitalOcean()
-    droplets = list(do.droplets.find_droplets())
+    inventory = do.droplets.inventory()
+
+    def droplets():
+        return sorted(inventory, key=lambda droplet: droplet["id"])
 
-    print("Name             Address          Status Region Size")
-    print("---------------- ---------------- ------ ------ --------")
-    for droplet in droplets:
-        ip_address = None
-        for network in droplet["networks"]["v4"]:
-            ip_address = network["ip_address"]
-            break
+    if args.format == "json":
+        output = JSONOutput(sys.stdout)
+    elif args.format == "csv":
+        output = CSVOutput(sys.stdout, watch=args.watch)
+    else:
+        output = TableOutput(sys.stdout)
+
+    output.snapshot(droplets())
+    if not args.watch:
+        return
+
+    # Log lines would throw off the rows the table redraws
+    if isinstance(output, TableOutput) and output.interactive:
+        logger.setLevel(logging.WARNING)
+
+    # The listing is revalidated with conditional requests so polling an
+    # unchanged fleet costs a 304 per page rather than the whole fleet.
+    try:
+        while True:
+            time.sleep(args.interval)
+            added, changed, removed = inventory.refresh()
+            if added or changed or removed:
+                output.update(droplets(), added, changed, removed)
+    except KeyboardInterrupt:
+        pass
 
-        args = (
-            droplet["name"], ip_address,
-            droplet["status"], droplet["region"]["slug"],
-            droplet["size_slug"]
-        )
-        print("{0:<16} {1:<16} {2:<6} {3:<6} {4:<8}".format(*args))
 
+def ocean(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
 
-def ocean():
     try:
         default_domain = config.get(Providers.DEFAULT, "domain")
     except (NoOptionError, NoSectionError):
@@ -76,17 +238,41 @@ def ocean():
         default=default_domain)
 
     show = subparsers.add_parser("show", help="Show all droplets")
+    show.add_argument(
+        "--format", choices=("table", "json", "csv"), default="table",
+        help="The output format, json is one object per line")
+    show.add_argument(
+        "--watch", action="store_true",
+        help="Keep running and show droplets as they change")
+    show.add_argument(
+        "--interval", type=float, default=5,
+        help="Seconds between refreshes with --watch")
     show.set_defaults(func=show_droplets)
 
     destroy = subparsers.add_parser(
         "destroy", help="Destroy resources on Digital Ocean based on a name")
-    destroy.add_argument("name", help="Name of objects to destroy")
+    destroy.add_argument(
+        "names", nargs="+", metavar="name",
+        help="Names of objects to destroy, glob patterns such as 'web-*' "
+             "are accepted")
+    destroy.add_argument(
+        "--dry-run", action="store_true",
+        help="Show what would be destroyed without destroying it")
+    destroy.add_argument(
+        "-y", "--yes", action="store_true",
+        help="Don't ask for confirmation when destroying by pattern")
+    destroy.add_argument(
+        "--workers", type=int, default=16,
+        help="The number of deletions to run at once")
     destroy.set_defaults(func=destroy_resources)
 
+    # The hook may add global options or reconfigure any command so it
+    # always runs, even for the commands defined above.
+    parser_hook = load_parser_hook()
     if parser_hook is not NotImplemented:
         parser_hook(parser, subparsers)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     try:
         args.func
     except AttributeError:
@@ -1,10 +1,23 @@
+import os
+import shutil
+import tempfile
+import threading
 from configparser import ConfigParser
 from collections import namedtuple
-from os.path import join, expanduser
+from contextlib import contextmanager
+from io import StringIO
+from errno import EEXIST, ENOENT
+from os.path import dirname, join, expanduser
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 CONFIG_DIR = join(expanduser("~"), ".vpsutil")
 CONFIG_FILE = join(CONFIG_DIR, "config")
 CONFIG_DIR_SSH = join(CONFIG_DIR, "ssh")
+CONFIG_DIR_CACHE = join(CONFIG_DIR, "cache")
 
 # In case we support other providers in the future
 _Providers = namedtuple("Providers", ("DEFAULT", "DIGITAL_OCEAN", ))
@@ -12,3 +25,182 @@ Providers = _Providers(DEFAULT="digital_ocean", DIGITAL_OCEAN="digital_ocean")
 
 config = ConfigParser()
 config.read(CONFIG_FILE)
+
+
+def _signature(path):
+    """Returns a value which changes whenever ``path`` is written"""
+    try:
+        stat = os.stat(path)
+    except (OSError, IOError) as e:
+        if e.errno != ENOENT:
+            raise
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class ConfigStore(object):
+    """
+    Reads and writes the config file on behalf of ``parser`` so several
+    processes can update it at once without losing each other's changes.
+
+    Changes are made inside :meth:`transaction` which holds an advisory
+    lock on ``<path>.lock`` (where :mod:`fcntl` is available), re-reads
+    the file if another process changed it and writes the result back
+    atomically once the outermost transaction finishes.  Transactions
+    nest, so many updates can be batched into a single write:
+
+    >>> with store.transaction():
+    ...     for name in hostnames:
+    ...         SSHClient.generate_key_pair(name=name)
+
+    The file is copied to ``<path>.last`` before the first write made
+    by the store.
+
+    :param string path:
+        The path to the config file.
+
+    :param parser:
+        The :class:`ConfigParser` holding the config in memory.
+    """
+    def __init__(self, path=CONFIG_FILE, parser=config):
+        self.path = path
+        self.parser = parser
+        self._signature = _signature(path)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._lock_file = None
+        self._backed_up = False
+        self._before = None
+
+    def refresh(self):
+        """
+        Re-reads the file if it changed on disk since it was last read
+        or written, returns True if it was re-read.
+        """
+        signature = _signature(self.path)
+        if signature == self._signature:
+            return False
+
+        try:
+            with open(self.path, "r") as stream:
+                contents = stream.read()
+        except (OSError, IOError) as e:
+            if e.errno != ENOENT:
+                raise
+            contents = ""
+
+        self._load(contents)
+        self._signature = signature
+        return True
+
+    def _load(self, contents):
+        """Replaces the parser's contents with ``contents``"""
+        for section in self.parser.sections():
+            self.parser.remove_section(section)
+        for option in list(self.parser.defaults()):
+            self.parser.remove_option("DEFAULT", option)
+        self.parser.read_string(contents)
+
+    def _acquire(self):
+        directory = dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except (OSError, IOError) as e:
+            if e.errno != EEXIST:
+                raise
+
+        if fcntl is None:
+            return
+
+        self._lock_file = open(self.path + ".lock", "a")
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+
+    def _release(self):
+        if self._lock_file is None:
+            return
+
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _write(self):
+        """Atomically replaces the config file with the parser's contents"""
+        if not self._backed_up:
+            try:
+                shutil.copy2(self.path, self.path + ".last")
+            except (OSError, IOError) as e:
+                if e.errno != ENOENT:
+                    raise
+            self._backed_up = True
+
+        descriptor, temp_path = tempfile.mkstemp(
+            dir=dirname(self.path), prefix=".config-")
+        try:
+            with os.fdopen(descriptor, "w") as stream:
+                self.parser.write(stream)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.replace(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        self._signature = _signature(self.path)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager yielding the parser with the lock held.  The file
+        is written when the outermost transaction exits without an error
+        and the config actually changed, if an error is raised the
+        changes are discarded.
+        """
+        with self._lock:
+            if self._depth == 0:
+                self._acquire()
+                try:
+                    self.refresh()
+                except Exception:
+                    self._release()
+                    raise
+                self._before = self._dump()
+
+            self._depth += 1
+            try:
+                try:
+                    yield self.parser
+                except Exception:
+                    if self._depth == 1:
+                        self._load(self._before)
+                    raise
+
+                if self._depth == 1 and self._dump() != self._before:
+                    self._write()
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._before = None
+                    self._release()
+
+    def _dump(self):
+        stream = StringIO()
+        self.parser.write(stream)
+        return stream.getvalue()
+
+    def set(self, section, option, value):
+        """Sets ``option`` in ``section``, creating the section if needed"""
+        with self.transaction() as parser:
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, option, value)
+
+    def remove_option(self, section, option):
+        """Removes ``option`` from ``section`` if it exists"""
+        with self.transaction() as parser:
+            if parser.has_section(section):
+                parser.remove_option(section, option)
+
+
+store = ConfigStore()
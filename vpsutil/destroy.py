@@ -0,0 +1,185 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatchcase
+from glob import has_magic
+
+from configparser import NoOptionError, NoSectionError
+
+from vpsutil.config import Providers, config, store
+from vpsutil.logger import logger
+from vpsutil.ssh import SSHClient
+
+# The record types destroyed along with a host
+RECORD_TYPES = ("A", "AAAA")
+
+# The name of the domain's own records, these are never destroyed
+APEX = "@"
+
+Action = namedtuple("Action", ("kind", "name", "description", "function"))
+
+
+def never_destroy_patterns():
+    """Returns the patterns from the ``never_destroy`` config option"""
+    try:
+        value = config.get(Providers.DEFAULT, "never_destroy")
+    except (NoOptionError, NoSectionError):
+        return []
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+
+def matches(name, patterns):
+    return any(fnmatchcase(name, pattern) for pattern in patterns)
+
+
+class DestroyPlan(object):
+    """
+    Everything which would be destroyed for the names matching a set of
+    glob patterns.  The plan is built from one snapshot of the droplets,
+    account keys, DNS records and local key pairs so building it costs
+    a single listing of each no matter how many names match.  A/AAAA
+    records are destroyed along with the droplet or key of the same name,
+    a record by itself is only destroyed when it's named exactly and the
+    domain's apex (``@``) records never are.
+
+    >>> plan = DestroyPlan.build(do, ["staging-*"], domain="example.com")
+    >>> for action in plan:
+    ...     print(action.description)
+    >>> plan.apply(workers=32)
+
+    :param list actions:
+        The :class:`Action` instances to run.
+
+    :param list protected:
+        (name, pattern) tuples for names which matched but are protected
+        by ``never_destroy``.
+    """
+    def __init__(self, actions, protected):
+        self.actions = actions
+        self.protected = protected
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def __len__(self):
+        return len(self.actions)
+
+    @property
+    def names(self):
+        return sorted(set(action.name for action in self.actions))
+
+    @classmethod
+    def build(cls, do, patterns, domain=None, never_destroy=None):
+        """
+        Returns the plan for destroying everything named by ``patterns``
+        using the :class:`vpsutil.api.DigitalOcean` instance ``do``.
+        """
+        if never_destroy is None:
+            never_destroy = never_destroy_patterns()
+
+        logger.info("Planning the destruction of %s", ", ".join(patterns))
+        inventory = do.droplets.inventory()
+        keys = do.ssh.key_index()["name"]
+        zone = do.dns.zone(domain) if domain else None
+        store.refresh()
+        local_keys = config.options("ssh_keys") \
+            if config.has_section("ssh_keys") else []
+
+        candidates = set(droplet["name"] for droplet in inventory)
+        candidates.update(keys)
+        candidates.update(local_keys)
+
+        # Patterns only reach the records of the droplets and keys being
+        # destroyed, a record on its own has to be named explicitly.
+        if zone is not None:
+            candidates.update(
+                record["name"] for record in zone
+                if record["type"] in RECORD_TYPES
+                and record["name"] != APEX
+                and record["name"] in patterns
+                and not has_magic(record["name"]))
+        candidates.discard(APEX)
+
+        actions, protected = [], []
+        for name in sorted(candidates):
+            if not matches(name, patterns):
+                continue
+
+            guard = [pattern for pattern in never_destroy
+                     if fnmatchcase(name, pattern)]
+            if guard:
+                protected.append((name, guard[0]))
+                continue
+
+            actions.extend(cls._actions(
+                do, name, inventory, keys, local_keys, zone, domain))
+
+        return cls(actions, protected)
+
+    @classmethod
+    def _actions(cls, do, name, inventory, keys, local_keys, zone, domain):
+        if name in local_keys:
+            yield Action(
+                "local key", name, "delete local key pair %s" % name,
+                lambda: SSHClient.delete_rsa_key_pair(name))
+
+        if name in keys:
+            yield Action(
+                "key", name, "delete account key %s (%d)" % (
+                    name, keys[name]["id"]),
+                lambda: do.ssh.delete_key(name=name))
+
+        for droplet in inventory.find_droplets(name=name):
+            droplet_id = droplet["id"]
+            yield Action(
+                "droplet", name, "destroy droplet %s (%d)" % (
+                    name, droplet_id),
+                lambda droplet_id=droplet_id:
+                    do.droplets.delete_droplet_by_id(droplet_id))
+
+        if zone is None:
+            return
+
+        for record_type in RECORD_TYPES:
+            for record in zone.get(record_type, name):
+                record_id = record["id"]
+                yield Action(
+                    "record", name, "delete %s record %s.%s -> %s" % (
+                        record_type, name, domain, record["data"]),
+                    lambda record_id=record_id:
+                        do.dns.delete_record_by_id(domain, record_id))
+
+    def apply(self, workers=16):
+        """
+        Runs the plan and returns a list of (action, error) tuples for
+        any actions which failed.  API calls run concurrently on up to
+        ``workers`` threads, local key pairs are removed in a single
+        config file update.
+        """
+        local = [action for action in self.actions
+                 if action.kind == "local key"]
+        remote = [action for action in self.actions
+                  if action.kind != "local key"]
+        failed = []
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (executor.submit(action.function), action)
+                for action in remote)
+
+            with store.transaction():
+                for action in local:
+                    try:
+                        action.function()
+                    except Exception as error:
+                        logger.error("Failed to %s: %s",
+                                     action.description, error)
+                        failed.append((action, error))
+
+            for future in as_completed(futures):
+                action = futures[future]
+                error = future.exception()
+                if error is not None:
+                    logger.error("Failed to %s: %s", action.description, error)
+                    failed.append((action, error))
+
+        return failed
@@ -0,0 +1,286 @@
+import shlex
+from collections import OrderedDict, namedtuple
+
+from vpsutil.logger import logger
+
+Rule = namedtuple("Rule", ("table", "action", "chain", "spec", "text"))
+FirewallPlan = namedtuple("FirewallPlan", ("add", "delete"))
+
+BUILTIN_CHAINS = frozenset(
+    ("INPUT", "OUTPUT", "FORWARD", "PREROUTING", "POSTROUTING"))
+
+# Long options iptables accepts but iptables-save never prints
+LONG_OPTIONS = {
+    "--table": "-t",
+    "--append": "-A",
+    "--insert": "-I",
+    "--delete": "-D",
+    "--protocol": "-p",
+    "--source": "-s",
+    "--src": "-s",
+    "--destination": "-d",
+    "--dst": "-d",
+    "--in-interface": "-i",
+    "--out-interface": "-o",
+    "--jump": "-j",
+    "--goto": "-g",
+    "--match": "-m",
+    "--destination-port": "--dport",
+    "--source-port": "--sport",
+    "--destination-ports": "--dports",
+    "--source-ports": "--sports"
+}
+ADDRESS_OPTIONS = frozenset(("-s", "-d"))
+
+
+def normalize_tokens(tokens):
+    """
+    Returns ``tokens`` in the form ``iptables-save`` prints them so that
+    a rule written by hand can be compared with the saved ruleset.
+    """
+    normalized = []
+    for token in tokens:
+        token = LONG_OPTIONS.get(token, token)
+
+        # iptables-save always shows the mask of an address
+        if normalized and normalized[-1] in ADDRESS_OPTIONS \
+                and "/" not in token and token.replace(".", "").isdigit():
+            token += "/32"
+        normalized.append(token)
+
+    # ... and the implicit match module of '-p tcp' or '-p udp', drop it
+    # from both sides so it doesn't matter if it was given or not
+    result = []
+    index = 0
+    while index < len(normalized):
+        token = normalized[index]
+        if token == "-m" and len(result) >= 2 and result[-2] == "-p" \
+                and normalized[index + 1:index + 2] == [result[-1]]:
+            index += 2
+            continue
+        result.append(token)
+        index += 1
+    return result
+
+
+def parse_rule(rule, table="filter"):
+    """
+    Parses an iptables rule such as ``-A INPUT -p tcp --dport 22 -j ACCEPT``
+    into a :class:`Rule`.  The rule should not include ``iptables``
+    itself.  Any ``-t`` option overrides ``table``.
+    """
+    tokens = normalize_tokens(shlex.split(rule))
+    if tokens and tokens[0] in ("iptables", "sudo"):
+        raise ValueError("Rule should not include the command: %s" % rule)
+
+    if "-t" in tokens:
+        index = tokens.index("-t")
+        table = tokens[index + 1]
+        del tokens[index:index + 2]
+
+    if len(tokens) < 2 or tokens[0] not in ("-A", "-I", "-D"):
+        raise ValueError("Expected -A, -I or -D CHAIN in rule: %s" % rule)
+
+    action, chain = tokens[0], tokens[1]
+    spec = tokens[2:]
+    if action == "-I" and spec and spec[0].isdigit():
+        spec = spec[1:]
+
+    return Rule(table, action, chain, tuple(spec),
+                " ".join(shlex.quote(token) for token in tokens))
+
+
+class Ruleset(object):
+    """
+    An index of the output of ``iptables-save`` by table and chain.  The
+    rules in each chain are stored both in order and in a set so
+    membership tests don't scan the chain.
+    """
+    def __init__(self):
+        self.tables = OrderedDict()
+
+    @classmethod
+    def parse(cls, output):
+        ruleset = cls()
+        table = None
+        for line in output.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#") or line == "COMMIT":
+                continue
+
+            if line.startswith("*"):
+                table = ruleset.table(line[1:])
+            elif line.startswith(":"):
+                chain, policy = line[1:].split()[:2]
+                table["chains"][chain] = policy
+                table["rules"].setdefault(chain, [])
+                table["index"].setdefault(chain, set())
+            elif table is not None:
+                rule = parse_rule(line, table=table["name"])
+                ruleset.add(table["name"], rule)
+        return ruleset
+
+    def table(self, name):
+        """Returns the index of table ``name``, creating it if needed"""
+        table = self.tables.get(name)
+        if table is None:
+            table = self.tables[name] = {
+                "name": name, "chains": OrderedDict(), "rules": {},
+                "index": {}}
+        return table
+
+    def add(self, table_name, rule):
+        table = self.table(table_name)
+        table["chains"].setdefault(rule.chain, "-")
+        table["rules"].setdefault(rule.chain, []).append(rule)
+        table["index"].setdefault(rule.chain, set()).add(rule.spec)
+
+    def remove(self, table_name, rule):
+        table = self.table(table_name)
+        rules = table["rules"].get(rule.chain, [])
+        table["rules"][rule.chain] = [
+            existing for existing in rules if existing.spec != rule.spec]
+        table["index"].get(rule.chain, set()).discard(rule.spec)
+
+    def has_chain(self, table_name, chain):
+        return chain in self.tables.get(table_name, {}).get("chains", {})
+
+    def rules(self, table_name, chain):
+        """Returns the rules in ``chain`` in the order they are applied"""
+        return list(
+            self.tables.get(table_name, {}).get("rules", {}).get(chain, []))
+
+    def __contains__(self, rule):
+        if not isinstance(rule, Rule):
+            rule = parse_rule(rule)
+        return rule.spec in self.tables.get(
+            rule.table, {}).get("index", {}).get(rule.chain, ())
+
+
+class Firewall(object):
+    """
+    Manages the iptables rules on a remote host.  The current ruleset
+    is fetched with a single ``iptables-save`` and the rules which are
+    missing are then applied together in one ``iptables-restore
+    --noflush`` call, so either all of the changes are applied or none
+    are.
+
+    >>> firewall = Firewall(ssh)
+    >>> firewall.sync([
+    ...     "-A INPUT -p tcp --dport 22 -j ACCEPT",
+    ...     "-A INPUT -m state --state RELATED,ESTABLISHED -j ACCEPT",
+    ...     "-t nat -A POSTROUTING -o eth0 -j MASQUERADE"])
+
+    :param ssh:
+        The :class:`vpsutil.ssh.SSHClient` to run iptables with.
+    """
+    def __init__(self, ssh):
+        self.ssh = ssh
+        self._ruleset = None
+
+    @property
+    def ruleset(self):
+        if self._ruleset is None:
+            self.load()
+        return self._ruleset
+
+    def load(self):
+        """Fetches and parses the current ruleset"""
+        result = self.ssh.run("iptables-save", echo=False)
+        self._ruleset = Ruleset.parse(result.stdout)
+        return self._ruleset
+
+    def __contains__(self, rule):
+        return rule in self.ruleset
+
+    def plan(self, rules, prune=False):
+        """
+        Returns a :class:`FirewallPlan` of the rules to add in order to
+        reach ``rules``.  With ``prune`` rules found in the chains named
+        by ``rules`` but not in ``rules`` themselves are deleted as well.
+        """
+        ruleset = self.ruleset
+        desired = [rule if isinstance(rule, Rule) else parse_rule(rule)
+                   for rule in rules]
+
+        add, seen = [], set()
+        for rule in desired:
+            key = (rule.table, rule.chain, rule.spec)
+            if key in seen:
+                continue
+            seen.add(key)
+            if rule.action == "-D":
+                if rule in ruleset:
+                    add.append(rule)
+            elif rule not in ruleset:
+                add.append(rule)
+
+        delete = []
+        if prune:
+            chains = set((rule.table, rule.chain) for rule in desired)
+            for table_name, chain in sorted(chains):
+                for rule in ruleset.rules(table_name, chain):
+                    if (table_name, chain, rule.spec) not in seen:
+                        delete.append(rule._replace(
+                            action="-D", text=" ".join(
+                                ["-D"] + rule.text.split(" ", 1)[1:])))
+
+        return FirewallPlan(add, delete)
+
+    def restore_input(self, plan):
+        """Returns the ``iptables-restore`` input which applies ``plan``"""
+        tables = OrderedDict()
+        for rule in plan.delete + plan.add:
+            tables.setdefault(rule.table, []).append(rule)
+
+        lines = []
+        for table_name, rules in tables.items():
+            lines.append("*%s" % table_name)
+
+            # Only new chains are declared, --noflush would still flush
+            # an existing chain which is declared again
+            declared = set()
+            for rule in rules:
+                if rule.chain not in declared \
+                        and rule.chain not in BUILTIN_CHAINS \
+                        and not self.ruleset.has_chain(table_name, rule.chain):
+                    declared.add(rule.chain)
+                    lines.append(":%s - [0:0]" % rule.chain)
+
+            for rule in rules:
+                lines.append(rule.text)
+            lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def apply(self, plan):
+        """Applies ``plan`` with a single ``iptables-restore`` call"""
+        if not plan.add and not plan.delete:
+            return plan
+
+        self.ssh.run(
+            "iptables-restore --noflush", echo=False,
+            stdin=self.restore_input(plan))
+
+        for rule in plan.delete:
+            self._ruleset.remove(rule.table, rule)
+        for rule in plan.add:
+            if rule.action == "-D":
+                self._ruleset.remove(rule.table, rule)
+            else:
+                self._ruleset.add(rule.table, rule)
+        return plan
+
+    def sync(self, rules, prune=False, dry_run=False):
+        """
+        Brings the host's ruleset in line with ``rules`` and returns the
+        :class:`FirewallPlan` which was applied.
+        """
+        plan = self.plan(rules, prune=prune)
+        for rule in plan.delete:
+            logger.info("... delete iptables rule: %s", rule.text)
+        for rule in plan.add:
+            logger.info("... add iptables rule: %s", rule.text)
+
+        if dry_run:
+            return plan
+        return self.apply(plan)
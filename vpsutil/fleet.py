@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from vpsutil.logger import logger
+from vpsutil.ssh import SSHClient
+
+Target = namedtuple("Target", ("user", "host", "key_pair"))
+HostResult = namedtuple("HostResult", ("host", "result", "error", "elapsed"))
+
+
+class FleetAborted(Exception):
+    """Used as the error for hosts skipped after a failure in fail fast mode"""
+
+
+class FleetResult(object):
+    """
+    The aggregated results of :meth:`Fleet.run`.  Iterating yields a
+    :class:`HostResult` for each host in the order the targets were
+    provided.  ``result`` is the host's :class:`vpsutil.ssh.CommandResult`
+    or None if ``error`` is set.
+    """
+    def __init__(self, command, results, elapsed):
+        self.command = command
+        self.results = results
+        self.elapsed = elapsed
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, host):
+        for result in self.results:
+            if result.host == host:
+                return result
+        raise KeyError(host)
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.error is None]
+
+    @property
+    def failed(self):
+        return [result for result in self.results
+                if result.error is not None
+                and not isinstance(result.error, FleetAborted)]
+
+    @property
+    def skipped(self):
+        return [result for result in self.results
+                if isinstance(result.error, FleetAborted)]
+
+    @property
+    def ok(self):
+        return len(self.succeeded) == len(self.results)
+
+
+class Fleet(object):
+    """
+    Runs commands on many hosts at once using :class:`vpsutil.ssh.SSHClient`.
+    Connections are opened lazily by the worker threads and kept open
+    between calls to :meth:`run` until :meth:`close` is called.
+
+    >>> with Fleet([("root", ip, name) for name, ip in hosts]) as fleet:
+    ...     result = fleet.run("apt-get update", timeout=300)
+    ...     for host in result.failed:
+    ...         print(host.host, host.error)
+
+    :param list targets:
+        (user, host, key_pair) tuples, ``key_pair`` is anything
+        :class:`vpsutil.ssh.SSHClient` accepts.
+
+    :param int max_workers:
+        The maximum number of hosts to talk to at once.
+
+    :param float timeout:
+        The default number of seconds a command may run on each host.
+
+    :param bool fail_fast:
+        Stop starting new hosts once one has failed.  Hosts which were
+        never started are reported with a :class:`FleetAborted` error.
+
+    :param int batch_size:
+        When provided hosts are processed in rolling batches of this size,
+        each batch finishing before the next one starts.
+
+    :param bool wait_for_connect:
+        Passed to :class:`vpsutil.ssh.SSHClient`.
+    """
+    def __init__(self, targets, max_workers=16, timeout=None, fail_fast=False,
+                 batch_size=None, wait_for_connect=False):
+        self.targets = [Target(*target) for target in targets]
+        assert len(set(target.host for target in self.targets)) == \
+            len(self.targets), "Duplicate hosts"
+        assert batch_size is None or batch_size > 0
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.fail_fast = fail_fast
+        self.batch_size = batch_size
+        self.wait_for_connect = wait_for_connect
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def client(self, target):
+        """Returns the :class:`vpsutil.ssh.SSHClient` for ``target``"""
+        with self._lock:
+            client = self._clients.get(target.host)
+            if client is None:
+                client = SSHClient(
+                    target.user, target.host, target.key_pair,
+                    wait_for_connect=self.wait_for_connect)
+                self._clients[target.host] = client
+        return client
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+
+        for client in clients:
+            client.close()
+
+    def _run_host(self, target, command, timeout, abort):
+        if abort.is_set():
+            return HostResult(
+                target.host, None, FleetAborted("Skipped after a failure"), 0)
+
+        start = time.time()
+        try:
+            result = self.client(target).run(command, timeout=timeout)
+        except Exception as error:
+            logger.error("%s: %s", target.host, error)
+            if self.fail_fast:
+                abort.set()
+            return HostResult(target.host, None, error, time.time() - start)
+
+        return HostResult(target.host, result, None, time.time() - start)
+
+    def run(self, command, timeout=None, hosts=None):
+        """
+        Runs ``command`` on every target, or only those in ``hosts``, and
+        returns a :class:`FleetResult`.  Errors on individual hosts are
+        captured in the result rather than raised.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        targets = self.targets
+        if hosts is not None:
+            targets = [target for target in targets if target.host in hosts]
+
+        batch_size = self.batch_size or len(targets) or 1
+        batches = [targets[index:index + batch_size]
+                   for index in range(0, len(targets), batch_size)]
+
+        logger.info(
+            "Running on %d host(s) in %d batch(es): %s",
+            len(targets), len(batches), command)
+
+        start = time.time()
+        abort = threading.Event()
+        results = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch in batches:
+                futures = dict(
+                    (executor.submit(
+                        self._run_host, target, command, timeout, abort),
+                     target)
+                    for target in batch)
+
+                # Hosts still queued when another fails in fail fast
+                # mode see the abort event and skip themselves.
+                for future, target in futures.items():
+                    results[target.host] = future.result()
+
+        elapsed = time.time() - start
+        result = FleetResult(
+            command, [results[target.host] for target in targets], elapsed)
+        logger.info(
+            "Finished in %0.2fs: %d succeeded, %d failed, %d skipped",
+            elapsed, len(result.succeeded), len(result.failed),
+            len(result.skipped))
+        return result
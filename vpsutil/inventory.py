@@ -0,0 +1,196 @@
+from itertools import islice
+
+try:
+    from http.client import NOT_FOUND
+except ImportError:
+    from httplib import NOT_FOUND
+
+from requests import HTTPError
+
+from vpsutil.logger import logger
+
+# Fields the inventory can answer directly from an index
+INDEXED_FIELDS = ("id", "name", "ip", "tag", "region")
+
+
+def droplet_keys(droplet, ip_version="v4"):
+    """
+    Returns a dictionary mapping each indexed field to the list of
+    values ``droplet`` should be indexed under.
+    """
+    return {
+        "id": [droplet["id"]],
+        "name": [droplet["name"]],
+        "ip": [address["ip_address"]
+               for address in droplet["networks"][ip_version]
+               if address["type"] == "public"],
+        "tag": list(droplet.get("tags", [])),
+        "region": [droplet["region"]["slug"]]
+    }
+
+
+class Inventory(object):
+    """
+    A snapshot of the account's droplets with hash indexes by id, name,
+    public ip, tag and region.  The droplets are downloaded with a
+    single listing (optionally filtered server side by ``tag_name``)
+    after which :meth:`find_droplet` lookups don't make any requests.
+
+    >>> inventory = do.droplets.inventory()
+    >>> inventory.find_droplet(name="www1")
+    >>> inventory.find_droplet(ip="203.0.113.10")
+
+    :param droplets:
+        The :class:`vpsutil.api.Droplets` instance used to make requests.
+
+    :param string tag_name:
+        Only track droplets with this tag.
+    """
+    def __init__(self, droplets, tag_name=None):
+        self.droplets = droplets
+        self.tag_name = tag_name
+        self._droplets = {}
+        self._indexes = dict((field, {}) for field in INDEXED_FIELDS)
+
+    def __len__(self):
+        return len(self._droplets)
+
+    def __iter__(self):
+        return iter(list(self._droplets.values()))
+
+    def __contains__(self, droplet_id):
+        return droplet_id in self._droplets
+
+    def _fetch(self, cache=False):
+        params = {}
+        if self.tag_name is not None:
+            params.update(tag_name=self.tag_name)
+
+        api = self.droplets
+        return api.paginate(
+            api.URL + "/droplets", "droplets", params=params, cache=cache)
+
+    def add(self, droplet):
+        """Adds or replaces ``droplet`` in the indexes"""
+        self.discard(droplet["id"])
+        self._droplets[droplet["id"]] = droplet
+        for field, values in droplet_keys(droplet).items():
+            index = self._indexes[field]
+            for value in values:
+                index.setdefault(value, set()).add(droplet["id"])
+
+    def discard(self, droplet_id):
+        """Removes the droplet with ``droplet_id`` from the indexes"""
+        droplet = self._droplets.pop(droplet_id, None)
+        if droplet is None:
+            return
+
+        for field, values in droplet_keys(droplet).items():
+            index = self._indexes[field]
+            for value in values:
+                ids = index.get(value)
+                if ids is None:
+                    continue
+                ids.discard(droplet_id)
+                if not ids:
+                    del index[value]
+
+    def load(self):
+        """Replaces the contents of the inventory with a fresh listing"""
+        logger.info("Loading droplet inventory (tag: %s)", self.tag_name)
+        self._droplets.clear()
+        for index in self._indexes.values():
+            index.clear()
+
+        for droplet in self._fetch():
+            self.add(droplet)
+        return self
+
+    def refresh(self, droplet_ids=None):
+        """
+        Brings the inventory up to date and returns the sets of added,
+        changed and removed droplet ids.  Only droplets which actually
+        changed are re-indexed.  When ``droplet_ids`` is provided only
+        those droplets are fetched, otherwise the listing is revalidated
+        with a conditional request where the cache allows it.
+        """
+        added, changed, removed = set(), set(), set()
+
+        if droplet_ids is not None:
+            for droplet_id in droplet_ids:
+                try:
+                    droplet = self.droplets.get_droplet(droplet_id)
+                except HTTPError as error:
+                    if error.response.status_code != NOT_FOUND:
+                        raise
+                    if droplet_id in self._droplets:
+                        self.discard(droplet_id)
+                        removed.add(droplet_id)
+                    continue
+
+                self._update(droplet, added, changed)
+            return added, changed, removed
+
+        seen = set()
+        for droplet in self._fetch(cache=True):
+            seen.add(droplet["id"])
+            self._update(droplet, added, changed)
+
+        for droplet_id in set(self._droplets) - seen:
+            self.discard(droplet_id)
+            removed.add(droplet_id)
+
+        logger.debug(
+            "... inventory refreshed: %d added, %d changed, %d removed",
+            len(added), len(changed), len(removed))
+        return added, changed, removed
+
+    def _update(self, droplet, added, changed):
+        current = self._droplets.get(droplet["id"])
+        if current is None:
+            added.add(droplet["id"])
+        elif current != droplet:
+            changed.add(droplet["id"])
+        else:
+            return
+        self.add(droplet)
+
+    def find_droplets(self, **fields):
+        """
+        Generator which yields droplets matching all ``fields``.  Indexed
+        fields (``id``, ``name``, ``ip``, ``tag`` and ``region``) are
+        answered from the indexes, any other fields are compared against
+        the candidates.
+        """
+        candidates = None
+        for field in INDEXED_FIELDS:
+            if field not in fields:
+                continue
+
+            ids = self._indexes[field].get(fields[field], set())
+            candidates = ids if candidates is None else candidates & ids
+
+        if candidates is None:
+            candidates = list(self._droplets)
+
+        remaining = dict(
+            (key, value) for key, value in fields.items()
+            if key not in INDEXED_FIELDS)
+
+        for droplet_id in sorted(candidates):
+            droplet = self._droplets[droplet_id]
+            for key, value in remaining.items():
+                if key not in droplet:
+                    raise KeyError("No such key %s" % key)
+                if droplet[key] != value:
+                    break
+            else:
+                yield droplet
+
+    def find_droplet(self, **fields):
+        droplets = list(islice(self.find_droplets(**fields), 2))
+        if not droplets:
+            return
+        if len(droplets) > 1:
+            raise ValueError("Found multiple droplets matching %s" % fields)
+        return droplets[0]
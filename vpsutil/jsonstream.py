@@ -0,0 +1,123 @@
+import codecs
+import json
+
+WHITESPACE = " \t\n\r"
+
+_decoder = json.JSONDecoder()
+
+
+class _Buffer(object):
+    """
+    Text decoded from an iterable of byte ``chunks`` which is read on
+    demand.  Consumed text is dropped so the buffer only ever holds the
+    value being decoded plus one chunk.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.position = 0
+        self.eof = False
+
+    def read(self):
+        """Appends the next chunk, returns False at the end of the input"""
+        if self.eof:
+            return False
+
+        if self.position:
+            self.text = self.text[self.position:]
+            self.position = 0
+
+        for chunk in self.chunks:
+            if chunk:
+                self.text += self.decoder.decode(chunk)
+                return True
+
+        self.text += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character, "" at the end"""
+        while True:
+            text, position = self.text, self.position
+            while position < len(text) and text[position] in WHITESPACE:
+                position += 1
+            self.position = position
+            if position < len(text):
+                return text[position]
+            if not self.read():
+                return ""
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(
+                "Expected one of %r at offset %d, found %r" % (
+                    characters, self.position, character))
+        self.position += 1
+        return character
+
+    def value(self):
+        """Decodes and returns the next complete json value"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.position)
+            except ValueError:
+                if not self.read():
+                    raise
+                continue
+
+            # A number (or literal) which ends with the buffer may
+            # continue in the next chunk.
+            if end == len(self.text) and not self.eof:
+                self.read()
+                continue
+
+            self.position = end
+            return value
+
+
+def iter_items(chunks, key, rest=None):
+    """
+    Generator which incrementally decodes a json object from the byte
+    ``chunks`` and yields each element of the list under ``key`` as
+    soon as it has been parsed, so the whole document is never held in
+    memory.  Every other top level value is decoded into ``rest``.
+
+    >>> links = {}
+    >>> for droplet in iter_items(
+    ...         response.iter_content(65536), "droplets", links):
+    ...     print(droplet["name"])
+    >>> links["links"]
+    """
+    if rest is None:
+        rest = {}
+
+    stream = _Buffer(chunks)
+    stream.expect("{")
+    if stream.peek() == "}":
+        stream.position += 1
+        return
+
+    while True:
+        name = stream.value()
+        if not isinstance(name, str):
+            raise ValueError("Expected an object key, found %r" % (name, ))
+        stream.expect(":")
+
+        if name == key and stream.peek() == "[":
+            stream.position += 1
+            if stream.peek() == "]":
+                stream.position += 1
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            rest[name] = stream.value()
+
+        if stream.expect(",}") == "}":
+            return
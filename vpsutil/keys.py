@@ -0,0 +1,172 @@
+import os
+import threading
+from os.path import join
+
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    from Queue import Empty, Full, Queue
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+from vpsutil.logger import logger
+
+# key type -> (file name, default bits)
+KEY_TYPES = {
+    "rsa": ("id_rsa", 2048),
+    "ecdsa": ("id_ecdsa", 256),
+    "ed25519": ("id_ed25519", None)
+}
+
+# The order get_key_pair() looks for private keys in
+KEY_FILES = ("id_rsa", "id_ed25519", "id_ecdsa")
+
+ECDSA_CURVES = {
+    256: ec.SECP256R1,
+    384: ec.SECP384R1,
+    521: ec.SECP521R1
+}
+
+
+def generate_private_key(key_type="rsa", bits=None):
+    """
+    Generates and returns a private key of ``key_type``.  ``bits`` is the
+    modulus size for RSA keys and the curve size (256, 384 or 521) for
+    ECDSA keys.  Ed25519 keys have a fixed size and ignore ``bits``.
+    """
+    if key_type not in KEY_TYPES:
+        raise ValueError("Unknown key type %r" % key_type)
+
+    if bits is None:
+        bits = KEY_TYPES[key_type][1]
+
+    if key_type == "rsa":
+        return rsa.generate_private_key(
+            public_exponent=65537, key_size=bits, backend=default_backend())
+
+    if key_type == "ecdsa":
+        if bits not in ECDSA_CURVES:
+            raise ValueError(
+                "ECDSA keys must be one of %s bits" % sorted(ECDSA_CURVES))
+        return ec.generate_private_key(
+            ECDSA_CURVES[bits](), backend=default_backend())
+
+    return ed25519.Ed25519PrivateKey.generate()
+
+
+def serialize_key(private_key):
+    """
+    Returns the private key, in a format OpenSSH and paramiko can read,
+    and the OpenSSH public key line for ``private_key``.  The public key
+    is derived from the key in memory.
+    """
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        private_format = serialization.PrivateFormat.OpenSSH
+    else:
+        private_format = serialization.PrivateFormat.TraditionalOpenSSL
+
+    private = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM, format=private_format,
+        encryption_algorithm=serialization.NoEncryption())
+    public = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.OpenSSH,
+        format=serialization.PublicFormat.OpenSSH)
+    return private, public
+
+
+def write_key_pair(output_dir, key_type, private_key):
+    """
+    Writes ``private_key`` and its public half to ``output_dir`` and
+    returns the paths to the (public, private) files.
+    """
+    private, public = serialize_key(private_key)
+    private_file = join(output_dir, KEY_TYPES[key_type][0])
+    public_file = private_file + ".pub"
+
+    descriptor = os.open(
+        private_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as stream:
+        stream.write(private)
+
+    with open(public_file, "wb") as stream:
+        stream.write(public)
+
+    return public_file, private_file
+
+
+class KeyPool(object):
+    """
+    Keeps up to ``size`` private keys generated ahead of time by a
+    background thread so that provisioning a host can claim a key
+    without waiting for one to be generated.  Keys only live in memory
+    until they are claimed.
+
+    >>> pool = KeyPool("rsa", bits=4096, size=8)
+    >>> SSHClient.generate_key_pair(name="www1", key_type="rsa", pool=pool)
+
+    :param string key_type:
+        One of ``rsa``, ``ecdsa`` or ``ed25519``.
+
+    :param int bits:
+        Passed to :func:`generate_private_key`.
+
+    :param int size:
+        The number of keys to keep ready.
+    """
+    def __init__(self, key_type="ed25519", bits=None, size=4):
+        assert size > 0
+        if key_type not in KEY_TYPES:
+            raise ValueError("Unknown key type %r" % key_type)
+
+        self.key_type = key_type
+        self.bits = bits
+        self.size = size
+        self._keys = Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._fill, name="vpsutil-key-pool")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return self._keys.qsize()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _fill(self):
+        while not self._stop.is_set():
+            key = generate_private_key(self.key_type, self.bits)
+            while not self._stop.is_set():
+                try:
+                    self._keys.put(key, timeout=0.5)
+                    break
+                except Full:
+                    continue
+
+    def claim(self):
+        """
+        Returns a private key from the pool, generating one on the spot
+        if the pool has run dry.
+        """
+        try:
+            return self._keys.get_nowait()
+        except Empty:
+            logger.debug(
+                "Key pool is empty, generating a %s key", self.key_type)
+            return generate_private_key(self.key_type, self.bits)
+
+    def close(self):
+        """Stops the background thread and drops any unclaimed keys"""
+        self._stop.set()
+        self._thread.join()
+        while True:
+            try:
+                self._keys.get_nowait()
+            except Empty:
+                break
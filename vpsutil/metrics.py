@@ -0,0 +1,276 @@
+import bisect
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Path segments replaced with a placeholder so requests for different
+# objects are counted under the same endpoint
+NUMERIC = re.compile(r"^\d+$")
+NAMED_SEGMENTS = {"domains": "{domain}", "tags": "{tag}"}
+
+
+def endpoint_template(path, root="/v2"):
+    """
+    Returns the template of the API ``path`` with ids and names replaced
+    by placeholders (ex. ``/v2/droplets/123/actions`` becomes
+    ``/droplets/{id}/actions``)
+    """
+    if path.startswith(root):
+        path = path[len(root):]
+
+    segments = path.strip("/").split("/")
+    template = []
+    previous = None
+    for segment in segments:
+        if NUMERIC.match(segment):
+            segment = "{id}"
+        elif previous in NAMED_SEGMENTS:
+            segment = NAMED_SEGMENTS[previous]
+        template.append(segment)
+        previous = segment
+    return "/" + "/".join(template)
+
+
+class Span(object):
+    """
+    A single request as seen by :class:`Metrics`.  Span hooks receive
+    the same object when the request starts and when it finishes, the
+    ``context`` attribute is free for hooks to store their own state in
+    (ex. a tracing span).
+    """
+    __slots__ = ("method", "url", "endpoint", "stream", "start", "end",
+                 "status", "bytes", "retries", "cached", "error", "context")
+
+    def __init__(self, method, url, endpoint, stream=False):
+        self.method = method
+        self.url = url
+        self.endpoint = endpoint
+        self.stream = stream
+        self.start = time.time()
+        self.end = None
+        self.status = None
+        self.bytes = 0
+        self.retries = 0
+        self.cached = False
+        self.error = None
+        self.context = None
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+
+class EndpointStats(object):
+    """The totals for one (method, endpoint template) pair"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.histogram = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.cached = 0
+        self.errors = 0
+        self.statuses = Counter()
+
+    def observe(self, span):
+        duration = span.duration
+        self.count += 1
+        self.seconds += duration
+        self.histogram[bisect.bisect_left(self.buckets, duration)] += 1
+        self.bytes += span.bytes
+        self.retries += span.retries
+        if span.cached:
+            self.cached += 1
+        if span.error is not None:
+            self.errors += 1
+        else:
+            self.statuses[span.status] += 1
+
+    def snapshot(self):
+        cumulative, buckets = 0, {}
+        for bound, count in zip(
+                [str(bound) for bound in self.buckets] + ["+Inf"],
+                self.histogram):
+            cumulative += count
+            buckets[bound] = cumulative
+
+        return {
+            "count": self.count,
+            "seconds": self.seconds,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "cached": self.cached,
+            "errors": self.errors,
+            "statuses": dict(
+                (str(status), count)
+                for status, count in sorted(self.statuses.items())),
+            "latency_buckets": buckets
+        }
+
+
+def _label(value):
+    return str(value).replace(
+        "\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics(object):
+    """
+    Records the count, latency histogram, response bytes, retries and
+    status codes of API requests for each endpoint template.  Install an
+    instance on :attr:`vpsutil.api.Base.instrumentation` (or on a single
+    session) to start recording, when that's None requests are not
+    instrumented at all.
+
+    >>> metrics = Metrics()
+    >>> Base.instrumentation = metrics
+    >>> do.droplets.find_droplet(name="www1")
+    >>> print(metrics.prometheus())
+    >>> metrics.snapshot()["GET /droplets"]["count"]
+    1
+
+    Tracing can be added with :meth:`add_hook`, each hook is called as
+    ``hook("start", span)`` before the request and ``hook("finish",
+    span)`` once it completes.
+
+    :param tuple buckets:
+        The upper bounds, in seconds, of the latency histogram buckets.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS, prefix="vpsutil_http"):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.hooks = []
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def start(self, method, url, stream=False):
+        """
+        Returns a new :class:`Span` for a request which is starting,
+        ``stream`` is the request's own flag.
+        """
+        span = Span(method.upper(), url,
+                    endpoint_template(urlsplit(url).path), stream=stream)
+        self._local.span = span
+        for hook in self.hooks:
+            hook("start", span)
+        return span
+
+    def retry(self):
+        """Records a retry of the current thread's request"""
+        span = getattr(self._local, "span", None)
+        if span is not None:
+            span.retries += 1
+
+    def finish(self, span, response=None, error=None):
+        """Records the outcome of ``span``"""
+        span.end = time.time()
+        self._local.span = None
+        if response is not None:
+            span.status = response.status_code
+            span.cached = getattr(response, "from_cache", False)
+            if not span.cached:
+                if span.stream:
+                    # The body of a streamed response is only read once
+                    # the caller iterates over it, use the declared length.
+                    span.bytes = int(
+                        response.headers.get("Content-Length", 0))
+                else:
+                    span.bytes = len(response.content or b"")
+        span.error = error
+
+        key = (span.method, span.endpoint)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = EndpointStats(self.buckets)
+            stats.observe(span)
+
+        for hook in self.hooks:
+            hook("finish", span)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self):
+        """
+        Returns a dictionary of ``"METHOD /endpoint"`` to that endpoint's
+        totals which can be serialized as json.
+        """
+        with self._lock:
+            return dict(
+                ("%s %s" % key, stats.snapshot())
+                for key, stats in sorted(self._stats.items()))
+
+    def json(self, **kwargs):
+        return json.dumps(self.snapshot(), sort_keys=True, **kwargs)
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            items = sorted(
+                (key, stats.snapshot()) for key, stats in self._stats.items())
+
+        prefix = self.prefix
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+
+        def labels(method, endpoint, **extra):
+            pairs = [("method", method), ("endpoint", endpoint)]
+            pairs.extend(sorted(extra.items()))
+            return "{%s}" % ",".join(
+                "%s=\"%s\"" % (key, _label(value)) for key, value in pairs)
+
+        metric("requests_total", "counter", "API requests by status code")
+        for (method, endpoint), stats in items:
+            for status, count in stats["statuses"].items():
+                lines.append("%s_requests_total%s %d" % (
+                    prefix, labels(method, endpoint, status=status), count))
+
+        metric("request_duration_seconds", "histogram",
+               "API request latency")
+        for (method, endpoint), stats in items:
+            for bound, count in stats["latency_buckets"].items():
+                lines.append("%s_request_duration_seconds_bucket%s %d" % (
+                    prefix, labels(method, endpoint, le=bound), count))
+            lines.append("%s_request_duration_seconds_sum%s %f" % (
+                prefix, labels(method, endpoint), stats["seconds"]))
+            lines.append("%s_request_duration_seconds_count%s %d" % (
+                prefix, labels(method, endpoint), stats["count"]))
+
+        for name, key, help_text in (
+                ("response_bytes_total", "bytes",
+                 "Response body bytes received from the API"),
+                ("retries_total", "retries",
+                 "Requests retried after being rate limited"),
+                ("cache_hits_total", "cached",
+                 "Responses served or revalidated from the HTTP cache"),
+                ("errors_total", "errors",
+                 "Requests which failed without a response")):
+            metric(name, "counter", help_text)
+            for (method, endpoint), stats in items:
+                lines.append("%s_%s%s %d" % (
+                    prefix, name, labels(method, endpoint), stats[key]))
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,293 @@
+import json
+from collections import OrderedDict
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+# Strings up to this length are interned, longer ones (public keys, user
+# data, descriptions) are rarely repeated
+INTERN_LENGTH = 64
+
+
+class _Missing(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+# The most recently used shared instances, keyed by their class,
+# identity and VERSION fields, and shared tuples, keyed by their values.
+# Both are bounded so a long running process listing changing objects
+# doesn't keep every version it has ever seen.
+SHARED_LIMIT = 1024
+_shared = OrderedDict()
+_tuples = OrderedDict()
+
+
+def _remember(cache, key, value):
+    """
+    Returns the value cached under ``key``, caching ``value`` first if
+    there is none, and drops the least recently used entry once the
+    cache holds more than ``SHARED_LIMIT`` entries.
+    """
+    cached = cache.pop(key, None)
+    if cached is None:
+        cached = value() if callable(value) else value
+    cache[key] = cached
+    if len(cache) > SHARED_LIMIT:
+        cache.popitem(last=False)
+    return cached
+
+
+def compact(value):
+    """
+    Returns a compact equivalent of the decoded json ``value``: short
+    strings are interned and lists of scalars become shared tuples.
+    """
+    if isinstance(value, str):
+        return intern(value) if len(value) <= INTERN_LENGTH else value
+
+    if isinstance(value, list) and not any(
+            isinstance(item, (dict, list)) for item in value):
+        values = tuple(compact(item) for item in value)
+        return _remember(_tuples, values, values)
+
+    return value
+
+
+def dumps(data):
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+class Model(Mapping):
+    """
+    A read only, dictionary compatible view of an API object which
+    stores ``FIELDS`` in slots instead of a dictionary.  ``droplet["name"]``
+    and ``droplet.name`` are equivalent.  Any other keys are kept as
+    compact json and decoded on demand, :attr:`raw` rebuilds the
+    original object.
+
+    Nested objects named in ``NESTED`` are converted to their own model,
+    models with ``SHARED`` set are deduplicated by their ``id`` (or
+    ``slug``) and ``VERSION`` fields so every droplet in the same region
+    refers to the same :class:`Region`.
+
+    :param dict data:
+        The decoded json object.
+
+    :param bool keep_extra:
+        Keep the keys outside ``FIELDS``.  Nested models which are fully
+        described by their ``FIELDS`` don't need to.
+    """
+    __slots__ = ("_extra",)
+    FIELDS = ()
+    NESTED = {}
+    SHARED = False
+    VERSION = ()
+
+    def __init__(self, data, keep_extra=True):
+        extra = None
+        if keep_extra:
+            extra = dict(
+                (key, value) for key, value in data.items()
+                if key not in self.FIELDS)
+        self._extra = dumps(extra) if extra else None
+
+        for field in self.FIELDS:
+            value = data.get(field, MISSING)
+            model = self.NESTED.get(field)
+            if value is MISSING or value is None:
+                pass
+            elif model is not None and isinstance(value, list):
+                value = tuple(model.from_json(item) for item in value)
+            elif model is not None:
+                value = model.from_json(value)
+            else:
+                value = compact(value)
+            setattr(self, field, value)
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Returns a model for ``data``.  When ``SHARED`` is set it's shared
+        with any recent object which had the same identity and the same
+        ``VERSION`` fields.
+        """
+        if isinstance(data, cls):
+            return data
+
+        identity = data.get("id", data.get("slug")) if cls.SHARED else None
+        if identity is None:
+            return cls(data, keep_extra=not issubclass(cls, Nested))
+
+        key = (cls, identity) + tuple(
+            compact(data.get(field)) for field in cls.VERSION)
+        return _remember(_shared, key, lambda: cls(data))
+
+    @property
+    def extra(self):
+        """A new dictionary of the keys outside ``FIELDS``"""
+        return json.loads(self._extra) if self._extra is not None else {}
+
+    @property
+    def raw(self):
+        """A new dictionary of the original json"""
+        data = self.extra
+        data.update((key, _plain(value)) for key, value in self._fields())
+        return data
+
+    def _fields(self):
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not MISSING:
+                yield field, value
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is MISSING:
+                raise KeyError(key)
+            return list(value) if isinstance(value, tuple) else value
+        return self.extra[key]
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key) is not MISSING
+        return key in self.extra
+
+    def __iter__(self):
+        for field, _ in self._fields():
+            yield field
+        for key in self.extra:
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is type(self):
+            return all(
+                getattr(self, slot) == getattr(other, slot)
+                for slot in _slots(type(self)))
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.raw == _plain(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in _slots(type(self)))
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, " ".join(
+            "%s=%r" % (field, value) for field, value in
+            list(self._fields())[:2]))
+
+
+def _slots(cls):
+    for klass in cls.__mro__:
+        for slot in getattr(klass, "__slots__", ()):
+            yield slot
+
+
+def _plain(value):
+    if isinstance(value, Model):
+        return value.raw
+    if isinstance(value, Mapping):
+        return dict((key, _plain(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+class Nested(Model):
+    """A model which only exists inside another object"""
+    __slots__ = ()
+
+
+class Region(Model):
+    __slots__ = ("slug", "name", "available", "features", "sizes")
+    FIELDS = __slots__
+    SHARED = True
+    VERSION = ("name", "available", "features", "sizes")
+
+
+class Size(Model):
+    __slots__ = ("slug", "memory", "vcpus", "disk", "transfer",
+                 "price_monthly", "price_hourly", "available", "regions",
+                 "description")
+    FIELDS = __slots__
+    SHARED = True
+    VERSION = ("available", "regions", "price_monthly", "price_hourly")
+
+
+class Image(Model):
+    __slots__ = ("id", "name", "distribution", "slug", "public", "regions",
+                 "created_at", "type", "min_disk_size", "size_gigabytes",
+                 "description", "status", "tags")
+    FIELDS = __slots__
+    SHARED = True
+    VERSION = ("name", "status", "regions", "created_at")
+
+
+class Address(Nested):
+    __slots__ = ("ip_address", "netmask", "gateway", "type")
+    FIELDS = __slots__
+
+
+class Networks(Nested):
+    __slots__ = ("v4", "v6")
+    FIELDS = __slots__
+    NESTED = {"v4": Address, "v6": Address}
+
+
+class Droplet(Model):
+    __slots__ = ("id", "name", "memory", "vcpus", "disk", "locked",
+                 "status", "created_at", "features", "backup_ids",
+                 "snapshot_ids", "volume_ids", "size_slug", "tags",
+                 "vpc_uuid", "region", "image", "size", "networks")
+    FIELDS = __slots__
+    NESTED = {"region": Region, "image": Image, "size": Size,
+              "networks": Networks}
+
+
+class DomainRecord(Model):
+    __slots__ = ("id", "type", "name", "data", "priority", "port", "ttl",
+                 "weight", "flags", "tag")
+    FIELDS = __slots__
+
+
+class SSHKey(Model):
+    __slots__ = ("id", "fingerprint", "public_key", "name")
+    FIELDS = __slots__
+
+
+# The model used for the objects under each key of a list response
+MODELS = {
+    "droplets": Droplet,
+    "images": Image,
+    "domain_records": DomainRecord,
+    "ssh_keys": SSHKey,
+    "regions": Region,
+    "sizes": Size,
+}
@@ -0,0 +1,222 @@
+import random
+from collections import Counter, OrderedDict
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from vpsutil.logger import logger
+
+SPREAD = "spread"
+PACK = "pack"
+ANTI_AFFINITY = "anti-affinity"
+PREFERRED = "preferred"
+RANDOM = "random"
+POLICIES = (SPREAD, PACK, ANTI_AFFINITY, PREFERRED, RANDOM)
+
+# Policies which need to know where the fleet already runs
+USAGE_POLICIES = (SPREAD, PACK, ANTI_AFFINITY)
+
+
+class RegionTable(object):
+    """
+    The available regions indexed by size, feature and image, built
+    once from the ``/regions`` and ``/images`` listings so choosing a
+    region for any number of droplets doesn't make further requests.
+
+    >>> table = do.search.region_table()
+    >>> table.candidates("s-1vcpu-1gb", features=["metadata"],
+    ...                  image="ubuntu-24-04-x64", slug_prefixes=["nyc"])
+    ['nyc1', 'nyc3']
+
+    :param list regions:
+        The regions as returned by the API.
+
+    :param list images:
+        The images (typically the public distributions) as returned by
+        the API.
+    """
+    def __init__(self, regions, images=()):
+        self.regions = OrderedDict()
+        self.sizes = {}
+        self.features = {}
+        self.images = list(images)
+        self._images = {}
+
+        for region in regions:
+            if not region["available"]:
+                logger.debug("... %s - not available", region["slug"])
+                continue
+
+            slug = region["slug"]
+            self.regions[slug] = region
+            for size in region["sizes"]:
+                self.sizes.setdefault(size, set()).add(slug)
+            for feature in region["features"]:
+                self.features.setdefault(feature, set()).add(slug)
+
+        for image in self.images:
+            self._images[image["id"]] = image
+            if image.get("slug"):
+                self._images[image["slug"]] = image
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __contains__(self, slug):
+        return slug in self.regions
+
+    def image(self, key):
+        """Returns the image with the id or slug ``key``, None if unknown"""
+        return self._images.get(key)
+
+    def candidates(self, size, features=None, image=None, slug_prefixes=None):
+        """
+        Returns the slugs, in catalog order, of the regions supporting
+        ``size`` and all ``features`` whose slug starts with one of
+        ``slug_prefixes``.  When ``image`` (an image, or its id or slug)
+        is provided the region must also carry that image.
+        """
+        slugs = set(self.sizes.get(size, ()))
+        for feature in features or ():
+            slugs &= self.features.get(feature, set())
+
+        if image is not None:
+            if not isinstance(image, Mapping):
+                image = self.image(image)
+            slugs &= set(image["regions"] if image is not None else ())
+
+        return [
+            slug for slug in self.regions if slug in slugs and (
+                not slug_prefixes or
+                any(slug.startswith(prefix) for prefix in slug_prefixes))]
+
+
+class Placement(object):
+    """
+    Chooses the region for new droplets from a :class:`RegionTable`
+    according to ``policy``:
+
+    * ``spread`` - the candidate with the fewest droplets in ``usage``
+    * ``pack`` - the candidate with the most droplets in ``usage``
+    * ``anti-affinity`` - a candidate with no droplets in ``usage``,
+      typically the droplets sharing a tag, falling back to ``spread``
+      once every candidate is taken unless ``strict`` is set
+    * ``preferred`` - the first candidate in ``preferred``
+    * ``random`` - any candidate
+
+    Ties are broken by the ``preferred`` order and then at random, or by
+    the catalog order for ``pack``.  Every region chosen is added to ``usage`` so a placement can
+    schedule a whole group of droplets by itself.
+
+    >>> placement = do.droplets.placement(policy="anti-affinity", tag="db")
+    >>> placement.schedule(3, "s-1vcpu-1gb", image="ubuntu-24-04-x64")
+    ['nyc1', 'nyc3', 'sfo2']
+
+    :param RegionTable table:
+        The regions to choose from.
+
+    :param dict usage:
+        Maps region slugs to the number of droplets already running
+        there.
+
+    :param list preferred:
+        Region slugs in order of preference.
+
+    :param list slug_prefixes:
+        Only consider regions whose slug starts with one of these.
+    """
+    def __init__(self, table, policy=SPREAD, usage=None, preferred=None,
+                 slug_prefixes=None, strict=False):
+        if policy not in POLICIES:
+            raise ValueError(
+                "Unknown placement policy %r, expected one of %s" % (
+                    policy, ", ".join(POLICIES)))
+
+        self.table = table
+        self.policy = policy
+        self.usage = Counter(usage or {})
+        self.preferred = list(preferred or [])
+        self.slug_prefixes = slug_prefixes
+        self.strict = strict
+        self._order = dict(
+            (slug, index) for index, slug in enumerate(table))
+
+    def candidates(self, size, image=None, features=None):
+        return self.table.candidates(
+            size, features=features, image=image,
+            slug_prefixes=self.slug_prefixes)
+
+    def _preference(self, slug):
+        try:
+            return self.preferred.index(slug)
+        except ValueError:
+            return len(self.preferred)
+
+    def _rank(self, slug):
+        return self._preference(slug), self._order[slug]
+
+    def _spread(self, slugs):
+        # Ties are broken at random rather than by catalog order,
+        # otherwise droplets placed without any usage (untagged single
+        # creates) would all land in the first region.
+        def key(slug):
+            return self.usage[slug], self._preference(slug)
+
+        lowest = min(map(key, slugs))
+        return random.choice([slug for slug in slugs if key(slug) == lowest])
+
+    def select(self, candidates):
+        """Returns the region ``policy`` picks out of ``candidates``"""
+        if not candidates:
+            raise ValueError("No region to choose from")
+
+        if self.policy == RANDOM:
+            return random.choice(candidates)
+
+        if self.policy == PACK:
+            return min(
+                candidates,
+                key=lambda slug: (-self.usage[slug], self._rank(slug)))
+
+        if self.policy == PREFERRED:
+            for slug in self.preferred:
+                if slug in candidates:
+                    return slug
+            return self._spread(candidates)
+
+        if self.policy == ANTI_AFFINITY:
+            free = [slug for slug in candidates if not self.usage[slug]]
+            if not free and self.strict:
+                raise ValueError(
+                    "Every region in %s is already in use" % candidates)
+            return self._spread(free or candidates)
+
+        return self._spread(candidates)
+
+    def choose(self, size, image=None, features=None):
+        """
+        Returns the region slug for one droplet of ``size`` and records
+        it in ``usage``.
+        """
+        candidates = self.candidates(size, image=image, features=features)
+        if not candidates:
+            raise ValueError(
+                "No region supports %s with features %s" % (
+                    size, features or "any"))
+
+        slug = self.select(candidates)
+        self.usage[slug] += 1
+        logger.debug(
+            "... %s placed %s in %s (candidates: %s)",
+            self.policy, size, slug, candidates)
+        return slug
+
+    def schedule(self, count, size, image=None, features=None):
+        """Returns the region slug for each of ``count`` droplets"""
+        return [self.choose(size, image=image, features=features)
+                for _ in range(count)]
@@ -0,0 +1,208 @@
+import errno
+import selectors
+import socket
+import time
+
+from vpsutil.logger import logger
+from vpsutil.waiter import Backoff
+
+
+class _Host(object):
+    __slots__ = ("host", "address", "backoff", "sock", "buffer",
+                 "next_attempt", "attempt_deadline", "attempts")
+
+    def __init__(self, host, address, backoff):
+        self.host = host
+        self.address = address
+        self.backoff = backoff
+        self.sock = None
+        self.buffer = b""
+        self.next_attempt = 0
+        self.attempt_deadline = None
+        self.attempts = 0
+
+
+class ReadinessProber(object):
+    """
+    Waits for many hosts to start accepting SSH connections from a
+    single thread.  Each host is probed with a non-blocking TCP connect
+    followed by a check for the ``SSH-`` protocol banner, failed probes
+    are retried after a short delay which grows with each failure.
+
+    >>> prober = ReadinessProber([ip for ip in addresses])
+    >>> prober.wait(timeout=300)
+    {'203.0.113.10': 41.2, ...}
+
+    :param list hosts:
+        Host names or addresses to probe.
+
+    :param int port:
+        The port sshd listens on.
+
+    :param float connect_timeout:
+        How long each probe may take to connect and send its banner.
+
+    :param float initial:
+        The delay before retrying a host after its first failure.
+
+    :param float maximum:
+        The largest delay between retries.
+    """
+    def __init__(self, hosts, port=22, connect_timeout=3.0, initial=0.25,
+                 maximum=5.0):
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.initial = initial
+        self.maximum = maximum
+        self.hosts = list(hosts)
+
+    def _start(self, state, selector, now):
+        # Hosts are resolved by their probes, so a name whose record
+        # was only just created is retried like a host which isn't
+        # listening yet instead of failing every other host.
+        if state.address is None:
+            try:
+                state.address = socket.getaddrinfo(
+                    state.host, self.port, 0, socket.SOCK_STREAM)[0]
+            except socket.gaierror as error:
+                state.attempts += 1
+                self._retry(state, selector, now)
+                logger.debug("... %s not resolved: %s", state.host, error)
+                return
+
+        family, socktype, proto, _, address = state.address
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(False)
+        state.attempts += 1
+        state.buffer = b""
+        state.sock = sock
+        state.attempt_deadline = now + self.connect_timeout
+
+        error = sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._retry(state, selector, now, os_error=error)
+            return
+
+        selector.register(sock, selectors.EVENT_WRITE, state)
+
+    def _retry(self, state, selector, now, os_error=None):
+        if state.sock is not None:
+            try:
+                selector.unregister(state.sock)
+            except (KeyError, ValueError):
+                pass
+            state.sock.close()
+            state.sock = None
+
+        state.attempt_deadline = None
+        state.next_attempt = now + state.backoff.delay()
+        if os_error is not None:
+            logger.debug(
+                "... %s not ready: %s", state.host, errno.errorcode.get(
+                    os_error, os_error))
+
+    def _handle(self, state, selector, events, now):
+        """Returns True once ``state`` has sent its SSH banner"""
+        if events & selectors.EVENT_WRITE:
+            error = state.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._retry(state, selector, now, os_error=error)
+                return False
+            selector.modify(state.sock, selectors.EVENT_READ, state)
+            return False
+
+        try:
+            data = state.sock.recv(256)
+        except (OSError, IOError) as error:
+            self._retry(state, selector, now, os_error=error.errno)
+            return False
+
+        if not data:
+            self._retry(state, selector, now)
+            return False
+
+        state.buffer += data
+        if state.buffer.startswith(b"SSH-"):
+            return True
+
+        # Some servers send other lines before the banner
+        if b"\nSSH-" in state.buffer:
+            return True
+        if len(state.buffer) > 8192:
+            self._retry(state, selector, now)
+        return False
+
+    def wait(self, timeout=None):
+        """
+        Probes until every host is ready and returns a dictionary of
+        host to the number of seconds it took.  :class:`TimeoutError` is
+        raised if some hosts are still not ready after ``timeout`` seconds.
+        """
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        pending = []
+        for host in self.hosts:
+            pending.append(_Host(host, None, Backoff(
+                initial=self.initial, maximum=self.maximum, jitter=0.1)))
+
+        ready = {}
+        selector = selectors.DefaultSelector()
+        try:
+            while pending:
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    raise TimeoutError(
+                        "Hosts not ready after %s seconds: %s" % (
+                            timeout, ", ".join(
+                                state.host for state in pending)))
+
+                # Start new probes and expire the ones taking too long
+                wake = deadline
+                for state in pending:
+                    if state.sock is None and state.next_attempt <= now:
+                        self._start(state, selector, now)
+
+                    if (state.attempt_deadline is not None
+                            and state.attempt_deadline <= now):
+                        self._retry(state, selector, now)
+
+                    when = state.attempt_deadline \
+                        if state.sock is not None else state.next_attempt
+                    wake = when if wake is None else min(wake, when)
+
+                if not selector.get_map():
+                    time.sleep(max(0, wake - time.time()))
+                    continue
+
+                events = selector.select(max(0, wake - time.time()))
+                now = time.time()
+                for key, mask in events:
+                    state = key.data
+                    if state.sock is None:
+                        continue
+                    if self._handle(state, selector, mask, now):
+                        selector.unregister(state.sock)
+                        state.sock.close()
+                        state.sock = None
+                        ready[state.host] = now - start
+                        logger.debug(
+                            "... %s ready after %0.2fs (%d probes)",
+                            state.host, now - start, state.attempts)
+
+                pending = [
+                    state for state in pending if state.host not in ready]
+        finally:
+            for state in pending:
+                if state.sock is not None:
+                    state.sock.close()
+            selector.close()
+
+        return ready
+
+
+def wait_for_ssh(host, port=22, timeout=None):
+    """
+    Blocks until ``host`` is accepting SSH connections and returns the
+    number of seconds that took.
+    """
+    return ReadinessProber([host], port=port).wait(timeout=timeout)[host]
@@ -0,0 +1,131 @@
+import threading
+import time
+
+from vpsutil.logger import logger
+
+
+class RateLimiter(object):
+    """
+    A token bucket which keeps requests under the API's rate limit.  The
+    bucket starts with ``burst`` tokens and refills at ``limit / period``
+    tokens per second.  Once the API starts reporting ``RateLimit-*``
+    headers the refill rate is adjusted so the remaining budget is spread
+    evenly until the limit resets and a 429 response blocks all requests
+    until ``Retry-After`` has passed.
+
+    Requests made with ``priority=True`` (mutating calls) are served
+    before waiting low priority requests (polling reads) so a busy
+    waiter can't starve the calls which actually make progress.
+
+    A single instance is meant to be shared by every session in a
+    process, see :attr:`vpsutil.api.Base.rate_limiter`.  The asyncio
+    client shares it too through :meth:`try_acquire` and :meth:`record`,
+    which never block the event loop.
+    """
+    def __init__(self, limit=5000, period=3600, burst=250):
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.rate = float(limit) / period
+        self.updated = time.time()
+        self.blocked_until = 0
+        self._condition = threading.Condition()
+        self._priority_waiting = 0
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self, priority):
+        """
+        Takes a token and returns None, or returns the number of seconds
+        to wait before trying again.  The caller holds the condition.
+        """
+        now = time.time()
+        self._refill(now)
+
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        # Leave the tokens for the mutating calls
+        if not priority and self._priority_waiting:
+            return 0.1
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self, priority=False):
+        """Blocks until a request may be made"""
+        with self._condition:
+            if priority:
+                self._priority_waiting += 1
+
+            try:
+                while True:
+                    delay = self._take(priority)
+                    if delay is None:
+                        return
+                    self._condition.wait(delay)
+            finally:
+                if priority:
+                    self._priority_waiting -= 1
+                    self._condition.notify_all()
+
+    def try_acquire(self, priority=False):
+        """
+        Takes a token without blocking.  Returns None when a request may
+        be made, otherwise the number of seconds to wait before trying
+        again.
+        """
+        with self._condition:
+            return self._take(priority)
+
+    def update(self, response):
+        """Adjusts the bucket using the rate limit headers of ``response``"""
+        self.record(response.status_code, response.headers)
+
+    def record(self, status, headers):
+        """
+        Adjusts the bucket using the ``status`` and rate limit
+        ``headers`` of a response from any http client.
+        """
+        now = time.time()
+
+        try:
+            remaining = int(headers["RateLimit-Remaining"])
+            reset = float(headers["RateLimit-Reset"])
+        except (KeyError, ValueError):
+            remaining = reset = None
+
+        with self._condition:
+            if remaining is not None:
+                self._refill(now)
+                self.tokens = min(self.tokens, remaining)
+                self.rate = max(remaining, 1) / max(reset - now, 1.0)
+
+            if status == 429:
+                delay = self.retry_after(headers, reset, now)
+                logger.warning("Rate limited, waiting %0.1f seconds", delay)
+                self.blocked_until = max(self.blocked_until, now + delay)
+                self.tokens = 0
+
+            self._condition.notify_all()
+
+    def retry_after(self, headers, reset=None, now=None):
+        """
+        Returns the number of seconds to wait after a 429 response with
+        ``headers``.
+        """
+        now = time.time() if now is None else now
+        try:
+            return max(0, float(headers["Retry-After"]))
+        except (KeyError, ValueError):
+            pass
+
+        if reset is not None and reset > now:
+            return reset - now
+
+        return 60
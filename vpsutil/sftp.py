@@ -0,0 +1,284 @@
+import hashlib
+import os
+import posixpath
+import stat
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from errno import ENOENT
+from os.path import join, relpath
+
+import paramiko
+
+from vpsutil.logger import logger
+
+FileInfo = namedtuple("FileInfo", ("size", "mtime"))
+SyncResult = namedtuple(
+    "SyncResult", ("transferred", "skipped", "bytes", "elapsed"))
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def shell_quote(value):
+    return "'%s'" % value.replace("'", "'\"'\"'")
+
+
+class TreeSync(object):
+    """
+    Copies directory trees to or from a remote host over several SFTP
+    channels at once.  Files whose size and mtime (or with
+    ``compare="checksum"``, size and sha256) already match on the
+    destination are skipped so re-deploying a tree only moves the files
+    that changed.  Transferred files get the source's mtime so the next
+    comparison is accurate.
+
+    Usually used through :meth:`vpsutil.ssh.SSHClient.put_tree` and
+    :meth:`vpsutil.ssh.SSHClient.get_tree`.
+
+    :param ssh:
+        The :class:`vpsutil.ssh.SSHClient` to transfer over.
+
+    :param int channels:
+        The number of SFTP channels to transfer over concurrently.
+
+    :param string compare:
+        Either ``mtime`` or ``checksum``.
+
+    :param int window_size:
+        The SSH window size of each channel, larger windows keep more
+        data in flight on high latency links.
+
+    :param int chunk_size:
+        The number of bytes read and written at a time.
+    """
+    WINDOW_SIZE = 16 * 1024 * 1024
+    MAX_PACKET_SIZE = 32 * 1024
+    CHUNK_SIZE = 256 * 1024
+    CHECKSUM_BATCH = 500
+
+    def __init__(self, ssh, channels=4, compare="mtime",
+                 window_size=WINDOW_SIZE, chunk_size=CHUNK_SIZE):
+        assert compare in ("mtime", "checksum")
+        assert channels > 0
+        self.ssh = ssh
+        self.channels = channels
+        self.compare = compare
+        self.window_size = window_size
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def _sftp(self):
+        """Returns the SFTP client for the current thread"""
+        sftp = getattr(self._local, "sftp", None)
+        if sftp is None:
+            transport = self.ssh.client.get_transport()
+            sftp = paramiko.SFTPClient.from_transport(
+                transport, window_size=self.window_size,
+                max_packet_size=self.MAX_PACKET_SIZE)
+            self._local.sftp = sftp
+            with self._lock:
+                self._clients.append(sftp)
+        return sftp
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients)
+            del self._clients[:]
+
+        for sftp in clients:
+            sftp.close()
+        self._local = threading.local()
+
+    def local_files(self, root):
+        """Returns a dictionary of relative path to :class:`FileInfo`"""
+        files = {}
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = join(dirpath, filename)
+                info = os.stat(path)
+                files[relpath(path, root).replace(os.sep, "/")] = FileInfo(
+                    info.st_size, int(info.st_mtime))
+        return files
+
+    def remote_files(self, root):
+        """
+        Returns a dictionary of relative path to :class:`FileInfo`, empty
+        if ``root`` does not exist.
+        """
+        sftp = self._sftp()
+        files = {}
+        pending = [""]
+        while pending:
+            directory = pending.pop()
+            try:
+                entries = sftp.listdir_attr(posixpath.join(root, directory))
+            except IOError as e:
+                if e.errno != ENOENT:
+                    raise
+                continue
+
+            for entry in entries:
+                path = posixpath.join(directory, entry.filename)
+                if stat.S_ISDIR(entry.st_mode):
+                    pending.append(path)
+                elif stat.S_ISREG(entry.st_mode):
+                    files[path] = FileInfo(entry.st_size, int(entry.st_mtime))
+        return files
+
+    def remote_checksums(self, root, paths):
+        """
+        Returns the sha256 of each of ``paths`` under ``root`` using one
+        remote command per ``CHECKSUM_BATCH`` paths.
+        """
+        checksums = {}
+        for index in range(0, len(paths), self.CHECKSUM_BATCH):
+            batch = paths[index:index + self.CHECKSUM_BATCH]
+            result = self.ssh.run(
+                "cd %s && sha256sum -- %s" % (
+                    shell_quote(root), " ".join(map(shell_quote, batch))),
+                echo=False)
+
+            for line in result.stdout.splitlines():
+                checksum, path = line.split(None, 1)
+                checksums[path.lstrip("*")] = checksum
+        return checksums
+
+    def _changed(self, source, destination, source_checksum,
+                 destination_checksum):
+        """
+        Returns the relative paths in ``source`` which differ from
+        ``destination``.  The checksum arguments are callables taking a
+        list of paths and returning a dictionary of path to checksum.
+        """
+        changed = []
+        same_size = []
+        for path, info in source.items():
+            existing = destination.get(path)
+            if existing is None or existing.size != info.size:
+                changed.append(path)
+            elif self.compare == "mtime":
+                if existing.mtime != info.mtime:
+                    changed.append(path)
+            else:
+                same_size.append(path)
+
+        if same_size:
+            source_sums = source_checksum(same_size)
+            destination_sums = destination_checksum(same_size)
+            for path in same_size:
+                if source_sums.get(path) != destination_sums.get(path):
+                    changed.append(path)
+
+        # Start the largest files first so they don't hold up the end
+        changed.sort(key=lambda path: source[path].size, reverse=True)
+        return changed
+
+    def _transfer(self, paths, function):
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.channels) as executor:
+            transferred = sum(executor.map(function, paths))
+        return transferred, time.time() - start
+
+    def _makedirs(self, sftp, root, paths):
+        directories = set()
+        for path in paths:
+            directory = posixpath.dirname(path)
+            while directory and directory not in directories:
+                directories.add(directory)
+                directory = posixpath.dirname(directory)
+
+        for directory in [""] + sorted(directories):
+            remote = posixpath.join(root, directory) if directory else root
+            try:
+                sftp.stat(remote)
+            except IOError as e:
+                if e.errno != ENOENT:
+                    raise
+                sftp.mkdir(remote)
+
+    def put_tree(self, local_root, remote_root):
+        """Copies ``local_root`` to ``remote_root`` on the remote host"""
+        logger.info("Syncing %s to %s:%s", local_root, self.ssh.host,
+                    remote_root)
+        local = self.local_files(local_root)
+        remote = self.remote_files(remote_root)
+        changed = self._changed(
+            local, remote,
+            lambda paths: dict(
+                (path, file_checksum(join(local_root, path)))
+                for path in paths),
+            lambda paths: self.remote_checksums(remote_root, paths))
+
+        self._makedirs(self._sftp(), remote_root, changed)
+
+        def put(path):
+            source = join(local_root, path)
+            destination = posixpath.join(remote_root, path)
+            info = local[path]
+            sftp = self._sftp()
+            with open(source, "rb") as local_file:
+                with sftp.open(destination, "wb") as remote_file:
+                    remote_file.set_pipelined(True)
+                    for chunk in iter(
+                            lambda: local_file.read(self.chunk_size), b""):
+                        remote_file.write(chunk)
+            sftp.utime(destination, (info.mtime, info.mtime))
+            logger.debug("... put %s (%d bytes)", path, info.size)
+            return info.size
+
+        transferred, elapsed = self._transfer(changed, put)
+        logger.info(
+            "... %d file(s) sent (%d bytes), %d unchanged in %0.2fs",
+            len(changed), transferred, len(local) - len(changed), elapsed)
+        return SyncResult(
+            changed, len(local) - len(changed), transferred, elapsed)
+
+    def get_tree(self, remote_root, local_root):
+        """Copies ``remote_root`` on the remote host to ``local_root``"""
+        logger.info("Syncing %s:%s to %s", self.ssh.host, remote_root,
+                    local_root)
+        remote = self.remote_files(remote_root)
+        local = self.local_files(local_root) if os.path.isdir(local_root) \
+            else {}
+        changed = self._changed(
+            remote, local,
+            lambda paths: self.remote_checksums(remote_root, paths),
+            lambda paths: dict(
+                (path, file_checksum(join(local_root, path)))
+                for path in paths))
+
+        for path in changed:
+            directory = os.path.dirname(join(local_root, path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        def get(path):
+            source = posixpath.join(remote_root, path)
+            destination = join(local_root, path)
+            info = remote[path]
+            sftp = self._sftp()
+            with sftp.open(source, "rb") as remote_file:
+                remote_file.prefetch(info.size)
+                with open(destination, "wb") as local_file:
+                    for chunk in iter(
+                            lambda: remote_file.read(self.chunk_size), b""):
+                        local_file.write(chunk)
+            os.utime(destination, (info.mtime, info.mtime))
+            logger.debug("... got %s (%d bytes)", path, info.size)
+            return info.size
+
+        transferred, elapsed = self._transfer(changed, get)
+        logger.info(
+            "... %d file(s) received (%d bytes), %d unchanged in %0.2fs",
+            len(changed), transferred, len(remote) - len(changed), elapsed)
+        return SyncResult(
+            changed, len(remote) - len(changed), transferred, elapsed)
@@ -1,10 +1,12 @@
 import atexit
+import codecs
+import logging
 import os
 import shutil
 import socket
-import subprocess
+import threading
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
 from configparser import NoOptionError, NoSectionError
 from errno import EEXIST, ENOENT
 from os.path import join, isdir, isfile
@@ -16,9 +18,15 @@ except NameError:
 
 import paramiko
 from vpsutil.logger import logger
-from vpsutil.config import CONFIG_FILE, CONFIG_DIR_SSH, config
-
-RSAKeyPair = namedtuple("RSAKeyPair", ("public", "private"))
+from vpsutil.config import CONFIG_DIR_SSH, config, store
+from vpsutil.firewall import Firewall, FirewallPlan, parse_rule
+from vpsutil.keys import KEY_FILES, generate_private_key, write_key_pair
+from vpsutil.probe import wait_for_ssh
+from vpsutil.sftp import TreeSync
+from vpsutil.waiter import Backoff
+
+KeyPair = namedtuple("KeyPair", ("public", "private"))
+RSAKeyPair = KeyPair  # the name used before other key types were supported
 CommandResult = namedtuple("CommandResult", ("stdout", "stderr"))
 
 
@@ -32,27 +40,39 @@ class SSHClient(object):
     ...    ssh.run("apt-get -y autoremove")
     ...    # more commands to setup the host
     """
-    def __init__(self, user, host, key_pair, wait_for_connect=True):
+    def __init__(self, user, host, key_pair, wait_for_connect=True, port=22):
         if isinstance(key_pair, str) and not isdir(key_pair):
             key_pair = self.get_key_pair(key_pair)
 
-        assert isinstance(key_pair, RSAKeyPair)
+        assert isinstance(key_pair, KeyPair)
         self.user = user
         self.host = host
+        self.port = port
         self.key_pair = key_pair
         self.wait_for_connect = wait_for_connect
         self._client = None
         self._sftp = None
+        self._firewall = None
         atexit.register(self.close)
 
     @classmethod
-    def generate_rsa_key_pair(cls, output_dir=None, name=None, bits=2048):
+    def generate_key_pair(cls, output_dir=None, name=None, key_type="rsa",
+                          bits=None, pool=None):
         """
-        Generates a public/private key pair in the given directory
-        with the number of requested bits.
+        Generates a public/private key pair of ``key_type`` (``rsa``,
+        ``ecdsa`` or ``ed25519``) in the given directory with the number
+        of requested bits.  When a :class:`vpsutil.keys.KeyPool` is
+        provided the private key is claimed from the pool instead of
+        being generated.
         """
         assert output_dir is not None or name is not None
-        logger.info("Generating %d-bit RSA key pair in %s", bits, output_dir)
+        if pool is not None:
+            assert pool.key_type == key_type, \
+                "pool has %s keys" % pool.key_type
+
+        logger.info(
+            "Generating %s key pair in %s", key_type,
+            output_dir or join(CONFIG_DIR_SSH, name))
 
         if output_dir is None:
             output_dir = join(CONFIG_DIR_SSH, name)
@@ -62,62 +82,63 @@ class SSHClient(object):
                 if e.errno != EEXIST:
                     raise
 
-        private_file = join(output_dir, "id_rsa")
-        public_file = private_file + ".pub"
-
-        # Generate private key
-        private_key = paramiko.RSAKey.generate(bits=2048)
-        private_key.write_private_key_file(private_file)
-
-        # Generate public key
-        public_key = paramiko.RSAKey(filename=private_file)
-        with open(public_file, "w") as public_file_stream:
-            public_file_stream.write(
-                "%s %s" % (public_key.get_name(), public_key.get_base64()))
+        if pool is not None:
+            private_key = pool.claim()
+        else:
+            private_key = generate_private_key(key_type, bits)
+        public_file, private_file = write_key_pair(
+            output_dir, key_type, private_key)
 
         if name is not None:
-            if not config.has_section("ssh_keys"):
-                config.add_section("ssh_keys")
-            config.set("ssh_keys", name, output_dir)
+            store.set("ssh_keys", name, output_dir)
 
-            shutil.copy2(CONFIG_FILE, CONFIG_FILE + ".last")
-            with open(CONFIG_FILE, "w") as config_file:
-                config.write(config_file)
+        return KeyPair(public=public_file, private=private_file)
 
-        return RSAKeyPair(public=public_file, private=private_file)
+    @classmethod
+    def generate_rsa_key_pair(cls, output_dir=None, name=None, bits=2048):
+        """
+        Generates a public/private key pair in the given directory
+        with the number of requested bits.
+        """
+        return cls.generate_key_pair(
+            output_dir=output_dir, name=name, key_type="rsa", bits=bits)
 
     @classmethod
     def delete_rsa_key_pair(cls, name):
-        """Deletes an RSA key pair from the config and on disk"""
-        try:
-            path = config.get("ssh_keys", name)
-        except (NoOptionError, NoSectionError):
-            return
-        try:
-            shutil.rmtree(path)
-            logger.warning("Deleted local RSA key pair for %s", name)
-        except (OSError, IOError) as e:
-            if e.errno != ENOENT:
-                raise
-        config.remove_option("ssh_keys", name)
-
-        shutil.copy2(CONFIG_FILE, CONFIG_FILE + ".last")
-        with open(CONFIG_FILE, "w") as config_file:
-            config.write(config_file)
+        """Deletes a key pair from the config and on disk"""
+        with store.transaction() as parser:
+            try:
+                path = parser.get("ssh_keys", name)
+            except (NoOptionError, NoSectionError):
+                return
+            try:
+                shutil.rmtree(path)
+                logger.warning("Deleted local key pair for %s", name)
+            except (OSError, IOError) as e:
+                if e.errno != ENOENT:
+                    raise
+            parser.remove_option("ssh_keys", name)
 
     @classmethod
     def get_key_pair(cls, name):
         # First try to get the key pair by name
+        store.refresh()
         try:
             name = config.get("ssh_keys", name)
         except (NoOptionError, NoSectionError):
             pass
 
-        private_key = join(name, "id_rsa")
+        for filename in KEY_FILES:
+            private_key = join(name, filename)
+            if isfile(private_key):
+                break
+        else:
+            private_key = join(name, KEY_FILES[0])
+
         public_key = private_key + ".pub"
         assert isfile(public_key), "not a file %s" % public_key
         assert isfile(private_key), "not a file %s" % private_key
-        return RSAKeyPair(public=public_key, private=private_key)
+        return KeyPair(public=public_key, private=private_key)
 
     @property
     def client(self):
@@ -135,6 +156,16 @@ class SSHClient(object):
         self._sftp = self.client.open_sftp()
         return self._sftp
 
+    @property
+    def firewall(self):
+        """
+        Returns a :class:`vpsutil.firewall.Firewall` for the host, the
+        ruleset is fetched the first time it's needed
+        """
+        if self._firewall is None:
+            self._firewall = Firewall(self)
+        return self._firewall
+
     def __enter__(self):
         self._client = self.connect()
         return self
@@ -146,32 +177,22 @@ class SSHClient(object):
         logger.info("Attempting SSH connection via %s@%s", self.user, self.host)
 
         if wait_for_connect:
-            # First, try to ping the first.  This is more reliable usually
-            # than just constantly trying to connect.
-            start = time.time()
-            ping_count = 0
-            while True:
-                try:
-                    subprocess.check_output(["ping", "-c", "1", self.host])
-                    break
-                except subprocess.CalledProcessError:
-                    pass
-
-                logger.debug("... ping failed")
-                ping_count += 1
-                time.sleep(30)
-
-            logger.debug("... ping complete in %s seconds", time.time() - start)
+            # First, wait for sshd to start answering.  Probing for the
+            # banner is much cheaper than repeatedly attempting a full
+            # ssh connection.
+            elapsed = wait_for_ssh(self.host, port=self.port)
+            logger.debug("... ssh banner received in %0.2f seconds", elapsed)
 
         start = time.time()
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
         logger.debug("... attempting ssh connection")
+        backoff = Backoff(initial=1, maximum=10)
         while True:
             try:
                 ssh.connect(
-                    username=self.user, hostname=self.host,
+                    username=self.user, hostname=self.host, port=self.port,
                     key_filename=self.key_pair.private,
                     timeout=5, banner_timeout=3
                 )
@@ -182,7 +203,12 @@ class SSHClient(object):
                     raise
 
                 logger.debug("... ssh connect() failed: %s", error)
-            time.sleep(10)
+            backoff.sleep()
+
+        # Commands are a few small packets each way, without this every
+        # one of them waits out Nagle's algorithm against delayed ACKs.
+        ssh.get_transport().sock.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         logger.debug(
             "... ssh connection complete in %s seconds", time.time() - start)
@@ -200,53 +226,250 @@ class SSHClient(object):
             self._client = None
             logger.debug("Closed SSH connection")
 
-    def run(self, command, echo=True, read_output=True):
-        if echo:
-            logger.debug("executing: %s", command)
-        else:
-            logger.debug("executing: %s", "*" * len(command))
+    def put_tree(self, local_root, remote_root, **kwargs):
+        """
+        Copies the ``local_root`` directory to ``remote_root`` skipping
+        files which are already up to date.  Keyword arguments are
+        passed to :class:`vpsutil.sftp.TreeSync`.
+        """
+        sync = TreeSync(self, **kwargs)
+        try:
+            return sync.put_tree(local_root, remote_root)
+        finally:
+            sync.close()
 
+    def get_tree(self, remote_root, local_root, **kwargs):
+        """
+        Copies the remote ``remote_root`` directory to ``local_root``
+        skipping files which are already up to date.  Keyword arguments
+        are passed to :class:`vpsutil.sftp.TreeSync`.
+        """
+        sync = TreeSync(self, **kwargs)
+        try:
+            return sync.get_tree(remote_root, local_root)
+        finally:
+            sync.close()
+
+    def _log_command(self, level, message, command, echo, *args):
+        if not echo:
+            command = "*" * len(command)
+        logger.log(level, message, *(args + (command, )))
+
+    def _iter_channel(self, channel, deadline=None, chunk_size=32768):
+        """
+        Generator which yields ``(name, bytes)`` tuples from the stdout
+        and stderr of ``channel`` as data arrives until the command exits.
+        Both streams are drained as we go so a chatty command can't fill
+        the channel window and stall.
+        """
+        # Set by paramiko when either stream receives data or reaches
+        # EOF, so waiting on it wakes up as soon as there's work to do.
+        ready = threading.Event()
+        channel.in_buffer.set_event(ready)
+        channel.in_stderr_buffer.set_event(ready)
+
+        while True:
+            received = False
+            if channel.recv_ready():
+                data = channel.recv(chunk_size)
+                if data:
+                    received = True
+                    yield "stdout", data
+
+            if channel.recv_stderr_ready():
+                data = channel.recv_stderr(chunk_size)
+                if data:
+                    received = True
+                    yield "stderr", data
+
+            if received:
+                continue
+
+            if (channel.exit_status_ready() and not channel.recv_ready()
+                    and not channel.recv_stderr_ready()):
+                return
+
+            if deadline is not None and time.time() > deadline:
+                channel.close()
+                raise socket.timeout("Command did not finish in time")
+
+            # Once the command has sent EOF the only thing left to wait
+            # for is its exit status (closing the channel also sets it).
+            if channel.eof_received:
+                channel.status_event.wait(self._remaining(deadline))
+            else:
+                ready.wait(self._remaining(deadline))
+
+    @staticmethod
+    def _remaining(deadline):
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
+
+    def stream(self, command, echo=True, timeout=None, tail=100, tee=None,
+               lines=True, stdin=None):
+        """
+        Generator which runs ``command`` and yields ``(name, data)``
+        tuples as output arrives, ``name`` is either ``stdout`` or
+        ``stderr``.  ``data`` is a decoded line when ``lines`` is True
+        otherwise it's the raw chunk of bytes that was received.  Only the
+        last ``tail`` lines of each stream are kept in memory, they're
+        logged if the command exits with a non-zero status.
+
+        >>> for name, line in ssh.stream("apt-get -y dist-upgrade"):
+        ...     print(name, line, end="")
+
+        :param float timeout:
+            The number of seconds the command may run for.
+
+        :param tee:
+            A path or a file object accepting bytes which receives a copy
+            of all output.
+
+        :param stdin:
+            Optional string or bytes written to the command's stdin
+            before closing it.
+        """
+        self._log_command(logging.DEBUG, "executing: %s", command, echo)
         start = time.time()
-        stdin, stdout, stderr = self.client.exec_command(command)
-        status = stderr.channel.recv_exit_status()
+        deadline = None if timeout is None else start + timeout
+        stdin_file, stdout, stderr = self.client.exec_command(command)
+        channel = stdout.channel
+
+        if stdin is not None:
+            if not isinstance(stdin, bytes):
+                stdin = stdin.encode("utf-8")
+            stdin_file.write(stdin)
+            stdin_file.flush()
+            channel.shutdown_write()
+
+        tails = {"stdout": deque(maxlen=tail), "stderr": deque(maxlen=tail)}
+        decoders = dict(
+            (name, codecs.getincrementaldecoder("utf-8")("replace"))
+            for name in tails)
+        partial = dict.fromkeys(tails, "")
+
+        tee_stream = open(tee, "wb") if isinstance(tee, str) else tee
+        try:
+            for name, chunk in self._iter_channel(channel, deadline):
+                if tee_stream is not None:
+                    tee_stream.write(chunk)
+
+                text = partial[name] + decoders[name].decode(chunk)
+                complete = text.split("\n")
+                partial[name] = complete.pop()
+                complete = [line + "\n" for line in complete]
+                tails[name].extend(complete)
+
+                if lines:
+                    for line in complete:
+                        yield name, line
+                else:
+                    yield name, chunk
+
+            for name in tails:
+                text = partial[name] + decoders[name].decode(b"", final=True)
+                if text:
+                    tails[name].append(text)
+                    if lines:
+                        yield name, text
+        finally:
+            if isinstance(tee, str):
+                tee_stream.close()
+            if not channel.exit_status_ready():
+                channel.close()
+
+        status = channel.recv_exit_status()
         if status != 0:
             logger.error("  exit: %s", status)
-            logger.error("stdout: %s", stdout.read())
-            logger.error("stderr: %s", stderr.read())
+            logger.error("stdout: %s", "".join(tails["stdout"]))
+            logger.error("stderr: %s", "".join(tails["stderr"]))
             raise ValueError("Non-zero exit status.")
 
-        if read_output:
-            result = CommandResult(
-                stdout=stdout.read().decode(),
-                stderr=stderr.read().decode())
+        self._log_command(
+            logging.INFO, "executed (%0.2fs): %s", command, echo,
+            time.time() - start)
 
-        else:
-            result = CommandResult(stdout=stdout, stderr=stderr)
+    def run(self, command, echo=True, read_output=True, timeout=None,
+            callback=None, tail=100, tee=None, stdin=None):
+        """
+        Runs ``command`` and returns a :class:`CommandResult`.  Output is
+        read as the command runs (see :meth:`stream`).  When ``callback``
+        is provided it's called with ``(name, line)`` for each line of
+        output and the result only contains the last ``tail`` lines of
+        each stream instead of the full output.
+        """
+        if (not read_output and callback is None and tee is None
+                and stdin is None):
+            return self._run_unread(command, echo, timeout)
 
-        elapsed = time.time() - start
-        if echo:
-            logger.info("executed (%0.2fs): %s", elapsed, command)
+        if callback is None:
+            output = {"stdout": [], "stderr": []}
         else:
-            logger.info("executed (%0.2fs): %s", elapsed, "*" * len(command))
+            output = {"stdout": deque(maxlen=tail),
+                      "stderr": deque(maxlen=tail)}
 
-        return result
+        for name, line in self.stream(
+                command, echo=echo, timeout=timeout, tail=tail, tee=tee,
+                stdin=stdin):
+            output[name].append(line)
+            if callback is not None:
+                callback(name, line)
+
+        return CommandResult(
+            stdout="".join(output["stdout"]),
+            stderr="".join(output["stderr"]))
+
+    def _run_unread(self, command, echo, timeout):
+        """
+        Waits for ``command`` to exit and returns the unread stdout and
+        stderr file objects.
+        """
+        self._log_command(logging.DEBUG, "executing: %s", command, echo)
+        start = time.time()
+        stdin, stdout, stderr = self.client.exec_command(
+            command, timeout=timeout)
+
+        if (timeout is not None
+                and not stdout.channel.status_event.wait(timeout)):
+            stdout.channel.close()
+            raise socket.timeout(
+                "Command did not finish within %s seconds" % timeout)
+
+        status = stderr.channel.recv_exit_status()
+        if status != 0:
+            logger.error("  exit: %s", status)
+            logger.error("stdout: %s", stdout.read())
+            logger.error("stderr: %s", stderr.read())
+            raise ValueError("Non-zero exit status.")
+
+        self._log_command(
+            logging.INFO, "executed (%0.2fs): %s", command, echo,
+            time.time() - start)
+        return CommandResult(stdout=stdout, stderr=stderr)
 
     def add_iptables_rule(self, rule, check_first=False):
         """
         Adds an iptables rule if appears that the rule does not
         already exist.  We are under the assumption that the input rule
-        does not contain "iptables" or the sudo command
+        does not contain "iptables" or the sudo command.  The ruleset is
+        only fetched once per client, use :attr:`firewall` directly to
+        add several rules in one call.
         """
-        # TODO: Better handling of iptables/sudo would be nice
-        iptables_save = self.run("iptables-save")
-
         message = "add iptables rule: %s"
-        should_run = True
-        if check_first and rule in iptables_save.stdout:
-            should_run = False
-            message += " (exists)"
-
-        if should_run:
+        try:
+            parsed = parse_rule(rule)
+        except ValueError:
+            # Policies, new chains, etc. aren't part of the ruleset index
             self.run("iptables " + rule)
+            self._firewall = None
+            logger.info(message % rule)
+            return
+
+        firewall = self.firewall
+        if check_first and parsed in firewall:
+            message += " (exists)"
+        else:
+            firewall.apply(FirewallPlan([parsed], []))
 
         logger.info(message % rule)
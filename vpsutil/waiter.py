@@ -0,0 +1,349 @@
+import random
+import threading
+import time
+from concurrent.futures import Future
+from itertools import islice
+
+try:
+    from http.client import NOT_FOUND
+except ImportError:
+    from httplib import NOT_FOUND
+
+from requests import RequestException
+
+from vpsutil.logger import logger
+
+
+class Backoff(object):
+    """
+    Produces increasing delays with jitter up to ``maximum`` seconds.
+    When ``timeout`` is provided :meth:`sleep` raises :class:`TimeoutError`
+    once the deadline has passed and never sleeps past it.
+
+    :param float initial:
+        The first delay in seconds.
+
+    :param float maximum:
+        The largest delay in seconds.
+
+    :param float factor:
+        The amount each delay is multiplied by.
+
+    :param float jitter:
+        The fraction of each delay which is randomized so many
+        clients don't poll in lockstep.
+
+    :param float timeout:
+        Optional number of seconds after which to give up.
+    """
+    def __init__(self, initial=1.0, maximum=15.0, factor=1.5, jitter=0.25,
+                 timeout=None):
+        assert 0 < initial <= maximum
+        assert factor >= 1
+        assert 0 <= jitter < 1
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.current = initial
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def reset(self):
+        """Starts over at the initial delay, the deadline is unchanged"""
+        self.current = self.initial
+
+    def delay(self):
+        """Returns the next delay and advances the backoff"""
+        delay = self.current * (1 - self.jitter * random.random())
+        self.current = min(self.maximum, self.current * self.factor)
+        if self.deadline is not None:
+            delay = min(delay, max(0, self.deadline - time.time()))
+        return delay
+
+    def sleep(self):
+        if self.expired:
+            raise TimeoutError("Deadline exceeded")
+        time.sleep(self.delay())
+
+
+class _Pending(object):
+    __slots__ = ("future", "condition", "deadline")
+
+    def __init__(self, future, condition, deadline):
+        self.future = future
+        self.condition = condition
+        self.deadline = deadline
+
+
+def droplet_active(droplet):
+    return droplet["status"] == "active"
+
+
+class Waiter(object):
+    """
+    Tracks many pending droplets and actions at once.  Each call to
+    :meth:`poll` refreshes everything that's pending using at most one
+    droplet request and one action request regardless of how many
+    droplets or actions are being waited on.  :meth:`wait` calls
+    :meth:`poll` with an adaptive backoff until the requested futures
+    are done.
+
+    >>> waiter = Waiter(do.droplets)
+    >>> futures = [waiter.droplet(droplet_id) for droplet_id in droplet_ids]
+    >>> droplets = waiter.wait(futures, timeout=600)
+
+    :param droplets:
+        The :class:`vpsutil.api.Droplets` instance used to make requests.
+
+    :param callable backoff:
+        A callable returning a new :class:`Backoff` given a timeout.
+    """
+    # The most actions read from the account's action listing in one
+    # poll, anything pending which wasn't seen is fetched on its own.
+    ACTION_SCAN_LIMIT = 200
+
+    def __init__(self, droplets, backoff=Backoff):
+        self.droplets = droplets
+        self.backoff = backoff
+        self._lock = threading.RLock()
+        self._droplets = {}
+        self._actions = {}
+
+    def _add(self, pending, key, condition, timeout, callback):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            pending.setdefault(key, []).append(
+                _Pending(future, condition, deadline))
+        return future
+
+    def droplet(self, droplet_id, condition=droplet_active, timeout=None,
+                callback=None):
+        """
+        Returns a future which resolves to the droplet's data once
+        ``condition(droplet)`` is true, by default once it's active.
+        ``callback`` is called with the future when it's done.
+        """
+        assert isinstance(droplet_id, int)
+        return self._add(
+            self._droplets, droplet_id, condition, timeout, callback)
+
+    def action(self, action_id, timeout=None, callback=None):
+        """
+        Returns a future which resolves to the action's data once it
+        has completed, or raises if the action errored.
+        """
+        assert isinstance(action_id, int)
+        return self._add(self._actions, action_id, None, timeout, callback)
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum(map(len, self._droplets.values())) + \
+                sum(map(len, self._actions.values()))
+
+    def _resolve(self, pending, key, data):
+        """
+        Resolves the futures for ``key`` which ``data`` satisfies and
+        returns the number resolved.
+        """
+        resolved = 0
+        remaining = []
+        for item in pending.get(key, []):
+            try:
+                if item.condition is None or item.condition(data):
+                    item.future.set_result(data)
+                    resolved += 1
+                    continue
+            except Exception as error:
+                item.future.set_exception(error)
+                resolved += 1
+                continue
+            remaining.append(item)
+
+        if remaining:
+            pending[key] = remaining
+        else:
+            pending.pop(key, None)
+        return resolved
+
+    def _expire(self, pending):
+        now = time.time()
+        for key in list(pending):
+            remaining = []
+            for item in pending[key]:
+                if item.future.done():
+                    continue
+                if item.deadline is not None and item.deadline <= now:
+                    item.future.set_exception(
+                        TimeoutError("Timed out waiting for %s" % key))
+                    continue
+                remaining.append(item)
+
+            if remaining:
+                pending[key] = remaining
+            else:
+                del pending[key]
+
+    def _poll_droplets(self):
+        api = self.droplets
+        if len(self._droplets) == 1:
+            droplet_id, = self._droplets
+            droplets = [api.get_droplet(droplet_id)]
+        else:
+            droplets = api.paginate(
+                api.URL + "/droplets", "droplets", cache=False)
+
+        # Stop reading the listing once every pending droplet has been
+        # seen, the remaining pages can't resolve anything.
+        unseen = set(self._droplets)
+        resolved = 0
+        for droplet in droplets:
+            if droplet["id"] in unseen:
+                unseen.discard(droplet["id"])
+                resolved += self._resolve(
+                    self._droplets, droplet["id"], droplet)
+                if not unseen:
+                    break
+        return resolved
+
+    def _get_action(self, action_id):
+        """
+        Returns the action with ``action_id``, None if it doesn't exist
+        in which case anything waiting on it fails.
+        """
+        api = self.droplets
+        response = api.get(api.URL + "/actions/%d" % action_id)
+        if response.status_code == NOT_FOUND:
+            for item in self._actions.pop(action_id, []):
+                item.future.set_exception(
+                    LookupError("No such action %d" % action_id))
+            return None
+        response.raise_for_status()
+        return response.json()["action"]
+
+    def _poll_actions(self):
+        api = self.droplets
+        unseen = set(self._actions)
+        actions = []
+        if len(unseen) > 1:
+            # Actions are listed newest first so reading can stop once
+            # every pending action has been seen or the listing reaches
+            # actions older than the oldest one we're waiting on.
+            oldest = min(unseen)
+            for action in islice(
+                    api.paginate(api.URL + "/actions", "actions", cache=False),
+                    self.ACTION_SCAN_LIMIT):
+                if action["id"] < oldest:
+                    break
+                if action["id"] in unseen:
+                    unseen.discard(action["id"])
+                    actions.append(action)
+                    if not unseen:
+                        break
+
+        # Anything the listing didn't cover (a single pending action, or
+        # one too old or unknown to be found) is fetched directly.
+        for action_id in sorted(unseen):
+            action = self._get_action(action_id)
+            if action is not None:
+                actions.append(action)
+
+        resolved = 0
+        for action in actions:
+            if action["status"] == "errored":
+                for item in self._actions.pop(action["id"], []):
+                    item.future.set_exception(
+                        RuntimeError("Action %d errored" % action["id"]))
+                    resolved += 1
+
+            elif action["status"] == "completed":
+                resolved += self._resolve(self._actions, action["id"], action)
+        return resolved
+
+    def poll(self):
+        """
+        Refreshes everything that's pending and returns the number of
+        futures resolved.
+        """
+        with self._lock:
+            self._expire(self._droplets)
+            self._expire(self._actions)
+
+            resolved = 0
+            for pending, poll in ((self._droplets, self._poll_droplets),
+                                  (self._actions, self._poll_actions)):
+                if not pending:
+                    continue
+
+                # A failed poll is retried on the next tick, the
+                # deadlines above still bound how long that goes on.
+                try:
+                    resolved += poll()
+                except (RequestException, ValueError) as error:
+                    logger.debug("... poll failed, will retry: %s", error)
+
+            logger.debug(
+                "... waiter resolved %d, %d pending", resolved, self.pending)
+            return resolved
+
+    def _discard(self, futures, error):
+        """
+        Fails any of ``futures`` which are not done yet with ``error``
+        and stops polling for them.
+        """
+        futures = set(futures)
+        with self._lock:
+            for pending in (self._droplets, self._actions):
+                for key in list(pending):
+                    remaining = []
+                    for item in pending[key]:
+                        if item.future not in futures:
+                            remaining.append(item)
+                        elif not item.future.done():
+                            item.future.set_exception(error)
+
+                    if remaining:
+                        pending[key] = remaining
+                    else:
+                        del pending[key]
+
+    def wait(self, futures=None, timeout=None):
+        """
+        Polls until ``futures`` (by default everything pending) are done
+        and returns their results in order.  The delay between polls
+        grows while nothing changes and resets when something resolves.
+        If ``timeout`` expires first, the futures which are not done fail
+        with :class:`TimeoutError`, are no longer polled for and the
+        error is raised.
+        """
+        if futures is None:
+            with self._lock:
+                futures = [
+                    item.future
+                    for pending in (self._droplets, self._actions)
+                    for items in pending.values() for item in items]
+
+        backoff = self.backoff(timeout=timeout)
+        while not all(future.done() for future in futures):
+            if self.poll():
+                backoff.reset()
+
+            if all(future.done() for future in futures):
+                break
+
+            try:
+                backoff.sleep()
+            except TimeoutError as error:
+                self._discard(futures, error)
+                raise
+
+        return [future.result() for future in futures]
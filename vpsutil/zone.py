@@ -0,0 +1,125 @@
+from collections import namedtuple
+
+from vpsutil.logger import logger
+
+ZoneChange = namedtuple("ZoneChange", ("action", "record", "current"))
+
+# Fields which make one record with a given (type, name) different
+# from another.
+RECORD_FIELDS = ("data", "priority", "port", "weight", "ttl")
+
+# Record types managed by the provider which are never pruned
+PROTECTED_TYPES = ("SOA", "NS")
+
+
+def record_key(record):
+    """Returns the (type, name) a record is indexed by"""
+    return record["type"], record["name"]
+
+
+def record_matches(current, desired):
+    """
+    Returns True if ``current`` already satisfies ``desired``.  Fields
+    missing from ``desired`` are not compared.
+    """
+    for field in RECORD_FIELDS:
+        if desired.get(field) is None:
+            continue
+        if current.get(field) != desired[field]:
+            return False
+    return True
+
+
+class Zone(object):
+    """
+    An in-memory index of a domain's records keyed by (type, name).
+    Build one with :meth:`vpsutil.api.Domains.zone` which downloads the
+    records once, then use :meth:`plan` to diff against a desired set.
+    """
+    def __init__(self, domain, records):
+        self.domain = domain
+        self.records = {}
+        for record in records:
+            self.records.setdefault(record_key(record), []).append(record)
+
+    def __len__(self):
+        return sum(map(len, self.records.values()))
+
+    def __iter__(self):
+        for records in self.records.values():
+            for record in records:
+                yield record
+
+    def get(self, record_type, name):
+        """Returns the list of records matching ``record_type`` and ``name``"""
+        return list(self.records.get((record_type, name), []))
+
+    def plan(self, records, prune=False):
+        """
+        Returns the list of :class:`ZoneChange` needed to make the zone
+        match ``records``.  Each desired record is a dictionary using the
+        API's field names (``type``, ``name``, ``data`` and optionally
+        ``priority``, ``port``, ``weight`` and ``ttl``).
+
+        Records sharing a (type, name) with a desired record but not
+        matching one are updated or deleted.  When ``prune`` is True
+        records whose (type, name) is not in ``records`` at all are
+        deleted as well, except for SOA and NS records.
+        """
+        desired = {}
+        for record in records:
+            assert record["type"].isupper()
+            desired.setdefault(record_key(record), []).append(record)
+
+        changes = []
+        for key, wanted in desired.items():
+            current = self.get(*key)
+
+            # Anything that already matches is left alone
+            unmatched = []
+            for record in wanted:
+                for existing in current:
+                    if record_matches(existing, record):
+                        current.remove(existing)
+                        break
+                else:
+                    unmatched.append(record)
+
+            # Reuse the leftover records before creating new ones
+            for record in unmatched:
+                if current:
+                    changes.append(ZoneChange("update", record, current.pop(0)))
+                else:
+                    changes.append(ZoneChange("create", record, None))
+
+            for existing in current:
+                changes.append(ZoneChange("delete", existing, existing))
+
+        if prune:
+            for key, existing_records in self.records.items():
+                if key in desired or key[0] in PROTECTED_TYPES:
+                    continue
+                for existing in existing_records:
+                    changes.append(ZoneChange("delete", existing, existing))
+
+        logger.debug(
+            "... zone %s plan: %d create, %d update, %d delete", self.domain,
+            *[sum(1 for change in changes if change.action == action)
+              for action in ("create", "update", "delete")])
+        return changes
+
+    def apply(self, change, record):
+        """
+        Updates the index after ``change`` has been applied, ``record``
+        is the record returned by the API (None for deletes).
+        """
+        if change.current is not None:
+            key = record_key(change.current)
+            self.records[key] = [
+                existing for existing in self.records.get(key, [])
+                if existing["id"] != change.current["id"]]
+            if not self.records[key]:
+                del self.records[key]
+
+        if record is not None:
+            self.records.setdefault(record_key(record), []).append(record)